@@ -0,0 +1,104 @@
+"""Postcode validation cost per address, before and after panda.util.postcode.
+
+"before" is the validator AddressBase used to have: the regex compiled (or
+fetched from re's own cache) and matched on every call. The addresses repeat
+a smaller set of postcodes, as a street or household would:
+
+    python -m benchmarks.postcode --addresses 100000 --distinct 5000
+"""
+import argparse
+import json
+import random
+import re
+import time
+from typing import Callable, Dict, List
+
+from panda.enums import AddressOwnerType
+from panda.schemas import AddressCreate
+from panda.util import postcode
+
+
+def legacy_coerce_postcode(v: str) -> str:
+    v = re.sub(r"[^a-zA-Z0-9]", "", v).upper()
+    valid_postcode = re.compile(
+        # This is the government's postcode validation regex
+        r"^([Gg][Ii][Rr] 0[Aa]{2})|((([A-Za-z][0-9]{1,2})|(([A-Za-z][A-Ha-hJ-Yj-y]"
+        r"[0-9]{1,2})|(([A-Za-z][0-9][A-Za-z])|([A-Za-z][A-Ha-hJ-Yj-y][0-9]"
+        r"[A-Za-z]?))))\s?[0-9][A-Za-z]{2})$"
+    )
+    match = valid_postcode.match(v)
+    if not match:
+        raise ValueError(f"Could not parse post code: {v}")
+    return v
+
+
+def sample_postcodes(addresses: int, distinct: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    letters = "ABDEFGHJLNPQRSTUWXYZ"
+    pool = [
+        f"{rng.choice(('TR', 'LS', 'M', 'EC', 'B'))}{rng.randint(1, 99)}"
+        f"{rng.choice((' ', '', '-'))}{rng.randint(0, 9)}"
+        f"{rng.choice(letters)}{rng.choice(letters)}"
+        for _ in range(distinct)
+    ]
+    return [rng.choice(pool) for _ in range(addresses)]
+
+
+def _per_address_us(
+    function: Callable[[List[str]], object], postcodes: List[str]
+) -> float:
+    start = time.perf_counter()
+    function(postcodes)
+    return round(1e6 * (time.perf_counter() - start) / len(postcodes), 3)
+
+
+def _addresses(postcodes: List[str]) -> None:
+    for value in postcodes:
+        AddressCreate(
+            owner_type=AddressOwnerType.PATIENT,
+            line1="1 High Street",
+            line2="",
+            town="Newquay",
+            county="Cornwall",
+            postcode=value,
+            country="UK",
+        )
+
+
+def run(addresses: int, distinct: int, seed: int) -> Dict[str, float]:
+    postcodes = sample_postcodes(addresses, distinct, seed)
+    results = {
+        "before_us": _per_address_us(
+            lambda values: [legacy_coerce_postcode(v) for v in values], postcodes
+        ),
+    }
+    postcode.canonical_postcode.cache_clear()
+    results["after_us"] = _per_address_us(
+        lambda values: [postcode.normalise_postcode(v) for v in values], postcodes
+    )
+    results["after_warm_cache_us"] = _per_address_us(
+        lambda values: [postcode.normalise_postcode(v) for v in values], postcodes
+    )
+    postcode.canonical_postcode.cache_clear()
+    results["batch_us"] = _per_address_us(postcode.normalise_postcodes, postcodes)
+    # The whole model, for the share the postcode takes
+    results["address_create_us"] = _per_address_us(_addresses, postcodes)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Postcode validation benchmark")
+    parser.add_argument("--addresses", type=int, default=100000)
+    parser.add_argument(
+        "--distinct",
+        type=int,
+        default=5000,
+        help="Distinct postcodes among the addresses",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.addresses, args.distinct, args.seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
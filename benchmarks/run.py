@@ -0,0 +1,485 @@
+"""In-process load tests of panda.main:app.
+
+Requests are sent through httpx's ASGITransport, so there is no server or
+network in the way and the numbers measure the app, crud and schemas. The app
+runs against a SQLite database seeded afresh for every run (the cancels and
+attends of one run would change the next), and reads the rest of its
+settings from the environment as usual, e.g. ASYNC_DATABASE=true:
+
+    python -m benchmarks.run --patients 10000 --requests 2000 --output report.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+
+Each scenario reports requests/sec, latency percentiles and SQL statements
+per request. With --baseline the report is compared against a stored one,
+and the exit status is 1 if any scenario regressed.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import count
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import httpx
+import numpy as np
+
+# Timings are noisy, statements per request are not
+DEFAULT_TOLERANCE = 0.2
+QUERIES_TOLERANCE = 0.05
+
+INSERT_CHUNK_SIZE = 5000
+PAGE_SIZE = 50
+# Appointments are seeded on days 1 to SEEDED_DAYS from today
+SEEDED_DAYS = 120
+
+# NHS Digital's test range, valid numbers that are never issued
+TEST_NHS_NUMBER_START = 999_000_000
+
+
+def nhs_numbers(size: int) -> List[str]:
+    """Distinct NHS numbers with valid check digits, from the test range"""
+    # pylint: disable=import-outside-toplevel
+    from panda.util.nhs_validator import check_digits
+
+    numbers: List[str] = []
+    body = TEST_NHS_NUMBER_START
+    while len(numbers) < size:
+        bodies = np.arange(body, body + size, dtype=np.int64)
+        checksums = check_digits(bodies)
+        valid = checksums != 10  # Never valid
+        numbers.extend(
+            f"{digits}{checksum}"
+            for digits, checksum in zip(
+                bodies[valid].tolist(), checksums[valid].tolist()
+            )
+        )
+        body += size
+    return numbers[:size]
+
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    """Nearest rank percentile of already sorted values"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+def summarise(
+    latencies: List[float], elapsed: float, errors: int, statements: int
+) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    requests = len(latencies)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "requests_per_sec": round(requests / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(1000 * sum(latencies) / requests, 3) if requests else 0.0,
+        "p50_ms": round(1000 * percentile(latencies, 0.50), 3),
+        "p95_ms": round(1000 * percentile(latencies, 0.95), 3),
+        "p99_ms": round(1000 * percentile(latencies, 0.99), 3),
+        "queries_per_request": round(statements / requests, 2) if requests else 0.0,
+    }
+
+
+def compare(
+    report: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE
+) -> List[str]:
+    """
+    The regressions of a report against a baseline: throughput down or p95
+    latency up by more than the tolerance (a fraction), or more statements
+    per request. Scenarios missing from either are skipped.
+    """
+    regressions = []
+    for name, result in report["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if result["requests_per_sec"] < base["requests_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['requests_per_sec']} requests/sec, "
+                f"baseline {base['requests_per_sec']}"
+            )
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {result['p95_ms']}ms, baseline {base['p95_ms']}ms"
+            )
+        if (
+            result["queries_per_request"]
+            > base["queries_per_request"] + QUERIES_TOLERANCE
+        ):
+            regressions.append(
+                f"{name}: {result['queries_per_request']} queries/request, "
+                f"baseline {base['queries_per_request']}"
+            )
+    return regressions
+
+
+class Workload:
+    """The seeded keys the requests pick from, and appointments still scheduled"""
+
+    def __init__(self, seed: int, nhs_numbers_: List[str], appointment_ids: List[int]):
+        self.rng = random.Random(seed)
+        self.nhs_numbers = nhs_numbers_
+        self.patients = len(nhs_numbers_)
+        # Cancel and attend each take one, created appointments are added
+        shuffled = list(appointment_ids)
+        self.rng.shuffle(shuffled)
+        self.scheduled: Deque[int] = deque(shuffled)
+        self.patients_cursor: Optional[str] = None
+        # Created appointments get an hour each, after the seeded ones, so they
+        # never overlap
+        self.first_free_slot = datetime.utcnow().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=SEEDED_DAYS + 1)
+        self.slots = count()
+
+    def scheduled_appointment(self) -> int:
+        if not self.scheduled:
+            raise RuntimeError(
+                "Every scheduled appointment has been used, seed more patients"
+            )
+        return self.scheduled.popleft()
+
+
+Operation = Callable[[httpx.AsyncClient, Workload], Awaitable[httpx.Response]]
+
+
+def _timestamp(value: datetime) -> str:
+    return f"{value.isoformat()}Z"
+
+
+async def patient_by_nhs_number(
+    client: httpx.AsyncClient, workload: Workload
+) -> httpx.Response:
+    return await client.get(
+        "/patients/getbynhsnumber",
+        params={"nhs_no": workload.rng.choice(workload.nhs_numbers)},
+    )
+
+
+async def patient_by_id(
+    client: httpx.AsyncClient, workload: Workload
+) -> httpx.Response:
+    return await client.get(f"/patients/{workload.rng.randint(1, workload.patients)}")
+
+
+async def patients_page(
+    client: httpx.AsyncClient, workload: Workload
+) -> httpx.Response:
+    """Follows the next page cursor through the patients, then starts again"""
+    params: Dict[str, Any] = {"limit": PAGE_SIZE}
+    if workload.patients_cursor:
+        params["cursor"] = workload.patients_cursor
+    response = await client.get("/patients/", params=params)
+    workload.patients_cursor = response.headers.get("X-Next-Cursor")
+    return response
+
+
+async def appointments_day(
+    client: httpx.AsyncClient, workload: Workload
+) -> httpx.Response:
+    day = datetime.utcnow().replace(
+        hour=0, minute=0, second=0, microsecond=0
+    ) + timedelta(days=workload.rng.randint(1, SEEDED_DAYS))
+    return await client.get(
+        "/appointments/",
+        params={
+            "start_from": _timestamp(day),
+            "start_to": _timestamp(day + timedelta(days=1)),
+            "limit": PAGE_SIZE,
+        },
+    )
+
+
+async def create_appointment(
+    client: httpx.AsyncClient, workload: Workload
+) -> httpx.Response:
+    start_at = workload.first_free_slot + timedelta(hours=next(workload.slots))
+    response = await client.post("/appointments/", json={
+        "patient_id": workload.rng.randint(1, workload.patients),
+        "start_at": _timestamp(start_at),
+        "end_at": _timestamp(start_at + timedelta(minutes=30)),
+    })
+    if response.status_code == 200:
+        workload.scheduled.append(response.json()["id"])
+    return response
+
+
+async def cancel_appointment(
+    client: httpx.AsyncClient, workload: Workload
+) -> httpx.Response:
+    return await client.post(f"/appointments/{workload.scheduled_appointment()}/cancel")
+
+
+async def mark_appointment_attended(
+    client: httpx.AsyncClient, workload: Workload
+) -> httpx.Response:
+    return await client.post(
+        f"/appointments/{workload.scheduled_appointment()}/attended"
+    )
+
+
+# Scenario name -> operations and their weights
+SCENARIOS: Dict[str, List[Tuple[Operation, int]]] = {
+    "patient_by_nhs_number": [(patient_by_nhs_number, 1)],
+    "patient_by_id": [(patient_by_id, 1)],
+    "patients_page": [(patients_page, 1)],
+    "appointments_day": [(appointments_day, 1)],
+    "appointment_create": [(create_appointment, 1)],
+    "appointment_cancel": [(cancel_appointment, 1)],
+    "appointment_attend": [(mark_appointment_attended, 1)],
+    # Mostly reads, like reception and clinic screens
+    "mixed": [
+        (patient_by_nhs_number, 35),
+        (patient_by_id, 10),
+        (patients_page, 15),
+        (appointments_day, 20),
+        (create_appointment, 10),
+        (cancel_appointment, 5),
+        (mark_appointment_attended, 5),
+    ],
+}
+
+
+def statements_run() -> float:
+    from panda import metrics  # pylint: disable=import-outside-toplevel
+
+    return sum(metrics.registry.counters.get("panda_db_statements_total", {}).values())
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    workload: Workload,
+    operations: List[Tuple[Operation, int]],
+    requests: int,
+    concurrency: int,
+) -> Dict[str, Any]:
+    """
+    Sends the requests from concurrency clients at once, each waiting for its
+    response
+    """
+    functions, weights = zip(*operations)
+    remaining = iter(range(requests))  # Shared by the clients
+    latencies: List[float] = []
+    errors = 0
+
+    async def client_loop() -> None:
+        nonlocal errors
+        for _ in remaining:
+            operation = workload.rng.choices(functions, weights)[0]
+            start = time.perf_counter()
+            response = await operation(client, workload)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    statements = statements_run()
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return summarise(latencies, elapsed, errors, int(statements_run() - statements))
+
+
+def seed_database(
+    engine, patients: int, appointments_per_patient: int, seed: int
+) -> Workload:
+    """Inserts the patients, an address each and their future appointments with Core"""
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy import insert
+
+    from panda import models, stats
+
+    rng = random.Random(seed)
+    numbers = nhs_numbers(patients)
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    patient_rows = [
+        {
+            "id": patient_id,
+            "nhs_number": nhs_number,
+            "name": f"Patient {patient_id}",
+            "dob": (today - timedelta(days=rng.randint(365, 90 * 365))).date(),
+            "sex": rng.choice(("Male", "Female")),
+            "created_at": today,
+        }
+        for patient_id, nhs_number in enumerate(numbers, 1)
+    ]
+    address_rows = [
+        {
+            "owner_type": "patient",
+            "owner_id": patient_id,
+            "line1": f"{patient_id} High Street",
+            "town": "Leeds",
+            "county": "West Yorkshire",
+            "postcode": (
+                f"LS{rng.randint(1, 29)} {rng.randint(1, 9)}"
+                f"{rng.choice('ABDEFGHJLNPQRSTUWXYZ')}"
+                f"{rng.choice('ABDEFGHJLNPQRSTUWXYZ')}"
+            ),
+            "country": "GB",
+        }
+        for patient_id in range(1, patients + 1)
+    ]
+    appointment_rows = []
+    for patient_id in range(1, patients + 1):
+        # A different day each, so no appointments of a patient overlap
+        for day in rng.sample(range(1, SEEDED_DAYS + 1), appointments_per_patient):
+            start_at = today + timedelta(
+                days=day, hours=rng.randint(8, 16), minutes=rng.choice((0, 15, 30, 45))
+            )
+            appointment_rows.append({
+                "patient_id": patient_id,
+                "start_at": start_at,
+                "end_at": start_at + timedelta(minutes=30),
+                "is_cancelled": False,
+                "status": "scheduled",
+                "created_at": today,
+            })
+
+    with engine.begin() as connection:
+        for model, rows in (
+            (models.Patient, patient_rows),
+            (models.Address, address_rows),
+            (models.Appointment, appointment_rows),
+        ):
+            for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+                connection.execute(insert(model), rows[start:start + INSERT_CHUNK_SIZE])
+        stats.rebuild(connection)
+    return Workload(seed, numbers, list(range(1, len(appointment_rows) + 1)))
+
+
+def configure(database: str) -> None:
+    """Points the app's settings at a new, empty database, before panda is imported"""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{database}"
+    os.environ.pop("SQLALCHEMY_ASYNC_DATABASE_URL", None)  # Derived from the URL above
+    # One JSON line per request would be part of the measurement
+    os.environ.setdefault("ACCESS_LOG", "false")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # pylint: disable=import-outside-toplevel
+    from panda.core.config import settings
+    from panda.database import engine
+    from panda.main import app
+
+    started = time.perf_counter()
+    workload = seed_database(
+        engine, args.patients, args.appointments_per_patient, args.seed
+    )
+    print(
+        f"Seeded {args.patients} patients in {time.perf_counter() - started:.1f}s",
+        file=sys.stderr,
+    )
+
+    scenarios: Dict[str, Any] = {}
+    # No lifespan events: the missed sweeper and metrics writer don't run
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://panda"
+    ) as client:
+        for name in args.scenario or SCENARIOS:
+            operations = SCENARIOS[name]
+            if args.warmup:
+                await run_scenario(
+                    client, workload, operations, args.warmup, args.concurrency
+                )
+            scenarios[name] = await run_scenario(
+                client, workload, operations, args.requests, args.concurrency
+            )
+            print(f"{name}: {scenarios[name]}", file=sys.stderr)
+
+    return {
+        "settings": {
+            "patients": args.patients,
+            "appointments_per_patient": args.appointments_per_patient,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "async_database": settings.ASYNC_DATABASE,
+            "fast_json": settings.FAST_JSON,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "scenarios": scenarios,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PANDA API benchmarks")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="Repeat for several, default all",
+    )
+    parser.add_argument(
+        "--database",
+        default="panda_bench.db",
+        help="SQLite file, replaced on every run",
+    )
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--appointments-per-patient", type=int, default=3)
+    parser.add_argument(
+        "--requests", type=int, default=2000, help="Timed requests per scenario"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=100, help="Untimed requests before each scenario"
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here, default stdout")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    configure(args.database)
+    report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline.get("settings") != report["settings"]:
+            print(
+                "Warning: the baseline was run with different settings", file=sys.stderr
+            )
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Awaitable versions of the crud functions, used by the routers.
+
+With ASYNC_DATABASE enabled the routers get an AsyncSession, and each crud
+function runs through AsyncSession.run_sync: the SQL goes through the async
+driver (aiosqlite/asyncpg) and the event loop carries on with other requests
+while a query is in flight. With the default sync Session the call is moved to
+the threadpool instead, so the event loop is never blocked on the database.
+"""
+import functools
+from typing import Any, AsyncIterator, Callable, Iterator, List, TypeVar
+
+from sqlalchemy import RowMapping, Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from panda import crud
+from panda.database import DbSession
+
+T = TypeVar("T")
+
+
+async def run(fn: Callable[..., T], db: DbSession, **kwargs: Any) -> T:
+    """Runs a sync crud function without blocking the event loop"""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(lambda session: fn(db=session, **kwargs))
+    return await run_in_threadpool(fn, db=db, **kwargs)
+
+
+async def stream(
+    db: DbSession, statement: Select, yield_per: int = 1000
+) -> AsyncIterator[List[RowMapping]]:
+    """
+    Streams the rows of a select in batches of yield_per, using a server-side
+    cursor where the driver has one, so whole tables can be read in constant memory
+    """
+    statement = statement.execution_options(yield_per=yield_per)
+    if isinstance(db, AsyncSession):
+        result = await db.stream(statement)
+        async for partition in result.mappings().partitions():
+            yield partition
+        return
+
+    def partitions() -> Iterator[List[RowMapping]]:
+        yield from db.execute(statement).mappings().partitions()
+
+    async for partition in iterate_in_threadpool(partitions()):
+        yield partition
+
+
+def _awaitable(fn: Callable[..., T]) -> Callable[..., Any]:
+    @functools.wraps(fn)
+    async def wrapper(db: DbSession, **kwargs: Any) -> T:
+        return await run(fn, db, **kwargs)
+
+    return wrapper
+
+
+get_patient_by_id = _awaitable(crud.get_patient_by_id)
+get_patient_by_nhs_number = _awaitable(crud.get_patient_by_nhs_number)
+get_cached_patient = _awaitable(crud.get_cached_patient)
+get_patient_with_related = _awaitable(crud.get_patient_with_related)
+get_cached_patient_by_nhs_number = _awaitable(crud.get_cached_patient_by_nhs_number)
+get_patient_version = _awaitable(crud.get_patient_version)
+get_patients = _awaitable(crud.get_patients)
+create_patient = _awaitable(crud.create_patient)
+create_patients = _awaitable(crud.create_patients)
+update_patient = _awaitable(crud.update_patient)
+delete_patient = _awaitable(crud.delete_patient)
+get_addresses = _awaitable(crud.get_addresses)
+create_patient_address = _awaitable(crud.create_patient_address)
+get_address_by_patient_id = _awaitable(crud.get_address_by_patient_id)
+get_address_version_by_patient_id = _awaitable(crud.get_address_version_by_patient_id)
+get_address_version = _awaitable(crud.get_address_version)
+get_address_by_id = _awaitable(crud.get_address_by_id)
+get_appointments = _awaitable(crud.get_appointments)
+get_patient_appointments = _awaitable(crud.get_patient_appointments)
+get_appointment_stats = _awaitable(crud.get_appointment_stats)
+get_appointment_conflicts = _awaitable(crud.get_appointment_conflicts)
+get_appointment_version = _awaitable(crud.get_appointment_version)
+get_appointment_by_id = _awaitable(crud.get_appointment_by_id)
+create_appointment = _awaitable(crud.create_appointment)
+update_appointment = _awaitable(crud.update_appointment)
+cancel_appointment = _awaitable(crud.cancel_appointment)
+mark_appointment_attended = _awaitable(crud.mark_appointment_attended)
+bulk_cancel_appointments = _awaitable(crud.bulk_cancel_appointments)
+bulk_mark_appointments_attended = _awaitable(crud.bulk_mark_appointments_attended)
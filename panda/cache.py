@@ -0,0 +1,173 @@
+"""Read-through cache of patients, keyed by patient id and NHS number.
+
+Entries are the JSON-compatible dicts of schemas.Patient, so they can be
+returned straight from the routers and stored in a shared backend as-is. The
+NHS number keys hold only the patient id, and are checked against the entry.
+
+The default backend is a bounded in-process LRU with a TTL, so each uvicorn
+worker keeps its own copy and may serve an entry up to PATIENT_CACHE_TTL
+seconds old after another worker changed it. Set CACHE_REDIS_URL (and install
+the redis package) to share one cache between workers, so that invalidation
+on update and delete is seen by all of them.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple, Union
+
+from panda.core.config import settings
+
+Entry = Dict[str, Any]
+
+
+class LocalBackend:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[float, Entry]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Entry) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisBackend:
+    def __init__(self, url: str, ttl: float):
+        try:
+            import redis  # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise ImportError(
+                "CACHE_REDIS_URL is set but the redis package is not installed"
+            ) from exc
+        self.ttl = ttl
+        self.evictions = 0  # Eviction is left to the Redis maxmemory policy
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[Entry]:
+        value = self._client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Entry) -> None:
+        self._client.set(key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def delete(self, *keys: str) -> None:
+        self._client.delete(*keys)
+
+    def clear(self) -> None:
+        keys = list(self._client.scan_iter("patient:*"))
+        if keys:
+            self._client.delete(*keys)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self._client.scan_iter("patient:*"))
+
+
+class PatientCache:
+    def __init__(self, backend: Union[LocalBackend, RedisBackend, None]):
+        # No backend disables the cache, every lookup is a miss
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _id_key(patient_id: int) -> str:
+        return f"patient:id:{patient_id}"
+
+    @staticmethod
+    def _nhs_key(nhs_number: str) -> str:
+        return f"patient:nhs:{nhs_number}"
+
+    def _count(self, value: Optional[Entry]) -> Optional[Entry]:
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def get_by_id(self, patient_id: int) -> Optional[Entry]:
+        if self.backend is None:
+            return self._count(None)
+        return self._count(self.backend.get(self._id_key(patient_id)))
+
+    def get_by_nhs_number(self, nhs_number: str) -> Optional[Entry]:
+        if self.backend is None:
+            return self._count(None)
+        # The NHS number key only points at the id entry, so invalidating the id
+        # is enough, even when the NHS number changed and the old one isn't known
+        pointer = self.backend.get(self._nhs_key(nhs_number))
+        patient = (
+            self.backend.get(self._id_key(pointer["id"]))
+            if pointer is not None
+            else None
+        )
+        if patient is not None and patient["nhs_number"] != nhs_number:
+            patient = None
+        return self._count(patient)
+
+    def set(self, patient: Entry) -> None:
+        if self.backend is not None:
+            self.backend.set(self._id_key(patient["id"]), patient)
+            self.backend.set(
+                self._nhs_key(patient["nhs_number"]), {"id": patient["id"]}
+            )
+
+    def invalidate(self, patient_id: int, nhs_number: Optional[str] = None) -> None:
+        if self.backend is not None:
+            keys = [self._id_key(patient_id)]
+            if nhs_number is not None:
+                keys.append(self._nhs_key(nhs_number))
+            self.backend.delete(*keys)
+
+    def clear(self) -> None:
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions if self.backend is not None else 0,
+            "size": len(self.backend) if self.backend is not None else 0,
+        }
+
+
+def _backend() -> Union[LocalBackend, RedisBackend, None]:
+    if settings.CACHE_REDIS_URL:
+        return RedisBackend(settings.CACHE_REDIS_URL, settings.PATIENT_CACHE_TTL)
+    if settings.PATIENT_CACHE_SIZE > 0:
+        return LocalBackend(settings.PATIENT_CACHE_SIZE, settings.PATIENT_CACHE_TTL)
+    return None
+
+
+patient_cache = PatientCache(_backend())
@@ -1,7 +1,20 @@
-from typing import List, Union
+from typing import Any, Dict, List, Optional, Union
 
 from pydantic import AnyHttpUrl, BaseSettings, validator
 
+ASYNC_DRIVERS = {
+    "sqlite://": "sqlite+aiosqlite://",
+    "postgresql://": "postgresql+asyncpg://",
+}
+
+
+def async_database_url(url: str) -> Optional[str]:
+    """The URL of the async driver for a sync database URL, if one is known"""
+    for sync_prefix, async_prefix in ASYNC_DRIVERS.items():
+        if url.startswith(sync_prefix):
+            return async_prefix + url[len(sync_prefix):]
+    return None
+
 
 class Settings(BaseSettings):
     PROJECT_NAME: str = "PANDA"
@@ -24,6 +37,96 @@ class Settings(BaseSettings):
 
     SQLALCHEMY_DATABASE_URL: str = "sqlite:///./panda_app.db"
 
+    # Serve requests through an AsyncSession (aiosqlite/asyncpg) instead of
+    # the sync session. The async URL is derived from the sync one if not set.
+    ASYNC_DATABASE: bool = False
+    SQLALCHEMY_ASYNC_DATABASE_URL: Optional[str] = None
+
+    @validator("SQLALCHEMY_ASYNC_DATABASE_URL", always=True)
+    def assemble_async_database_url(
+        cls, v: Optional[str], values: Dict[str, Any]
+    ) -> Optional[str]:
+        if v:
+            return v
+        return async_database_url(values.get("SQLALCHEMY_DATABASE_URL", ""))
+
+    # Read-only replicas serving the GET routes, a JSON list, e.g.
+    # '["sqlite:///file:./panda_replica.db?mode=ro&uri=true"]'.
+    # Each read goes to the next replica in turn, one that fails to connect
+    # is skipped for REPLICA_RETRY_INTERVAL seconds, and reads go to the
+    # primary when none is left. Clients read from the primary for
+    # READ_YOUR_WRITES_SECONDS after a write, so they see it despite lag
+    SQLALCHEMY_REPLICA_URLS: List[str] = []
+    REPLICA_RETRY_INTERVAL: float = 10.0
+    READ_YOUR_WRITES_SECONDS: float = 5.0
+
+    # Connection pool, applies to databases using a queue pool
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_PRE_PING: bool = False
+    DB_POOL_RECYCLE: int = -1  # Seconds, -1 never recycles
+
+    # SQLite pragmas set on every new connection. WAL lets readers carry on
+    # while a write commits. Cache size is in KiB when negative (SQLite's own
+    # convention)
+    SQLITE_WAL: bool = True
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE: int = -64 * 1024
+
+    @validator("SQLITE_SYNCHRONOUS")
+    def validate_sqlite_synchronous(cls, v: str) -> str:
+        if v.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(
+                f"SQLITE_SYNCHRONOUS must be OFF, NORMAL, FULL or EXTRA: {v}"
+            )
+        return v.upper()
+
+    # Patients validated and inserted per transaction by POST /patients/bulk
+    BULK_IMPORT_CHUNK_SIZE: int = 500
+
+    # Patients cached by id and NHS number, 0 disables the in-process cache
+    PATIENT_CACHE_SIZE: int = 10000
+    PATIENT_CACHE_TTL: float = 60.0
+    # Share the cache between workers, e.g. redis://localhost:6379/0
+    CACHE_REDIS_URL: Optional[str] = None
+
+    # Encode list and export responses with orjson straight from row mappings,
+    # skipping the Pydantic round trip. The JSON is the same byte for byte
+    FAST_JSON: bool = False
+
+    # JSON lines access log, written to stderr unless a file is given
+    ACCESS_LOG: bool = True
+    ACCESS_LOG_FILE: Optional[str] = None
+    # Fraction of successful requests logged, 4xx and 5xx are always logged
+    ACCESS_LOG_SAMPLE_RATE: float = 1.0
+
+    # Statements allowed per request, by "METHOD /route/{template}" or route
+    # template, e.g. QUERY_BUDGETS='{"GET /patients/": 2}'. Identical
+    # statements repeated N_PLUS_ONE_THRESHOLD times are flagged too.
+    # QUERY_BUDGET_MODE "log" warns, "raise" fails the request (for tests)
+    QUERY_BUDGET: int = 20
+    QUERY_BUDGETS: Dict[str, int] = {}
+    N_PLUS_ONE_THRESHOLD: int = 5
+    QUERY_BUDGET_MODE: str = "log"
+
+    @validator("QUERY_BUDGET_MODE")
+    def validate_query_budget_mode(cls, v: str) -> str:
+        if v not in ("log", "raise"):
+            raise ValueError(f"QUERY_BUDGET_MODE must be log or raise: {v}")
+        return v
+
+    # Directory shared by the workers, to aggregate their /metrics
+    METRICS_DIR: Optional[str] = None
+    METRICS_FLUSH_INTERVAL: float = 5.0  # Seconds
+
+    # Seconds between sweeps marking ended, unattended appointments as
+    # missed, 0 disables the sweeper. Rows are updated in chunks, one
+    # transaction each, so writes are never blocked for long
+    MISSED_SWEEP_INTERVAL: float = 60.0
+    MISSED_SWEEP_CHUNK_SIZE: int = 500
+
     # To implement
     # POSTGRES_USER: str
     # POSTGRES_PASSWORD: str
@@ -1,11 +1,31 @@
 # pylint: disable=expression-not-assigned
-from datetime import datetime
+import heapq
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 from enum import Enum
+from typing import Callable, FrozenSet, List, Sequence, Tuple, Union
 
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import (
+    Select,
+    and_,
+    column,
+    exists,
+    insert,
+    literal,
+    or_,
+    select,
+    tuple_,
+    update,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Query, Session, selectinload
 
-from panda import models, schemas
+from panda import database, models, schemas, search, stats
+from panda.cache import patient_cache
+from panda.enums import AppointmentStatus, PatientInclude, StatsPeriod
+from panda.util import pagination
 
 
 class ErrorsEng(Enum):
@@ -33,7 +53,69 @@ class ErrorsEng(Enum):
     )
     APPT_ALREADY_ATTENDED = "Cannot alter an attended appointment, ID: "
     NO_ADDRESS_FOR_PATIENT_ID = "No address found for patient, ID: "
-    
+    INVALID_CURSOR = "Could not parse pagination cursor, cursor: "
+    UNSUPPORTED_IMPORT_TYPE = (
+        "Bulk imports must be NDJSON or CSV, Content-Type: "
+    )
+    VERSION_MISMATCH = (
+        "Resource has changed since it was fetched (If-Match), ID: "
+    )
+    APPT_OVERLAP = (
+        "Appointment overlaps another appointment of the patient, ID: "
+    )
+    PATIENT_IMPORT_CONFLICT = (
+        "Patient could not be imported, patients with the chunk's NHS Numbers "
+        "kept being added, NHS No.: "
+    )
+    APPT_BOOKING_CONFLICT = (
+        "Appointment could not be booked, the patient's appointments kept "
+        "changing, patient ID: "
+    )
+    STATS_RANGE_TOO_LONG = (
+        "Appointment stats are limited to 366 days, date_from: "
+    )
+    INVALID_INCLUDE = (
+        f"Include must be a comma separated list of {PatientInclude.list()}, include: "
+    )
+
+
+def error_code(detail) -> str:
+    """The ErrorsEng name of an HTTPException detail, for metrics"""
+    if isinstance(detail, str):
+        for error in ErrorsEng:
+            if detail.startswith(error.value):
+                return error.name
+    return "OTHER"
+
+
+# Sort keys for keyset pagination, the last column must be unique
+PATIENT_CURSOR_KEY = (models.Patient.id,)
+ADDRESS_CURSOR_KEY = (models.Address.id,)
+APPOINTMENT_CURSOR_KEY = (models.Appointment.start_at, models.Appointment.id)
+
+
+def paginate(
+    db_query: Query,
+    key_columns: tuple,
+    offset: int = 0,
+    limit: int = 100,
+    cursor: Union[str, None] = None,
+) -> list:
+    """
+    Orders by key_columns and pages with the cursor (keyset) when given,
+    falling back to offset for the first/legacy pages
+    """
+    if cursor:
+        try:
+            values = pagination.decode_cursor(cursor, len(key_columns))
+        except ValueError:
+            raise HTTPException(
+                400, detail=f"{ErrorsEng.INVALID_CURSOR.value}{cursor}"
+            )
+        db_query = db_query.filter(tuple_(*key_columns) > tuple_(*values))
+    elif offset:
+        db_query = db_query.offset(offset)
+    return db_query.order_by(*key_columns).limit(limit).all()
 
 
 def get_patient_by_id(db: Session, patient_id: int):
@@ -63,63 +145,367 @@ def get_patient_by_nhs_number(db: Session, nhs_number: str):
     return db_patient
 
 
-def get_patients(db: Session, query: str, offset: int = 0, limit: int = 100):
-    return db.query(models.Patient).offset(offset).limit(limit).all()
+def _cache_patient(db: Session, db_patient: models.Patient) -> dict:
+    # The version is kept for the ETag, response_model leaves it out of the body
+    patient = jsonable_encoder(schemas.Patient.from_orm(db_patient))
+    patient["version"] = db_patient.version
+    # A replica may not have caught up with a write that invalidated the
+    # patient, so only the primary fills the cache
+    if not database.is_replica(db):
+        patient_cache.set(patient)
+    return patient
 
 
-def create_patient(db: Session, patient: schemas.PatientCreate):
+def get_cached_patient(db: Session, patient_id: int) -> dict:
+    """
+    Read-through cached lookup for read-only uses, returns the patient as a
+    schemas.Patient dict rather than an ORM object
+    """
+    patient = patient_cache.get_by_id(patient_id)
+    if patient is None:
+        patient = _cache_patient(db, get_patient_by_id(db=db, patient_id=patient_id))
+    return patient
+
+
+def get_cached_patient_by_nhs_number(db: Session, nhs_number: str) -> dict:
+    patient = patient_cache.get_by_nhs_number(nhs_number)
+    if patient is None:
+        patient = _cache_patient(
+            db, get_patient_by_nhs_number(db=db, nhs_number=nhs_number)
+        )
+    return patient
+
+
+def _get_version(db: Session, model, row_id: int) -> Union[int, None]:
+    return db.scalar(select(model.version).where(model.id == row_id))
+
+
+def get_patient_version(db: Session, patient_id: int) -> Union[int, None]:
+    """Only the version, to answer conditional requests without loading the row"""
+    return _get_version(db, models.Patient, patient_id)
+
+
+def _export_columns(model, schema) -> list:
+    # Same names and order as the API responses
+    return [model.__table__.c[name] for name in schema.__fields__]
+
+
+def _list_query(db: Session, model, schema, as_dicts: bool) -> Query:
+    """
+    as_dicts selects just the response columns, for routes that encode the
+    rows directly instead of validating ORM objects through the schema
+    """
+    if as_dicts:
+        return db.query(*_export_columns(model, schema))
+    return db.query(model)
+
+
+def _list_result(rows: list, as_dicts: bool) -> list:
+    return [row._asdict() for row in rows] if as_dicts else rows
+
+
+def _as_dict(row, schema) -> dict:
+    return {name: getattr(row, name) for name in schema.__fields__}
+
+
+def _related_options(include: FrozenSet[PatientInclude]) -> list:
+    """
+    One SELECT ... WHERE ... IN (...) per relationship for the whole page,
+    rather than a lazy load per patient
+    """
+    options = []
+    if PatientInclude.ADDRESS in include:
+        options.append(selectinload(models.Patient.address))
+    if PatientInclude.APPOINTMENTS in include:
+        options.append(
+            selectinload(
+                models.Patient.appointments.and_(
+                    models.Appointment.is_cancelled.is_not(True),
+                    models.Appointment.end_at >= datetime.now(),
+                )
+            )
+        )
+    return options
+
+
+def _with_related(
+    db_patient: models.Patient, include: FrozenSet[PatientInclude]
+) -> dict:
+    """
+    A schemas.PatientWithRelations dict, with the latest address and the
+    upcoming appointments (soonest first) of the patient
+    """
+    patient = _as_dict(db_patient, schemas.Patient)
+    if PatientInclude.ADDRESS in include:
+        addresses = db_patient.address
+        patient["address"] = (
+            _as_dict(max(addresses, key=lambda address: address.id), schemas.Address)
+            if addresses
+            else None
+        )
+    if PatientInclude.APPOINTMENTS in include:
+        patient["appointments"] = [
+            _as_dict(appointment, schemas.Appointment)
+            for appointment in sorted(
+                db_patient.appointments,
+                key=lambda appointment: (appointment.start_at, appointment.id),
+            )
+        ]
+    return patient
+
+
+def get_patients(
+    db: Session,
+    query: Union[str, None],
+    offset: int = 0,
+    limit: int = 100,
+    cursor: Union[str, None] = None,
+    as_dicts: bool = False,
+    include: FrozenSet[PatientInclude] = frozenset(),
+):
+    """
+    With include, returns schemas.PatientWithRelations dicts (as_dicts is
+    implied) and runs one extra query per included relationship
+    """
+    db_query = _list_query(
+        db, models.Patient, schemas.Patient, as_dicts and not include
+    )
+    if include:
+        db_query = db_query.options(*_related_options(include))
+    if query:
+        db_query = db_query.filter(
+            search.patient_search_filter(db.get_bind().dialect.name, query)
+        )
+    rows = paginate(
+        db_query,
+        PATIENT_CURSOR_KEY,
+        offset=offset,
+        limit=limit,
+        cursor=cursor,
+    )
+    if include:
+        return [_with_related(row, include) for row in rows]
+    return _list_result(rows, as_dicts)
+
+
+def get_patient_with_related(
+    db: Session, patient_id: int, include: FrozenSet[PatientInclude]
+) -> dict:
     db_patient = (
         db.query(models.Patient)
-        .filter(models.Patient.nhs_number == patient.nhs_number)
+        .options(*_related_options(include))
+        .filter(models.Patient.id == patient_id)
         .first()
     )
-    if db_patient:
+    if not db_patient:
+        raise HTTPException(
+            status_code=403,
+            detail=f"{ErrorsEng.NO_PATIENT_FOR_ID.value}{patient_id}",
+        )
+    return _with_related(db_patient, include)
+
+
+def patients_export_query(
+    created_from: Union[datetime, None] = None,
+    created_to: Union[datetime, None] = None,
+) -> Select:
+    statement = select(*_export_columns(models.Patient, schemas.Patient))
+    if created_from:
+        statement = statement.where(models.Patient.created_at >= created_from)
+    if created_to:
+        statement = statement.where(models.Patient.created_at < created_to)
+    return statement.order_by(*PATIENT_CURSOR_KEY)
+
+
+def _is_nhs_number_conflict(error: IntegrityError) -> bool:
+    # SQLite names the column, PostgreSQL its unique index, ix_patients_nhs_number
+    return "nhs_number" in str(error.orig)
+
+
+def create_patient(db: Session, patient: schemas.PatientCreate):
+    # The unique NHS number constraint rejects duplicates, so there is no
+    # window between checking and inserting
+    try:
+        db_patient = db.scalars(
+            insert(models.Patient)
+            .values(**patient.dict())
+            .returning(models.Patient)
+        ).one()
+        db.commit()
+    except IntegrityError as error:
+        db.rollback()
+        if not _is_nhs_number_conflict(error):
+            raise
         raise HTTPException(
             403,
             detail=f"{ErrorsEng.PATIENT_ALREADY_EXISTS.value}{patient.nhs_number}",
         )
-    db_patient = models.Patient(**patient.dict())
-    db.add(db_patient)
-    db.commit()
-    db.refresh(db_patient)
     return db_patient
 
 
-def update_patient(
-    db: Session, patient_id: int, patient: schemas.PatientCreate
-):
-    db_stored_patient_by_id = get_patient_by_id(db=db, patient_id=patient_id)
-    if not db_stored_patient_by_id:
-        raise HTTPException(
-            404, detail=f"{ErrorsEng.NO_PATIENT_FOR_ID.value}'{patient_id}'"
+# Chunk INSERTs tried while other requests add patients with the same NHS numbers
+IMPORT_ATTEMPTS = 3
+
+PatientResult = Tuple[Union[int, None], Union[str, None]]
+
+
+def _existing_nhs_numbers(db: Session, nhs_numbers: List[str]) -> set:
+    return set(
+        db.scalars(
+            select(models.Patient.nhs_number).where(
+                models.Patient.nhs_number.in_(nhs_numbers)
+            )
+        )
+    )
+
+
+def _check_new_patients(
+    patients: List[schemas.PatientCreate], existing: set
+) -> Tuple[List[PatientResult], List[Tuple[int, dict]]]:
+    """
+    An error result for each patient whose NHS number is taken, or repeated
+    in the chunk. Returns the results, and (position, values) of the others.
+    """
+    results: List[PatientResult] = []
+    new_patients = []
+    for patient in patients:
+        if patient.nhs_number in existing:
+            error = f"{ErrorsEng.PATIENT_ALREADY_EXISTS.value}{patient.nhs_number}"
+            results.append((None, error))
+            continue
+        existing.add(patient.nhs_number)  # Also catches repeats within the chunk
+        new_patients.append((len(results), patient.dict()))
+        results.append((None, None))
+    return results, new_patients
+
+
+def _insert_patients(
+    db: Session, new_patients: List[Tuple[int, dict]], results: List[PatientResult]
+) -> bool:
+    """
+    Inserts the chunk with one multi-row INSERT and fills in the new ids.
+    Returns False if another request has added one of the NHS numbers since
+    they were checked.
+    """
+    try:
+        ids = db.scalars(
+            insert(models.Patient).returning(
+                models.Patient.id, sort_by_parameter_order=True
+            ),
+            [values for _, values in new_patients],
+        ).all()
+        db.commit()
+    except IntegrityError as error:
+        db.rollback()
+        if not _is_nhs_number_conflict(error):
+            raise
+        return False
+    for (position, _), patient_id in zip(new_patients, ids):
+        results[position] = (patient_id, None)
+    return True
+
+
+def create_patients(
+    db: Session, patients: List[schemas.PatientCreate]
+) -> List[PatientResult]:
+    """
+    Inserts a chunk of patients in one transaction. Duplicate NHS numbers are
+    found with a single IN (...) query and the rest are inserted with one
+    multi-row INSERT. Returns (id, error) for each patient, in order.
+    """
+    nhs_numbers = [patient.nhs_number for patient in patients]
+    for _ in range(IMPORT_ATTEMPTS):
+        existing = _existing_nhs_numbers(db, nhs_numbers)
+        results, new_patients = _check_new_patients(patients, existing)
+        if not new_patients or _insert_patients(db, new_patients, results):
+            return results
+        # Added by another request since the SELECT, check again
+
+    return [
+        (
+            None,
+            error or f"{ErrorsEng.PATIENT_IMPORT_CONFLICT.value}{patient.nhs_number}",
         )
+        for patient, (_, error) in zip(patients, results)
+    ]
+
+
+def _if_version(statement, model, versions: Union[List[int], None]):
+    if versions is not None:
+        statement = statement.where(model.version.in_(versions))
+    return statement
+
+
+def _raise_version_mismatch(row_id: int):
+    raise HTTPException(
+        412, detail=f"{ErrorsEng.VERSION_MISMATCH.value}{row_id}"
+    )
+
 
-    db_stored_patient_by_nhs_no = get_patient_by_nhs_number(
-        db=db, nhs_number=patient.nhs_number
+def update_patient(
+    db: Session,
+    patient_id: int,
+    patient: schemas.PatientCreate,
+    versions: Union[List[int], None] = None,
+):
+    """
+    versions are the row versions allowed by an If-Match header, None for
+    an unconditional update
+    """
+    values = {
+        var: value for var, value in patient if value or str(value) == "False"
+    }
+    statement = (
+        update(models.Patient)
+        .where(models.Patient.id == patient_id)
+        .values(**values, version=models.Patient.version + 1)
+        .returning(models.Patient)
     )
-    if bool(db_stored_patient_by_nhs_no.id != db_stored_patient_by_id.id):
+    try:
+        db_patient = db.scalars(
+            _if_version(statement, models.Patient, versions)
+        ).one_or_none()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(
             403,
             detail=f"{ErrorsEng.NHS_NUMBER_CONFLICT.value}'{patient.nhs_number}'",
         )
-    for var, value in patient:
-        setattr(db_stored_patient_by_id, var, value) if value or str(
-            value
-        ) == "False" else None
-    db.commit()
-    db.refresh(db_stored_patient_by_id)
-    return db_stored_patient_by_id
+    if db_patient is None:
+        if versions is not None and get_patient_version(db, patient_id) is not None:
+            _raise_version_mismatch(patient_id)
+        raise HTTPException(
+            403, detail=f"{ErrorsEng.NO_PATIENT_FOR_ID.value}{patient_id}"
+        )
+    # The NHS number key of the old number is dropped with the id entry
+    patient_cache.invalidate(patient_id, str(db_patient.nhs_number))
+    return db_patient
 
 
 def delete_patient(db: Session, patient_id: int):
     db_patient = get_patient_by_id(db=db, patient_id=patient_id)
     db.delete(db_patient)
     db.commit()
+    patient_cache.invalidate(patient_id, str(db_patient.nhs_number))
     return []
 
 
-def get_addresses(db: Session, offset: int = 0, limit: int = 100):
-    return db.query(models.Address).offset(offset).limit(limit).all()
+def get_addresses(
+    db: Session,
+    offset: int = 0,
+    limit: int = 100,
+    cursor: Union[str, None] = None,
+    as_dicts: bool = False,
+):
+    rows = paginate(
+        _list_query(db, models.Address, schemas.Address, as_dicts),
+        ADDRESS_CURSOR_KEY,
+        offset=offset,
+        limit=limit,
+        cursor=cursor,
+    )
+    return _list_result(rows, as_dicts)
 
 
 # [ ] TODO - Abstract to -> create_owner_address and use owner_type
@@ -127,31 +513,22 @@ def get_addresses(db: Session, offset: int = 0, limit: int = 100):
 def create_patient_address(
     db: Session, address: schemas.AddressCreate, patient_id: int
 ):
-    owner = (
-        db.query(models.Patient)
-        .filter(models.Patient.id == patient_id)
-        .first()
-    )
-    if not owner:
-        raise HTTPException(
-            403, detail=f"{ErrorsEng.NO_PATIENT_FOR_ID.value}'{patient_id}'"
-        )
-    db_address = models.Address(**address.dict(), owner_id=patient_id)
-    db.add(db_address)
+    # Raises if there is no patient
+    get_cached_patient(db=db, patient_id=patient_id)
+    db_address = db.scalars(
+        insert(models.Address)
+        .values(**address.dict(), owner_id=patient_id)
+        .returning(models.Address)
+    ).one()
     db.commit()
-    db.refresh(db_address)
     return db_address
 
 
 # [ ] TODO - Abstract to -> get_address_by_owner_id and use owner_type
 # Prevents a separate function to get address for department, etc
 def get_address_by_patient_id(db: Session, patient_id: int):
-    owner = get_patient_by_id(db=db, patient_id=patient_id)
-    if not owner:
-        raise HTTPException(
-            403, detail=f"{ErrorsEng.NO_PATIENT_FOR_ID.value}'{patient_id}'"
-        )
-    # [ ] TODO - use owner object above
+    # Raises if there is no patient
+    get_cached_patient(db=db, patient_id=patient_id)
     db_address = (
         db.query(models.Address)
         .filter(models.Address.owner_type == "patient")
@@ -167,6 +544,25 @@ def get_address_by_patient_id(db: Session, patient_id: int):
     return db_address
 
 
+def get_address_version_by_patient_id(
+    db: Session, patient_id: int
+) -> Union[Tuple[int, int], None]:
+    """(id, version) of the patient's latest address"""
+    row = db.execute(
+        select(models.Address.id, models.Address.version)
+        .join(models.Patient, models.Patient.id == models.Address.owner_id)
+        .where(models.Address.owner_type == "patient")
+        .where(models.Address.owner_id == patient_id)
+        .order_by(models.Address.id.desc())
+        .limit(1)
+    ).first()
+    return tuple(row) if row is not None else None
+
+
+def get_address_version(db: Session, address_id: int) -> Union[int, None]:
+    return _get_version(db, models.Address, address_id)
+
+
 def get_address_by_id(db: Session, address_id: int):
     return (
         db.query(models.Address)
@@ -175,8 +571,133 @@ def get_address_by_id(db: Session, address_id: int):
     )
 
 
-def get_appointments(db: Session, offset: int = 0, limit: int = 100):
-    return db.query(models.Appointment).offset(offset).limit(limit).all()
+def appointment_status_filter(status: AppointmentStatus, now: datetime):
+    """
+    Filters on the status column (ix_appointments_status_end). Scheduled
+    appointments that have ended but not been swept yet count as missed.
+    """
+    status_column, end_at = models.Appointment.status, models.Appointment.end_at
+    scheduled = AppointmentStatus.SCHEDULED.value
+    if status == AppointmentStatus.SCHEDULED:
+        return and_(status_column == scheduled, end_at >= now)
+    if status == AppointmentStatus.MISSED:
+        return or_(
+            status_column == AppointmentStatus.MISSED.value,
+            and_(status_column == scheduled, end_at < now),
+        )
+    return status_column == status.value
+
+
+def _filter_appointments(
+    statement,
+    start_from: Union[datetime, None] = None,
+    start_to: Union[datetime, None] = None,
+    patient_id: Union[int, None] = None,
+    status: Union[AppointmentStatus, None] = None,
+):
+    """
+    Appointments starting in [start_from, start_to), filters for a Query or a
+    Select. Ranges use ix_appointments_start_at, or with a patient_id
+    ix_appointments_patient_interval, both in start_at order.
+    """
+    if patient_id is not None:
+        statement = statement.where(models.Appointment.patient_id == patient_id)
+    if start_from:
+        statement = statement.where(models.Appointment.start_at >= start_from)
+    if start_to:
+        statement = statement.where(models.Appointment.start_at < start_to)
+    if status:
+        statement = statement.where(appointment_status_filter(status, datetime.now()))
+    return statement
+
+
+def get_appointments(
+    db: Session,
+    offset: int = 0,
+    limit: int = 100,
+    cursor: Union[str, None] = None,
+    as_dicts: bool = False,
+    start_from: Union[datetime, None] = None,
+    start_to: Union[datetime, None] = None,
+    patient_id: Union[int, None] = None,
+    status: Union[AppointmentStatus, None] = None,
+):  # pylint: disable=too-many-arguments
+    db_query = _filter_appointments(
+        _list_query(db, models.Appointment, schemas.Appointment, as_dicts),
+        start_from=start_from,
+        start_to=start_to,
+        patient_id=patient_id,
+        status=status,
+    )
+    rows = paginate(
+        db_query,
+        APPOINTMENT_CURSOR_KEY,
+        offset=offset,
+        limit=limit,
+        cursor=cursor,
+    )
+    return _list_result(rows, as_dicts)
+
+
+def get_patient_appointments(db: Session, patient_id: int, **filters):
+    """get_appointments for one patient, which must exist"""
+    get_cached_patient(db=db, patient_id=patient_id)
+    return get_appointments(db=db, patient_id=patient_id, **filters)
+
+
+def appointments_export_query(
+    start_from: Union[datetime, None] = None,
+    start_to: Union[datetime, None] = None,
+) -> Select:
+    statement = select(*_export_columns(models.Appointment, schemas.Appointment))
+    statement = _filter_appointments(
+        statement, start_from=start_from, start_to=start_to
+    )
+    return statement.order_by(*APPOINTMENT_CURSOR_KEY)
+
+
+def get_appointment_conflicts(
+    db: Session, start_from: datetime, start_to: datetime
+) -> List[dict]:
+    """
+    Every pair of overlapping, not cancelled, appointments of the same
+    patient, both starting in [start_from, start_to).
+
+    A sweep line over the appointments in start order (the start_at index):
+    a heap of end times drops appointments once they have ended, so each new
+    appointment is only compared with its patient's appointments still
+    running, O(n log n + conflicts) rather than comparing every pair.
+    """
+    rows = db.execute(
+        select(
+            models.Appointment.id,
+            models.Appointment.patient_id,
+            models.Appointment.start_at,
+            models.Appointment.end_at,
+        )
+        .where(models.Appointment.start_at >= start_from)
+        .where(models.Appointment.start_at < start_to)
+        .where(models.Appointment.status != AppointmentStatus.CANCELLED.value)
+        .order_by(*APPOINTMENT_CURSOR_KEY)
+    )
+    ending: list = []  # Heap of (end_at, id, patient_id)
+    running: dict = defaultdict(dict)  # patient_id -> {id: row}
+    conflicts = []
+    for row in rows:
+        while ending and ending[0][0] <= row.start_at:
+            _, ended_id, patient_id = heapq.heappop(ending)
+            running[patient_id].pop(ended_id, None)
+        for other in running[row.patient_id].values():
+            conflicts.append({
+                "patient_id": row.patient_id,
+                "appointment_id": other.id,
+                "other_appointment_id": row.id,
+                "overlap_start": row.start_at,
+                "overlap_end": min(other.end_at, row.end_at),
+            })
+        running[row.patient_id][row.id] = row
+        heapq.heappush(ending, (row.end_at, row.id, row.patient_id))
+    return conflicts
 
 
 def get_appointment_by_id(db: Session, appointment_id):
@@ -193,108 +714,517 @@ def get_appointment_by_id(db: Session, appointment_id):
     return db_stored_appointment
 
 
-def create_appointment(db: Session, appointment: schemas.AppointmentCreate):
-    db_patient = get_patient_by_id(db=db, patient_id=appointment.patient_id)
-    if not db_patient:
+def get_appointment_version(db: Session, appointment_id: int) -> Union[int, None]:
+    return _get_version(db, models.Appointment, appointment_id)
+
+
+def _overlapping(
+    patient_id: int,
+    start_at: datetime,
+    end_at: datetime,
+    exclude_id: Union[int, None] = None,
+) -> Select:
+    """
+    The patient's other bookings overlapping [start_at, end_at), back to back
+    appointments don't overlap. A range read of ix_appointments_patient_interval.
+    """
+    statement = (
+        select(models.Appointment.id)
+        .where(models.Appointment.patient_id == patient_id)
+        .where(models.Appointment.start_at < end_at)
+        .where(models.Appointment.end_at > start_at)
+        .where(models.Appointment.status != AppointmentStatus.CANCELLED.value)
+    )
+    if exclude_id is not None:
+        statement = statement.where(models.Appointment.id != exclude_id)
+    return statement
+
+
+def _raise_for_overlap(
+    db: Session,
+    appointment: schemas.AppointmentCreate,
+    exclude_id: Union[int, None] = None,
+):
+    """Raises with the id of a booking the appointment would overlap, if any"""
+    conflict_id = db.scalar(
+        _overlapping(
+            appointment.patient_id, appointment.start_at, appointment.end_at, exclude_id
+        ).limit(1)
+    )
+    if conflict_id is not None:
         raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.NO_PATIENT_FOR_ID.value}{appointment.patient_id}",
+            status_code=403, detail=f"{ErrorsEng.APPT_OVERLAP.value}{conflict_id}"
         )
-    appointment = models.Appointment(**appointment.dict())
-    db.add(appointment)
-    db.commit()
-    db.refresh(appointment)
-    return appointment
 
 
-def update_appointment(
-    db: Session, appointment_id: int, appointment: schemas.AppointmentCreate
+def _raise_for_appointment(
+    db: Session,
+    appointment_id: int,
+    guards: Sequence[Tuple[Callable[[models.Appointment], bool], ErrorsEng]],
+    versions: Union[List[int], None] = None,
+    overlap: Union[schemas.AppointmentCreate, None] = None,
 ):
-    # Guard against non existent appointment
+    """
+    Called when a conditional appointment UPDATE matched no row, to report
+    why. Raises for a missing appointment, for the first guard that fails,
+    or if the overlap values would double book the patient.
+    """
+    db.rollback()  # Release the write lock taken by the UPDATE
     db_stored_appointment = get_appointment_by_id(
         db=db, appointment_id=appointment_id
     )
-    if bool(db_stored_appointment.is_cancelled):
-        raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.CANNOT_EDIT_CANCELLED_APPT.value}{appointment_id}",
-        )
+    if versions is not None and db_stored_appointment.version not in versions:
+        _raise_version_mismatch(appointment_id)
+    for is_blocked, error in guards:
+        if is_blocked(db_stored_appointment):
+            raise HTTPException(
+                status_code=403, detail=f"{error.value}{appointment_id}"
+            )
+    if overlap is not None:
+        _raise_for_overlap(db, overlap, exclude_id=appointment_id)
+    # The appointment changed state between the UPDATE and this read
+    raise HTTPException(
+        status_code=403,
+        detail=f"{ErrorsEng.NO_APPT_FOR_ID.value}{appointment_id}",
+    )
 
-    # Guard against non-existent patient
-    db_stored_appointment_patient = get_patient_by_id(
-        patient_id=appointment.patient_id, db=db
+
+def _is_cancelled(appointment: models.Appointment) -> bool:
+    return bool(appointment.is_cancelled)
+
+
+def _is_attended(appointment: models.Appointment) -> bool:
+    return bool(appointment.attended_at)
+
+
+def _is_past_end(appointment: models.Appointment) -> bool:
+    return bool(datetime.now() > appointment.end_at)
+
+
+def _lock_patient(db: Session, patient_id: int):
+    """
+    Locks the patient row until the transaction ends, so bookings for one
+    patient are checked for overlaps one at a time. Under READ COMMITTED two
+    NOT EXISTS checks could otherwise both miss the other's new row. SQLite
+    has no FOR UPDATE, but its single writer serialises the bookings anyway,
+    so it skips the round trip.
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        return
+    db.execute(
+        select(models.Patient.id)
+        .where(models.Patient.id == patient_id)
+        .with_for_update()
     )
-    if not db_stored_appointment_patient:
-        raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.NO_PATIENT_FOR_ID.value}{appointment.patient_id}",
+
+
+# INSERTs tried while overlapping bookings are being cancelled under them
+BOOKING_ATTEMPTS = 3
+
+
+def create_appointment(db: Session, appointment: schemas.AppointmentCreate):
+    # Raises if there is no patient
+    get_cached_patient(db=db, patient_id=appointment.patient_id)
+    # INSERT ... SELECT ... WHERE NOT EXISTS, checking for a double booking in
+    # the same statement, with the patient locked by _lock_patient first
+    values = appointment.dict()
+    columns = models.Appointment.__table__.c
+    statement = (
+        insert(models.Appointment)
+        .from_select(
+            list(values),
+            select(
+                *[literal(value, columns[name].type) for name, value in values.items()]
+            ).where(~exists(_overlapping(**values))),
         )
+        .returning(models.Appointment)
+    )
+    for _ in range(BOOKING_ATTEMPTS):
+        _lock_patient(db, appointment.patient_id)
+        db_appointment = db.scalars(statement).one_or_none()
+        if db_appointment is not None:
+            stats.created(db, db_appointment.start_at)
+            db.commit()
+            return db_appointment
+        db.rollback()
+        _raise_for_overlap(db, appointment)
+        # The booking it overlapped has just been cancelled, try again
+    raise HTTPException(
+        status_code=409,
+        detail=f"{ErrorsEng.APPT_BOOKING_CONFLICT.value}{appointment.patient_id}",
+    )
+
 
-    # Guard against appointment already attended
-    if bool(db_stored_appointment.attended_at):
+def update_appointment(
+    db: Session,
+    appointment_id: int,
+    appointment: schemas.AppointmentCreate,
+    versions: Union[List[int], None] = None,
+):
+    # Guard against non-existent patient
+    get_cached_patient(db=db, patient_id=appointment.patient_id)
+    # Held until the commit, so the overlap check below can't race a booking
+    _lock_patient(db, appointment.patient_id)
+
+    # The stats rollup needs the day and status the appointment moves from,
+    # the UPDATE only applies if the row is still at the version read here
+    current = db.execute(
+        select(
+            models.Appointment.start_at,
+            models.Appointment.status,
+            models.Appointment.version,
+        ).where(models.Appointment.id == appointment_id)
+    ).one_or_none()
+    if current is None:
         raise HTTPException(
             status_code=403,
-            detail=f"{ErrorsEng.APPT_ALREADY_ATTENDED.value}{appointment_id}",
+            detail=f"{ErrorsEng.NO_APPT_FOR_ID.value}{appointment_id}",
         )
+    if versions is not None and current.version not in versions:
+        _raise_version_mismatch(appointment_id)
 
-    for var, value in appointment:
-        setattr(db_stored_appointment, var, value) if value or str(
-            value
-        ) == "False" else None
+    # Only open (not cancelled or attended) appointments can be edited
+    values = {
+        var: value for var, value in appointment if value or str(value) == "False"
+    }
+    db_appointment = db.scalars(
+        update(models.Appointment)
+        .where(models.Appointment.id == appointment_id)
+        .where(models.Appointment.is_cancelled.is_not(True))
+        .where(models.Appointment.attended_at.is_(None))
+        .where(models.Appointment.version == current.version)
+        .where(~exists(_overlapping(exclude_id=appointment_id, **appointment.dict())))
+        # Rescheduling a missed appointment makes it scheduled again
+        .values(
+            **values,
+            status=AppointmentStatus.SCHEDULED.value,
+            version=models.Appointment.version + 1,
+        )
+        .returning(models.Appointment)
+    ).one_or_none()
+    if db_appointment is None:
+        _raise_for_appointment(db, appointment_id, [
+            (_is_cancelled, ErrorsEng.CANNOT_EDIT_CANCELLED_APPT),
+            (_is_attended, ErrorsEng.APPT_ALREADY_ATTENDED),
+        ], versions=versions, overlap=appointment)
+    stats.rescheduled(db, current.start_at, current.status, db_appointment.start_at)
     db.commit()
-    db.refresh(db_stored_appointment)
-    return db_stored_appointment
+    return db_appointment
 
 
-def cancel_appointment(db: Session, appointment_id: int):
-    # Guard against cancelled appointment
-    db_stored_appointment = get_appointment_by_id(
-        db=db, appointment_id=appointment_id
-    )
-    if bool(db_stored_appointment.attended_at):
-        raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.APPT_ALREADY_ATTENDED.value}{appointment_id}",
+# Why an appointment can't be cancelled or attended, checked in order
+CANCEL_GUARDS = [
+    (_is_attended, ErrorsEng.APPT_ALREADY_ATTENDED),
+    (_is_cancelled, ErrorsEng.APPT_ALREADY_CANCELLED),
+]
+ATTEND_GUARDS = [
+    (_is_cancelled, ErrorsEng.CANNOT_MARK_CANCELLED_APPT_ATTENDED),
+    (_is_past_end, ErrorsEng.CANNOT_MARK_APPT_ATTENDED_PAST_END),
+    (_is_attended, ErrorsEng.APPT_MARKED_AS_ATTENDED),
+]
+# Open appointments are scheduled, or missed if they have ended. Matching on
+# the status tells the stats rollup which count to move the row from
+CANCELLABLE = (AppointmentStatus.SCHEDULED, AppointmentStatus.MISSED)
+# Not missed either, that needs end_at to have passed
+ATTENDABLE = (AppointmentStatus.SCHEDULED,)
+
+
+def _cancel_values() -> dict:
+    return {
+        "is_cancelled": True,
+        "cancelled_at": datetime.utcnow(),
+        "status": AppointmentStatus.CANCELLED.value,
+        "version": models.Appointment.version + 1,
+    }
+
+
+def _attend_values() -> dict:
+    return {
+        "attended_at": datetime.utcnow(),
+        "status": AppointmentStatus.ATTENDED.value,
+        "version": models.Appointment.version + 1,
+    }
+
+
+def _attend_conditions() -> list:
+    # Should we allow this? Disallows running early
+    # models.Appointment.start_at <= datetime.now()
+    return [models.Appointment.end_at >= datetime.now()]
+
+
+def _transition(
+    ids: List[int],
+    from_statuses: Tuple[AppointmentStatus, ...],
+    conditions: list,
+    values: dict,
+    columns: list,
+):
+    """
+    One UPDATE of the appointments in from_statuses, RETURNING columns and
+    each one's previous_status, for the stats rollup. The previous statuses
+    are read by a materialized CTE, which runs before the UPDATE (and locks
+    the rows on PostgreSQL), RETURNING on the table itself has the new ones.
+    """
+    previous = (
+        select(
+            models.Appointment.id.label("previous_id"),
+            models.Appointment.status.label("previous_status"),
         )
-    if bool(db_stored_appointment.is_cancelled):
-        raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.APPT_ALREADY_CANCELLED.value}{appointment_id}",
+        .where(models.Appointment.id.in_(ids))
+        .where(
+            models.Appointment.status.in_([status.value for status in from_statuses])
         )
+        .where(*conditions)
+        .with_for_update()
+        .cte("previous")
+        .prefix_with("MATERIALIZED")
+    )
+    appointments = models.Appointment.__table__
+    # Distinct column names, SQLite's RETURNING drops the table names
+    previous_status = (
+        select(previous.c.previous_status)
+        .where(previous.c.previous_id == appointments.c.id)
+        .scalar_subquery()
+        .label("previous_status")
+    )
+    return (
+        update(appointments)
+        .where(appointments.c.id.in_(select(previous.c.previous_id)))
+        .values(**values)
+        .returning(*columns, previous_status)
+    )
+
 
-    setattr(db_stored_appointment, "is_cancelled", True)
-    setattr(db_stored_appointment, "cancelled_at", datetime.utcnow())
+def cancel_appointment(db: Session, appointment_id: int):
+    statement = _transition(
+        [appointment_id],
+        CANCELLABLE,
+        [],
+        _cancel_values(),
+        list(models.Appointment.__table__.columns),
+    )
+    # The ORM can't return a column besides the entity from an UPDATE itself
+    row = db.execute(
+        select(models.Appointment, column("previous_status"))
+        .from_statement(statement)
+        .execution_options(populate_existing=True)
+    ).one_or_none()
+    if row is None:
+        _raise_for_appointment(db, appointment_id, CANCEL_GUARDS)
+    db_appointment, previous_status = row
+    stats.transitions(
+        db, [(db_appointment.start_at, previous_status, db_appointment.status)]
+    )
     db.commit()
-    db.refresh(db_stored_appointment)
-    return db_stored_appointment
+    return db_appointment
 
 
 def mark_appointment_attended(db: Session, appointment_id: int):
-    # Guard against cancelled appointment
-    db_stored_appointment = get_appointment_by_id(
-        db=db, appointment_id=appointment_id
+    db_appointment = db.scalars(
+        update(models.Appointment)
+        .where(models.Appointment.id == appointment_id)
+        .where(models.Appointment.status.in_([status.value for status in ATTENDABLE]))
+        .where(*_attend_conditions())
+        .values(**_attend_values())
+        .returning(models.Appointment)
+    ).one_or_none()
+    if db_appointment is None:
+        _raise_for_appointment(db, appointment_id, ATTEND_GUARDS)
+    stats.transitions(
+        db,
+        [
+            (
+                db_appointment.start_at,
+                AppointmentStatus.SCHEDULED.value,
+                db_appointment.status,
+            )
+        ],
     )
-    if bool(db_stored_appointment.is_cancelled):
-        raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.CANNOT_MARK_CANCELLED_APPT_ATTENDED.value}{appointment_id}",
-        )
-    if bool(datetime.now() > db_stored_appointment.end_at):
+    db.commit()
+    return db_appointment
+
+
+# (id, new status, error), the status is None when the transition was refused
+BulkOutcome = Tuple[int, Union[str, None], Union[str, None]]
+
+
+def _select_appointment_ids(
+    db: Session,
+    ids: Union[List[int], None] = None,
+    start_from: Union[datetime, None] = None,
+    start_to: Union[datetime, None] = None,
+    patient_id: Union[int, None] = None,
+) -> List[int]:
+    if ids is not None:
+        return list(dict.fromkeys(ids))  # Drops repeats, keeps the order
+    return list(db.scalars(
+        _filter_appointments(
+            select(models.Appointment.id),
+            start_from=start_from,
+            start_to=start_to,
+            patient_id=patient_id,
+        ).order_by(*APPOINTMENT_CURSOR_KEY)
+    ))
+
+
+def _bulk_transition(
+    db: Session,
+    ids: List[int],
+    from_statuses: Tuple[AppointmentStatus, ...],
+    conditions: list,
+    values: dict,
+    guards: Sequence[Tuple[Callable[[models.Appointment], bool], ErrorsEng]],
+) -> List[BulkOutcome]:
+    """
+    Applies values to the appointments with one conditional UPDATE, and their
+    stats, in one transaction. The rows that weren't updated are then loaded
+    with one SELECT, to report the first guard each fails.
+    """
+    if not ids:
+        return []
+    new_status: dict = {}
+    changes = []
+    for row in db.execute(_transition(ids, from_statuses, conditions, values, [
+        models.Appointment.id,
+        models.Appointment.start_at,
+        models.Appointment.status,
+    ])):
+        new_status[row.id] = row.status
+        changes.append((row.start_at, row.previous_status, row.status))
+    stats.transitions(db, changes)
+    db.commit()
+
+    errors = {}
+    refused = [
+        appointment_id for appointment_id in ids if appointment_id not in new_status
+    ]
+    if refused:
+        for appointment in db.scalars(
+            select(models.Appointment).where(models.Appointment.id.in_(refused))
+        ):
+            # Falls back to not found if it changed since the UPDATE, like the
+            # single routes
+            error = next(
+                (error for is_blocked, error in guards if is_blocked(appointment)),
+                ErrorsEng.NO_APPT_FOR_ID,
+            )
+            errors[appointment.id] = f"{error.value}{appointment.id}"
+    outcomes: List[BulkOutcome] = []
+    for appointment_id in ids:
+        if appointment_id in new_status:
+            outcomes.append((appointment_id, new_status[appointment_id], None))
+        else:
+            missing = f"{ErrorsEng.NO_APPT_FOR_ID.value}{appointment_id}"
+            outcomes.append((appointment_id, None, errors.get(appointment_id, missing)))
+    return outcomes
+
+
+def bulk_cancel_appointments(db: Session, **selection) -> List[BulkOutcome]:
+    """
+    Cancels the appointments selected by ids, or by start_from, start_to and
+    patient_id, see _select_appointment_ids
+    """
+    return _bulk_transition(
+        db,
+        _select_appointment_ids(db, **selection),
+        CANCELLABLE,
+        [],
+        _cancel_values(),
+        CANCEL_GUARDS,
+    )
+
+
+def bulk_mark_appointments_attended(db: Session, **selection) -> List[BulkOutcome]:
+    return _bulk_transition(
+        db,
+        _select_appointment_ids(db, **selection),
+        ATTENDABLE,
+        _attend_conditions(),
+        _attend_values(),
+        ATTEND_GUARDS,
+    )
+
+
+# A year of days, or 53 weeks
+MAX_STATS_DAYS = 366
+
+
+def _rate(count: int, out_of: int) -> Union[float, None]:
+    return round(count / out_of, 4) if out_of else None
+
+
+def get_appointment_stats(
+    db: Session, date_from: date, date_to: date, period: StatsPeriod = StatsPeriod.DAY
+) -> List[dict]:
+    """
+    Appointment counts and rates per day or week for appointments starting
+    in [date_from, date_to], read from the daily rollup. Periods without
+    appointments are left out.
+    """
+    if (date_to - date_from).days >= MAX_STATS_DAYS:
         raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.CANNOT_MARK_APPT_ATTENDED_PAST_END.value}{appointment_id}",
+            400, detail=f"{ErrorsEng.STATS_RANGE_TOO_LONG.value}{date_from}"
         )
-    if bool(db_stored_appointment.attended_at):
-        raise HTTPException(
-            status_code=403,
-            detail=f"{ErrorsEng.APPT_MARKED_AS_ATTENDED.value}{appointment_id}",
+    rows = db.scalars(
+        select(models.AppointmentDailyStats)
+        .where(models.AppointmentDailyStats.day >= date_from)
+        .where(models.AppointmentDailyStats.day <= date_to)
+        .order_by(models.AppointmentDailyStats.day)
+    ).all()
+    periods: dict = {}
+    for row in rows:
+        start = row.day
+        if period == StatsPeriod.WEEK:
+            start = row.day - timedelta(days=row.day.weekday())
+        counts = periods.setdefault(start, dict.fromkeys(stats.COUNT_COLUMNS, 0))
+        for name in stats.COUNT_COLUMNS:
+            counts[name] += getattr(row, name)
+    return [
+        {
+            "period_start": start,
+            **counts,
+            # Of the appointments that went ahead, i.e. were not cancelled
+            # and have ended (or been attended)
+            "attendance_rate": _rate(
+                counts["attended"], counts["attended"] + counts["missed"]
+            ),
+            "dna_rate": _rate(counts["missed"], counts["attended"] + counts["missed"]),
+            "cancellation_rate": _rate(counts["cancelled"], counts["total"]),
+        }
+        for start, counts in periods.items()
+    ]
+
+
+def mark_missed_appointments(db: Session, now: datetime, limit: int) -> int:
+    """
+    Marks up to limit scheduled appointments that ended before now as missed,
+    in one transaction with their stats. Returns how many were marked, less
+    than limit once there are none left.
+    """
+    overdue = (
+        select(models.Appointment.id)
+        .where(models.Appointment.status == AppointmentStatus.SCHEDULED.value)
+        .where(models.Appointment.end_at < now)
+        .limit(limit)
+        .scalar_subquery()
+    )
+    start_times = db.scalars(
+        update(models.Appointment)
+        .where(models.Appointment.id.in_(overdue))
+        # Checked again, a cancel or another sweeper may change the row after
+        # the subquery read it (READ COMMITTED)
+        .where(models.Appointment.status == AppointmentStatus.SCHEDULED.value)
+        .where(models.Appointment.end_at < now)
+        .values(
+            status=AppointmentStatus.MISSED.value,
+            version=models.Appointment.version + 1,
         )
-    # Should we allow this? Disallows running early
-    # if datetime.now() < db_stored_appointment.start_at:
-    #     raise HTTPException(
-    #         status_code=403, detail="Cannot mark an appointment as attended before the start time"
-    #     )
-    setattr(db_stored_appointment, "attended_at", datetime.utcnow())
+        .returning(models.Appointment.start_at)
+        .execution_options(synchronize_session=False)
+    ).all()
+    stats.transitions(db, [
+        (start_at, AppointmentStatus.SCHEDULED.value, AppointmentStatus.MISSED.value)
+        for start_at in start_times
+    ])
     db.commit()
-    db.refresh(db_stored_appointment)
-    return db_stored_appointment
+    return len(start_times)
@@ -20,3 +20,29 @@ class Sex(ExtendedEnum):
 class AddressOwnerType(ExtendedEnum):
     PATIENT = "patient"
     #LOCATION = "location"
+
+
+@unique
+class ExportFormat(ExtendedEnum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+@unique
+class PatientInclude(ExtendedEnum):
+    ADDRESS = "address"
+    APPOINTMENTS = "appointments"
+
+
+@unique
+class AppointmentStatus(ExtendedEnum):
+    SCHEDULED = "scheduled"
+    ATTENDED = "attended"
+    CANCELLED = "cancelled"
+    MISSED = "missed"  # Ended without being attended or cancelled
+
+
+@unique
+class StatsPeriod(ExtendedEnum):
+    DAY = "day"
+    WEEK = "week"  # Monday to Sunday
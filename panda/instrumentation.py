@@ -0,0 +1,146 @@
+"""Per-request database statistics and statement metrics, collected from
+SQLAlchemy engine events.
+
+The access log middleware starts a RequestStats for each request and every
+statement run while handling it, on any engine and from the threadpool or
+the async driver, adds its time to it. QueryBudgetMiddleware uses the same
+stats to flag routes that run too many statements, or the same one over and
+over (an N+1 from a lazy relationship).
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from sqlalchemy import Engine, event
+
+from panda import metrics
+
+
+class RequestStats:
+    __slots__ = ("statements", "db_time", "shapes")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0  # Seconds
+        # Statement text (with placeholders, not values) -> times run
+        self.shapes: "Counter[str]" = Counter()
+
+    def repeated(self, threshold: int) -> Dict[str, int]:
+        """Statements run at least threshold times, the signature of an N+1"""
+        return {
+            shape: count for shape, count in self.shapes.items() if count >= threshold
+        }
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# The stats object is shared, not the variable: threadpool calls run in a copy
+# of the request's context, so they update the same RequestStats
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    "request_stats", default=None
+)
+
+
+def start_request() -> RequestStats:
+    stats = RequestStats()
+    _request_stats.set(stats)
+    return stats
+
+
+def current_request() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+@contextmanager
+def track_statements() -> Iterator[RequestStats]:
+    """Counts the statements run inside the block, e.g. in tests"""
+    stats = RequestStats()
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+# pylint: disable-next=unused-argument,too-many-arguments
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+# pylint: disable-next=unused-argument,too-many-arguments
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    metrics.observe_statement(statement, elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+        stats.shapes[statement] += 1
+
+
+class QueryBudgetMiddleware:
+    """
+    ASGI middleware, checks the statements of each request against the
+    budget of its route (budgets are keyed by "METHOD /route/{template}" or
+    just the template) and for statements repeated n_plus_one_threshold times.
+    In "log" mode problems are logged as warnings, in "raise" mode (for
+    tests) QueryBudgetExceeded is raised once the response has been sent.
+    """
+
+    def __init__(
+        self,
+        app,
+        budget: int,
+        budgets: Dict[str, int],
+        n_plus_one_threshold: int,
+        mode: str = "log",
+        logger: Optional[logging.Logger] = None,
+    ):  # pylint: disable=too-many-arguments
+        self.app = app
+        self.budget = budget
+        self.budgets = budgets
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.mode = mode
+        self.logger = logger or logging.getLogger(__name__)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # Shares the access log's stats when it runs outside this middleware
+        stats = current_request()
+        if stats is None:
+            with track_statements() as stats:
+                await self.app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+        self.check(scope, stats)
+
+    def check(self, scope, stats: RequestStats) -> None:
+        route = getattr(scope.get("route"), "path", None)
+        if route is None:
+            return
+        name = f"{scope['method']} {route}"
+        budget = self.budgets.get(name, self.budgets.get(route, self.budget))
+        problems = []
+        if stats.statements > budget:
+            problems.append(
+                f"{stats.statements} statements, over the budget of {budget}"
+            )
+        problems.extend(
+            f"{count} x {' '.join(shape.split())}"
+            for shape, count in stats.repeated(self.n_plus_one_threshold).items()
+        )
+        if not problems:
+            return
+        message = f"Query budget for {name}: " + "; ".join(problems)
+        if self.mode == "raise":
+            raise QueryBudgetExceeded(message)
+        self.logger.warning(message)
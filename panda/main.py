@@ -2,34 +2,65 @@ import logging
 import os
 
 from fastapi import FastAPI, Request
+from fastapi.exception_handlers import http_exception_handler
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+)
+from sqlalchemy import make_url
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from panda import models
+from panda import crud, database, instrumentation, metrics, migrations, sweeper
+from panda.cache import patient_cache
 from panda.core.config import settings
-from panda.database import engine
+from panda.database import SessionLocal, async_engine, describe_engine, engine
 from panda.routers import address_router, appointments_router, patients_router
+from panda.util import access_log
+from panda.util.pagination import NEXT_CURSOR_HEADER
+
+# Log handlers run on listener threads, so requests don't block on disk
+log_listeners = []
 
 LOGGING = os.getenv('ENABLE_LOGGING', None)
 if LOGGING == "true":
-    logging.basicConfig(
-        filename='app.log',
-        filemode='w',
-        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+    log_file = logging.FileHandler('app.log')
+    log_file.setFormatter(logging.Formatter(
+        fmt='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
         datefmt='%H:%M:%S',
-        level=logging.DEBUG
-    )
+    ))
+    logging.getLogger().setLevel(logging.DEBUG)
+    log_listeners.append(access_log.queue_logging(logging.getLogger(), log_file))
 else:
     logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger()
 
-models.Base.metadata.create_all(bind=engine)
+access_logger = logging.getLogger("panda.access")
+if settings.ACCESS_LOG:
+    access_handler = (
+        logging.FileHandler(settings.ACCESS_LOG_FILE)
+        if settings.ACCESS_LOG_FILE
+        else logging.StreamHandler()
+    )
+    access_handler.setFormatter(access_log.JsonFormatter())
+    access_logger.setLevel(logging.INFO)
+    access_logger.propagate = False
+    log_listeners.append(access_log.queue_logging(access_logger, access_handler))
+else:
+    access_logger.disabled = True
+
+migrations.upgrade(engine)
 
 app = FastAPI()
 
 
 def get_application():
-    _app = FastAPI(title=settings.PROJECT_NAME)
+    _app = FastAPI(
+        title=settings.PROJECT_NAME,
+        default_response_class=ORJSONResponse if settings.FAST_JSON else JSONResponse,
+    )
 
     _app.add_middleware(
         CORSMiddleware,
@@ -38,6 +69,24 @@ def get_application():
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=[NEXT_CURSOR_HEADER, "ETag"],
+    )
+    _app.add_middleware(
+        instrumentation.QueryBudgetMiddleware,
+        budget=settings.QUERY_BUDGET,
+        budgets=settings.QUERY_BUDGETS,
+        n_plus_one_threshold=settings.N_PLUS_ONE_THRESHOLD,
+        mode=settings.QUERY_BUDGET_MODE,
+    )
+    _app.add_middleware(metrics.MetricsMiddleware)
+    if database.replica_pool is not None:
+        _app.add_middleware(
+            database.ReadYourWritesMiddleware, window=settings.READ_YOUR_WRITES_SECONDS
+        )
+    _app.add_middleware(
+        access_log.AccessLogMiddleware,
+        logger=access_logger,
+        sample_rate=settings.ACCESS_LOG_SAMPLE_RATE,
     )
     _app.include_router(address_router.router)
     _app.include_router(patients_router.router)
@@ -50,13 +99,105 @@ app = get_application()
 logging.info('Running...')
 
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    response = await call_next(request)
-    logger.info(f"{request.method} request to {request.url}\n"
-                f"\tStatus_code: {response.status_code}\n"
-                f"\tRequest_Body: {request.body()}\n")  # [ ] TODO get body and params
-    return response
+# The pool that serves requests, only queue pools count checkouts
+request_pool = (async_engine.sync_engine if async_engine is not None else engine).pool
+pool_checked_out = getattr(request_pool, "checkedout", lambda: 0)
+# Summed over the workers with METRICS_DIR, like the counters
+metrics.registry.collectors.update({
+    "panda_db_pool_checked_out": pool_checked_out,
+    "panda_patient_cache_hits_total": lambda: patient_cache.stats()["hits"],
+    "panda_patient_cache_misses_total": lambda: patient_cache.stats()["misses"],
+    "panda_patient_cache_evictions_total": lambda: patient_cache.stats()["evictions"],
+    "panda_patient_cache_size": lambda: patient_cache.stats()["size"],
+})
+metrics_writer = (
+    metrics.SnapshotWriter(settings.METRICS_FLUSH_INTERVAL)
+    if settings.METRICS_DIR
+    else None
+)
+
+missed_sweeper = (
+    sweeper.MissedAppointmentSweeper(
+        SessionLocal, settings.MISSED_SWEEP_INTERVAL, settings.MISSED_SWEEP_CHUNK_SIZE
+    )
+    if settings.MISSED_SWEEP_INTERVAL > 0
+    else None
+)
+
+
+@app.exception_handler(StarletteHTTPException)
+async def count_http_exceptions(request: Request, exc: StarletteHTTPException):
+    metrics.count_http_exception(exc.status_code, crud.error_code(exc.detail))
+    return await http_exception_handler(request, exc)
+
+
+@app.on_event("startup")
+def start_log_listeners():
+    for listener in log_listeners:
+        listener.start()
+
+
+@app.on_event("shutdown")
+def stop_log_listeners():
+    # Flushes the queued records
+    for listener in log_listeners:
+        listener.stop()
+
+
+@app.on_event("startup")
+def start_metrics_writer():
+    if metrics_writer is not None:
+        metrics_writer.start()
+
+
+@app.on_event("shutdown")
+def stop_metrics_writer():
+    if metrics_writer is not None:
+        metrics_writer.stop()
+
+
+@app.on_event("startup")
+def start_missed_sweeper():
+    if missed_sweeper is not None:
+        missed_sweeper.start()
+
+
+@app.on_event("shutdown")
+def stop_missed_sweeper():
+    if missed_sweeper is not None:
+        missed_sweeper.stop()
+
+
+@app.on_event("startup")
+async def report_database_settings():
+    # Logged at WARNING so it shows with the default logging level
+    logger.warning("Database engine: %s", describe_engine(engine))
+    if async_engine is not None:
+        async with async_engine.connect() as connection:
+            report = await connection.run_sync(
+                lambda sync_connection: describe_engine(
+                    async_engine.sync_engine, sync_connection
+                )
+            )
+        logger.warning("Async database engine: %s", report)
+    if database.replica_pool is not None:
+        logger.warning(
+            "Read replicas: %s",
+            [
+                make_url(url).render_as_string(hide_password=True)
+                for url in settings.SQLALCHEMY_REPLICA_URLS
+            ],
+        )
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats", include_in_schema=False)
+async def cache_stats():
+    return patient_cache.stats()
 
 
 @app.get("/", include_in_schema=False)
@@ -0,0 +1,330 @@
+"""Prometheus metrics, served in the text exposition format at /metrics.
+
+Counters and histograms are kept in plain dicts behind a lock, so recording
+a request or a statement costs a few microseconds and needs no client library.
+
+With several uvicorn/gunicorn workers, set METRICS_DIR to a directory shared
+by them. Each worker writes a snapshot of its metrics to <pid>.json every
+METRICS_FLUSH_INTERVAL seconds, and a scrape of any worker adds up its own
+live metrics and the other workers' snapshots. Clear the directory when
+deploying, counters of workers that have exited are kept until then.
+"""
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, TypedDict
+
+from panda.core.config import settings
+
+Labels = Tuple[str, ...]
+
+# Seconds, upper bounds of the histogram buckets (Prometheus' defaults)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(NamedTuple):
+    type: str
+    labels: Tuple[str, ...]
+    help: str
+
+
+METRICS: Dict[str, Metric] = {
+    "panda_http_requests_total": Metric(
+        "counter", ("method", "route", "status"), "HTTP requests by route template"
+    ),
+    "panda_http_request_duration_seconds": Metric(
+        "histogram", ("method", "route"), "HTTP request latency by route template"
+    ),
+    "panda_http_exceptions_total": Metric(
+        "counter", ("status", "code"), "HTTPExceptions raised, by ErrorsEng code"
+    ),
+    "panda_db_statements_total": Metric(
+        "counter", ("operation",), "SQL statements executed"
+    ),
+    "panda_db_statement_duration_seconds": Metric(
+        "histogram", ("operation",), "SQL statement execution time"
+    ),
+    "panda_db_pool_checkout_wait_seconds": Metric(
+        "histogram", (), "Time waiting for a connection from the pool"
+    ),
+    "panda_db_pool_checked_out": Metric(
+        "gauge", (), "Connections currently checked out of the pool"
+    ),
+    "panda_db_reads_total": Metric(
+        "counter",
+        ("database",),
+        "Sessions opened by GET routes, on the primary or a replica",
+    ),
+    "panda_patient_cache_hits_total": Metric("counter", (), "Patient cache hits"),
+    "panda_patient_cache_misses_total": Metric("counter", (), "Patient cache misses"),
+    "panda_patient_cache_evictions_total": Metric(
+        "counter", (), "Patient cache evictions"
+    ),
+    "panda_patient_cache_size": Metric("gauge", (), "Patients in the cache"),
+    "panda_appointments_marked_missed_total": Metric(
+        "counter", (), "Appointments marked as missed by the sweeper"
+    ),
+}
+
+
+class Snapshot(TypedDict):
+    """A worker's metrics as written to METRICS_DIR, series as [labels, value]"""
+
+    counters: Dict[str, List[Tuple[List[str], float]]]
+    histograms: Dict[str, List[Tuple[List[str], List[float]]]]
+    collected: Dict[str, float]
+
+
+_OPERATION = re.compile(r"\s*(\w+)")
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        # Per bucket counts (not cumulative), then +Inf, sum and count
+        self.histograms: Dict[str, Dict[Labels, List[float]]] = {}
+        # Read when a snapshot is taken, e.g. pool and cache state
+        self.collectors: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            counts = series.get(labels)
+            if counts is None:
+                counts = series[labels] = [0.0] * (len(BUCKETS) + 3)
+            counts[bisect_left(BUCKETS, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self) -> Snapshot:
+        with self._lock:
+            counters = {
+                name: [(list(labels), value) for labels, value in series.items()]
+                for name, series in self.counters.items()
+            }
+            histograms = {
+                name: [
+                    (list(labels), list(counts)) for labels, counts in series.items()
+                ]
+                for name, series in self.histograms.items()
+            }
+        collected = {name: collect() for name, collect in self.collectors.items()}
+        return Snapshot(counters=counters, histograms=histograms, collected=collected)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+
+
+def observe_request(method: str, route: str, status: int, latency: float) -> None:
+    registry.inc("panda_http_requests_total", (method, route, str(status)))
+    registry.observe("panda_http_request_duration_seconds", latency, (method, route))
+
+
+def observe_statement(statement: str, elapsed: float) -> None:
+    match = _OPERATION.match(statement)
+    operation = match.group(1).upper() if match else ""
+    if operation not in _OPERATIONS:
+        operation = "OTHER"
+    registry.inc("panda_db_statements_total", (operation,))
+    registry.observe("panda_db_statement_duration_seconds", elapsed, (operation,))
+
+
+def observe_pool_checkout(wait: float) -> None:
+    registry.observe("panda_db_pool_checkout_wait_seconds", wait)
+
+
+def count_http_exception(status: int, code: str) -> None:
+    registry.inc("panda_http_exceptions_total", (str(status), code))
+
+
+class MetricsMiddleware:
+    """ASGI middleware, records the count and latency of each HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Unmatched paths share one series, raw URLs would be unbounded
+            route = getattr(scope.get("route"), "path", "(no route)")
+            observe_request(scope["method"], route, status, time.perf_counter() - start)
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(settings.METRICS_DIR, f"{pid}.json")  # type: ignore[arg-type]
+
+
+def write_snapshot() -> None:
+    path = _snapshot_path(os.getpid())
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(registry.snapshot(), file)
+    os.replace(f"{path}.tmp", path)  # Readers never see a partial file
+
+
+def _worker_snapshots() -> List[Snapshot]:
+    """This worker's live metrics, plus the last snapshot of every other worker"""
+    snapshots = [registry.snapshot()]
+    if not settings.METRICS_DIR:
+        return snapshots
+    own = f"{os.getpid()}.json"
+    for name in os.listdir(settings.METRICS_DIR):
+        if name.endswith(".json") and name != own:
+            try:
+                with open(
+                    os.path.join(settings.METRICS_DIR, name), encoding="utf-8"
+                ) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                continue  # Being replaced, it is picked up on the next scrape
+    return snapshots
+
+
+class SnapshotWriter:
+    """Writes this worker's snapshot to METRICS_DIR every interval, and on stop"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            write_snapshot()
+
+    def start(self) -> None:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)  # type: ignore[arg-type]
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        write_snapshot()
+
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series(name: str, label_names: Tuple[str, ...], labels, extra: str = "") -> str:
+    pairs = [
+        f'{label}="{_label_value(str(value))}"'
+        for label, value in zip(label_names, labels)
+    ]
+    if extra:
+        pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _merge_counters(snapshots: List[Snapshot]) -> Dict[str, Dict[Labels, float]]:
+    counters: Dict[str, Dict[Labels, float]] = {}
+    for snapshot in snapshots:
+        for name, series in snapshot["counters"].items():
+            merged = counters.setdefault(name, {})
+            for labels, value in series:
+                merged[tuple(labels)] = merged.get(tuple(labels), 0) + value
+    return counters
+
+
+def _merge_histograms(
+    snapshots: List[Snapshot],
+) -> Dict[str, Dict[Labels, List[float]]]:
+    histograms: Dict[str, Dict[Labels, List[float]]] = {}
+    for snapshot in snapshots:
+        for name, series in snapshot["histograms"].items():
+            merged = histograms.setdefault(name, {})
+            for labels, counts in series:
+                total = merged.setdefault(tuple(labels), [0.0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+    return histograms
+
+
+def _merge_collected(snapshots: List[Snapshot]) -> Dict[str, float]:
+    collected: Dict[str, float] = {}
+    for snapshot in snapshots:
+        for name, value in snapshot["collected"].items():
+            collected[name] = collected.get(name, 0) + value
+    return collected
+
+
+def _render_counters(
+    name: str, metric: Metric, series: Dict[Labels, float]
+) -> List[str]:
+    return [
+        f"{_series(name, metric.labels, labels)} {_format_value(value)}"
+        for labels, value in sorted(series.items())
+    ]
+
+
+def _render_histograms(
+    name: str, metric: Metric, series: Dict[Labels, List[float]]
+) -> List[str]:
+    lines = []
+    for labels, counts in sorted(series.items()):
+        cumulative = 0.0
+        for bound, count in zip(BUCKETS + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            bucket = _series(f"{name}_bucket", metric.labels, labels, f'le="{le}"')
+            lines.append(f"{bucket} {_format_value(cumulative)}")
+        total = _series(f"{name}_sum", metric.labels, labels)
+        lines.append(f"{total} {_format_value(counts[-2])}")
+        observations = _series(f"{name}_count", metric.labels, labels)
+        lines.append(f"{observations} {_format_value(counts[-1])}")
+    return lines
+
+
+def render() -> str:
+    snapshots = _worker_snapshots()
+    counters = _merge_counters(snapshots)
+    histograms = _merge_histograms(snapshots)
+    collected = _merge_collected(snapshots)
+
+    lines = []
+    for name, metric in METRICS.items():
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        if name in collected:
+            lines.append(f"{name} {_format_value(collected[name])}")
+        lines.extend(_render_counters(name, metric, counters.get(name, {})))
+        lines.extend(_render_histograms(name, metric, histograms.get(name, {})))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,335 @@
+"""Versioned schema migrations.
+
+Base.metadata.create_all only creates missing tables, so an existing database
+never picks up new indexes or columns. Each Migration below runs once per
+database, in version order, and is recorded in the schema_version table.
+
+Indexes are created with IF NOT EXISTS, and CONCURRENTLY on PostgreSQL, so
+they can be added to a live database without blocking writes for the build.
+
+Usage:
+
+    python -m panda.migrations upgrade
+    python -m panda.migrations status
+    python -m panda.migrations explain
+"""
+import argparse
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Engine,
+    Index,
+    Integer,
+    MetaData,
+    Select,
+    String,
+    Table,
+    create_engine,
+    func,
+    inspect,
+    select,
+    tuple_,
+    update,
+)
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+# search adds its index to create_all
+from panda import models, search, stats  # noqa: F401
+from panda.core.config import settings
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String),
+    Column("applied_at", DateTime(timezone=True), default=datetime.utcnow),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+    # Concurrent index builds on PostgreSQL cannot run inside a transaction
+    transactional: bool = True
+
+
+def _model_index(table: Table, name: str) -> Index:
+    return next(index for index in table.indexes if index.name == name)
+
+
+def create_index(connection: Connection, index: Index) -> None:
+    ddl = str(
+        CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect)
+    )
+    if connection.dialect.name == "postgresql":
+        ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+    connection.exec_driver_sql(ddl)
+
+
+def _create_indexes(table: Table, *names: str) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection) -> None:
+        for name in names:
+            create_index(connection, _model_index(table, name))
+
+    return upgrade
+
+
+def _create_retired_index(
+    table: Table, name: str, *columns: str
+) -> Callable[[Connection], None]:
+    """
+    For migrations creating an index the models no longer have. It is built
+    on a copy of the table, an Index on the model's columns would be added to
+    the model and so to create_all.
+    """
+    def upgrade(connection: Connection) -> None:
+        copy = table.to_metadata(MetaData())
+        create_index(connection, Index(name, *[copy.c[column] for column in columns]))
+
+    return upgrade
+
+
+def _replace_index(
+    table: Table, name: str, old_name: str
+) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection) -> None:
+        create_index(connection, _model_index(table, name))
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {old_name}")
+
+    return upgrade
+
+
+def add_column(connection: Connection, table: Table, name: str) -> None:
+    """Adds a model column to an existing table, unless create_all already made it"""
+    if name in {
+        column["name"] for column in inspect(connection).get_columns(table.name)
+    }:
+        return
+    column = str(CreateColumn(table.c[name]).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column}")
+
+
+def _add_columns(name: str, *tables: Table) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection) -> None:
+        for table in tables:
+            add_column(connection, table, name)
+
+    return upgrade
+
+
+def _add_appointment_status(connection: Connection) -> None:
+    """Adds the status column, appointments that have ended are left to the sweeper"""
+    appointments = models.Appointment.__table__
+    add_column(connection, appointments, "status")
+    connection.execute(
+        update(appointments)
+        .where(appointments.c.is_cancelled.is_(True))
+        .values(status="cancelled")
+    )
+    connection.execute(
+        update(appointments)
+        .where(appointments.c.is_cancelled.is_not(True))
+        .where(appointments.c.attended_at.is_not(None))
+        .values(status="attended")
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1,
+        "Index addresses on (owner_type, owner_id, id)",
+        _create_indexes(models.Address.__table__, "ix_addresses_owner"),
+        transactional=False,
+    ),
+    Migration(
+        2,
+        "Index appointments on start_at and end_at",
+        _create_indexes(
+            models.Appointment.__table__,
+            "ix_appointments_start_at",
+            "ix_appointments_end_at",
+        ),
+        transactional=False,
+    ),
+    Migration(
+        3,
+        "Add a version column to patients, addresses and appointments for ETags",
+        _add_columns(
+            "version",
+            models.Patient.__table__,
+            models.Address.__table__,
+            models.Appointment.__table__,
+        ),
+    ),
+    Migration(
+        4,
+        "Index appointments on (patient_id, start_at)",
+        # Since replaced by ix_appointments_patient_interval, see 8
+        _create_retired_index(
+            models.Appointment.__table__,
+            "ix_appointments_patient_start",
+            "patient_id",
+            "start_at",
+        ),
+        transactional=False,
+    ),
+    Migration(5, "Add a status column to appointments", _add_appointment_status),
+    Migration(
+        6,
+        "Index appointments on (status, end_at)",
+        _create_indexes(models.Appointment.__table__, "ix_appointments_status_end"),
+        transactional=False,
+    ),
+    Migration(7, "Build the daily appointment stats rollup", stats.rebuild),
+    Migration(
+        8,
+        "Replace the (patient_id, start_at) appointments index with "
+        "(patient_id, start_at, end_at)",
+        _replace_index(
+            models.Appointment.__table__,
+            "ix_appointments_patient_interval",
+            "ix_appointments_patient_start",
+        ),
+        transactional=False,
+    ),
+]
+
+
+def current_version(engine: Engine) -> int:
+    with engine.begin() as connection:
+        schema_version.create(connection, checkfirst=True)
+        return connection.scalar(select(func.max(schema_version.c.version))) or 0
+
+
+def upgrade(engine: Engine) -> List[Migration]:
+    """
+    Creates missing tables, then applies pending migrations in order.
+    Returns the migrations that were applied.
+    """
+    models.Base.metadata.create_all(bind=engine)
+    version = current_version(engine)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        if migration.transactional:
+            with engine.begin() as connection:
+                migration.upgrade(connection)
+        else:
+            with engine.connect() as connection:
+                migration.upgrade(
+                    connection.execution_options(isolation_level="AUTOCOMMIT")
+                )
+        try:
+            with engine.begin() as connection:
+                connection.execute(
+                    schema_version.insert().values(
+                        version=migration.version, description=migration.description
+                    )
+                )
+        except IntegrityError:
+            pass  # Another worker applied it first, the migrations are idempotent
+        applied.append(migration)
+    return applied
+
+
+def _report_queries() -> Dict[str, Select]:
+    """Representative queries from crud, to check that they use an index"""
+    now = datetime.utcnow()
+    return {
+        "address_by_patient_id": select(models.Address)
+        .where(models.Address.owner_type == "patient")
+        .where(models.Address.owner_id == 1)
+        .order_by(models.Address.id.desc())
+        .limit(1),
+        "patient_by_nhs_number": select(models.Patient).where(
+            models.Patient.nhs_number == "4609571471"
+        ),
+        "appointments_page": select(models.Appointment)
+        .where(
+            tuple_(models.Appointment.start_at, models.Appointment.id)
+            > tuple_(now, 1)
+        )
+        .order_by(models.Appointment.start_at, models.Appointment.id)
+        .limit(100),
+        "appointments_day_sheet": select(models.Appointment)
+        .where(models.Appointment.start_at >= now)
+        .where(models.Appointment.start_at < now + timedelta(hours=8))
+        .order_by(models.Appointment.start_at, models.Appointment.id)
+        .limit(100),
+        "patient_schedule": select(models.Appointment)
+        .where(models.Appointment.patient_id == 1)
+        .where(models.Appointment.start_at >= now)
+        .order_by(models.Appointment.start_at, models.Appointment.id)
+        .limit(100),
+        "overlap_check": select(models.Appointment.id)
+        .where(models.Appointment.patient_id == 1)
+        .where(models.Appointment.start_at < now + timedelta(hours=1))
+        .where(models.Appointment.end_at > now)
+        .where(models.Appointment.status != "cancelled")
+        .limit(1),
+        "missed_sweep": select(models.Appointment.id)
+        .where(models.Appointment.status == "scheduled")
+        .where(models.Appointment.end_at < now)
+        .limit(500),
+        "appointments_ending_between": select(models.Appointment)
+        .where(models.Appointment.end_at >= now)
+        .where(models.Appointment.end_at < now + timedelta(days=1)),
+    }
+
+
+def explain(connection: Connection, statement: Select) -> List[str]:
+    """Returns the database's query plan for a statement, one line per step"""
+    compiled = statement.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(  # type: ignore[assignment]
+            params[name] for name in compiled.positiontup
+        )
+    if connection.dialect.name == "sqlite":
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params)
+        return [row.detail for row in rows]
+    rows = connection.exec_driver_sql(f"EXPLAIN {compiled}", params)
+    return [row[0] for row in rows]
+
+
+def explain_report(engine: Engine) -> Dict[str, List[str]]:
+    with engine.connect() as connection:
+        return {
+            name: explain(connection, statement)
+            for name, statement in _report_queries().items()
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PANDA schema migrations")
+    parser.add_argument("command", choices=["upgrade", "status", "explain"])
+    parser.add_argument("--url", default=settings.SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args()
+    engine = create_engine(args.url)
+
+    if args.command == "upgrade":
+        applied = upgrade(engine)
+        for migration in applied:
+            print(f"Applied {migration.version}: {migration.description}")
+        print(f"Schema is at version {current_version(engine)}")
+    elif args.command == "status":
+        version = current_version(engine)
+        for migration in MIGRATIONS:
+            state = "applied" if migration.version <= version else "pending"
+            print(f"{migration.version:>4} {state:<8} {migration.description}")
+    else:
+        for name, plan in explain_report(engine).items():
+            print(name)
+            for line in plan:
+                print(f"    {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,17 @@ from __future__ import annotations
 
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, Date, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    text,
+)
 from sqlalchemy.orm import relationship
 
 from panda.database import Base
@@ -17,13 +27,19 @@ class Patient(Base):
     dob = Column(Date)
     sex = Column(String)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    # Bumped by every update, used for ETags
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
 
     address = relationship("Address", primaryjoin="and_(foreign(Address.owner_type)=='patient', Patient.id==foreign(Address.owner_id))")
     appointments = relationship("Appointment", back_populates="patient")
 
-# [ ] TODO - Index owner_type & owner_id
+
 class Address(Base):
     __tablename__ = "addresses"
+    __table_args__ = (
+        # Owner lookups sort by id desc to get the latest address
+        Index("ix_addresses_owner", "owner_type", "owner_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     owner_type = Column(String)
@@ -35,10 +51,18 @@ class Address(Base):
     postcode = Column(String)
     country = Column(String)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
 
 
 class Appointment(Base):
     __tablename__ = "appointments"
+    __table_args__ = (
+        # A patient's schedule in start_at order, and double booking checks,
+        # which read both ends of the interval from the index
+        Index("ix_appointments_patient_interval", "patient_id", "start_at", "end_at"),
+        # Status filters, and the sweeper's scheduled rows past their end_at
+        Index("ix_appointments_status_end", "status", "end_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
@@ -46,12 +70,32 @@ class Appointment(Base):
     # department_id = Column(Integer, ForeignKey("departments.id"), index=True)
     # location_id = Column(Integer, ForeignKey("locations.id"), index=True)
     # organisation_id = Column(Integer, ForeignKey("organisations.id"), index=True)
-    start_at = Column(DateTime(timezone=True))
-    end_at = Column(DateTime(timezone=True))
+    start_at = Column(DateTime(timezone=True), index=True)
+    end_at = Column(DateTime(timezone=True), index=True)
     attended_at = Column(DateTime(timezone=True))
     cancelled_at = Column(DateTime(timezone=True))
     ended_at = Column(DateTime(timezone=True))
     is_cancelled = Column(Boolean, default=False)
+    # AppointmentStatus, set by cancel/attend and by the missed appointment sweeper
+    status = Column(
+        String, nullable=False, default="scheduled", server_default=text("'scheduled'")
+    )
 
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
     patient = relationship("Patient", back_populates="appointments")
+
+
+class AppointmentDailyStats(Base):
+    """
+    Appointments starting on each day by status, kept up to date by the crud
+    writes and the missed sweeper, see panda/stats.py
+    """
+    __tablename__ = "appointment_daily_stats"
+
+    day = Column(Date, primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    scheduled = Column(Integer, nullable=False, default=0)
+    attended = Column(Integer, nullable=False, default=0)
+    cancelled = Column(Integer, nullable=False, default=0)
+    missed = Column(Integer, nullable=False, default=0)
@@ -1,118 +1,337 @@
-from datetime import datetime, timedelta, timezone
-from typing import List
+"""Fills a database with synthetic patients, addresses and appointment histories.
 
+    python -m panda.populate_db --patients 1000000 --seed 0
+    python -m panda.populate_db --patients 10000 --url sqlite:///./bench.db --drop
+
+Patients are added to those already in the database, unless --drop is given
+to drop and recreate the tables first. Rows are written with chunked Core
+inserts (executemany), one transaction per chunk of patients, and the daily
+appointment stats are rebuilt at the end. Patient ids are given explicitly,
+so on PostgreSQL each chunk also moves the id sequence past them.
+
+Every patient has an address, and a history of appointments over the last
+two years (attended, missed or cancelled) plus a few to come. NHS numbers
+are unique and have valid check digits: candidate n is the body
+400 000 000 + (NHS_MULTIPLIER * n) mod 10^8, a bijection on England's range
+that scatters consecutive patients, skipping bodies whose check digit
+would be 10. A run continues after the number of patients already there,
+skipping numbers that are already taken.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+import numpy as np
 from faker import Faker
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session, declarative_base, sessionmaker
-
-from panda import crud, models
-from panda.enums import AddressOwnerType, Sex
-from panda.models import Address, Appointment, Patient
-from panda.schemas import AddressCreate, AppointmentCreate, PatientCreate
-
-SQLALCHEMY_DATABASE_URL = "sqlite:///./panda_app.db"
-
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={
-        "check_same_thread": False  # check_same_thread required for SQLite
-    },
-)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-Base = declarative_base()()
-
-
-# Dependency
-def get_db():
-    db_session = SessionLocal()
-    try:
-        return db_session
-    finally:
-        db_session.close()
-
-
-Faker.seed(0)
-fake: Faker = Faker("en-GB")
-
-NHS_NOS = [
-    "4609571471",
-    "4524408592",
-    "4959181745",
-    "1565022955",
-    "6607313191",
-    "2469139341",
-    "1451773986",
-    "0849244285",
-    "8663598831",
-    "7133568055",
-]
-
-# Drop the tables if they exist
-if engine.dialect.has_table(engine.connect(), "patients"):
-    Patient.__table__.drop(engine)
-if engine.dialect.has_table(engine.connect(), "addresses"):
-    Address.__table__.drop(engine)
-if engine.dialect.has_table(engine.connect(), "appointments"):
-    Appointment.__table__.drop(engine)
-
-# Create the tables from out models
-db: Session = get_db()
-models.Base.metadata.create_all(bind=engine)
-
-# Create lists to hold our fake data
-fake_patients: List[PatientCreate] = []
-fake_addresses: List[AddressCreate] = []
-fake_appointments: List[AppointmentCreate] = []
-
-# Create 10 for each model type
-for i in range(10):
-    fake_patients.append(
-        PatientCreate(
-            nhs_number=NHS_NOS[i],
-            name=fake.name(),
-            dob=fake.date_of_birth(),
-            sex=fake.enum(Sex).value,
+from sqlalchemy import Engine, create_engine, func, insert, select
+from sqlalchemy.engine import Connection
+
+from panda import migrations, models, stats
+from panda.core.config import settings
+from panda.database import set_sqlite_pragmas
+from panda.enums import AddressOwnerType, AppointmentStatus, Sex
+from panda.util.nhs_validator import check_digits
+from panda.util.postcode import normalise_postcodes
+
+NHS_BODY_START = 400_000_000
+NHS_BODY_SPAN = 100_000_000
+# Coprime with NHS_BODY_SPAN, so candidates map to distinct bodies
+NHS_MULTIPLIER = 61_803_399
+# NHS numbers per IN (...) looking for those already taken
+NHS_LOOKUP_SIZE = 5000
+
+HISTORY_DAYS = 730
+FUTURE_DAYS = 90
+# Probabilities of each status, for appointments that have ended and those to come
+PAST_STATUSES = {
+    AppointmentStatus.ATTENDED.value: 0.80,
+    AppointmentStatus.MISSED.value: 0.12,
+    AppointmentStatus.CANCELLED.value: 0.08,
+}
+FUTURE_STATUSES = {
+    AppointmentStatus.SCHEDULED.value: 0.92,
+    AppointmentStatus.CANCELLED.value: 0.08,
+}
+DURATIONS = np.array([15, 30, 60])  # Minutes
+
+
+def iter_nhs_numbers(
+    skip: int = 0, block_size: int = 1_000_000
+) -> Iterator[np.ndarray]:
+    """The NHS numbers from the skip-th on, in blocks, as 10 digit integers"""
+    found = 0
+    for candidate in range(0, NHS_BODY_SPAN, block_size):
+        candidates = np.arange(
+            candidate, min(candidate + block_size, NHS_BODY_SPAN), dtype=np.int64
         )
-    )
+        bodies = NHS_BODY_START + (NHS_MULTIPLIER * candidates) % NHS_BODY_SPAN
+        checksums = check_digits(bodies)
+        valid = bodies[checksums != 10] * 10 + checksums[checksums != 10]
+        found += len(valid)
+        if found > skip:
+            yield valid[max(skip - found + len(valid), 0):]
+    raise ValueError(f"Can't generate more than {found} NHS numbers")
+
 
-    fake_addresses.append(
-        AddressCreate(
-            owner_type=fake.enum(AddressOwnerType).value,
-            line1=fake.secondary_address(),
-            line2=fake.street_address(),
-            town=fake.city(),
-            county=fake.county(),
-            country=fake.current_country_code(),
-            postcode=fake.postcode(),
+def nhs_numbers(count: int, skip: int = 0, block_size: int = 1_000_000) -> np.ndarray:
+    """The NHS numbers of patients skip to skip + count, as 10 digit integers"""
+    numbers: List[np.ndarray] = []
+    found = 0
+    blocks = iter_nhs_numbers(skip, block_size)
+    while found < count:
+        numbers.append(next(blocks))
+        found += len(numbers[-1])
+    return np.concatenate(numbers)[:count] if numbers else np.empty(0, dtype=np.int64)
+
+
+def _unused(connection: Connection, numbers: np.ndarray) -> np.ndarray:
+    """Leaves out the numbers patients already have, e.g. added through the API"""
+    taken = [
+        int(number)
+        for start in range(0, len(numbers), NHS_LOOKUP_SIZE)
+        for number in connection.scalars(
+            select(models.Patient.nhs_number).where(
+                models.Patient.nhs_number.in_(
+                    numbers[start:start + NHS_LOOKUP_SIZE].astype(str).tolist()
+                )
+            )
+        )
+    ]
+    return numbers[~np.isin(numbers, taken)]
+
+
+class Generator:
+    """
+    Draws rows from pools of Faker values with NumPy, Faker itself is far too
+    slow to call for every one of millions of rows
+    """
+
+    def __init__(self, seed: int, appointments: float, pool_size: int = 1000):
+        Faker.seed(seed)
+        fake = Faker("en-GB")
+        self.rng = np.random.default_rng(seed)
+        self.appointments = appointments
+        self.first_names = [fake.first_name() for _ in range(pool_size)]
+        self.last_names = [fake.last_name() for _ in range(pool_size)]
+        self.streets = [fake.street_address() for _ in range(pool_size)]
+        self.towns = [fake.city() for _ in range(pool_size)]
+        self.counties = [fake.county() for _ in range(pool_size)]
+        # Faker's postcodes aren't all valid ones
+        self.postcodes = [
+            postcode
+            for postcode in normalise_postcodes(
+                fake.postcode() for _ in range(pool_size)
+            )
+            if postcode
+        ]
+        self.sexes = Sex.list()
+        self.now = datetime.utcnow().replace(second=0, microsecond=0)
+
+    def _pick(self, pool: List[str], size: int) -> List[str]:
+        return [pool[i] for i in self.rng.integers(len(pool), size=size)]
+
+    def patients(self, ids: np.ndarray, numbers: np.ndarray) -> List[Dict]:
+        size = len(ids)
+        first_names = self._pick(self.first_names, size)
+        last_names = self._pick(self.last_names, size)
+        sexes = self._pick(self.sexes, size)
+        ages = self.rng.integers(0, 100 * 365, size=size)
+        return [
+            {
+                "id": int(patient_id),
+                "nhs_number": str(number),
+                "name": f"{first_name} {last_name}",
+                "dob": (self.now - timedelta(days=int(age))).date(),
+                "sex": sex,
+                "created_at": self.now,
+            }
+            for patient_id, number, first_name, last_name, sex, age in zip(
+                ids, numbers, first_names, last_names, sexes, ages
+            )
+        ]
+
+    def addresses(self, ids: np.ndarray) -> List[Dict]:
+        size = len(ids)
+        return [
+            {
+                "owner_type": AddressOwnerType.PATIENT.value,
+                "owner_id": int(patient_id),
+                "line1": line1,
+                "line2": "",
+                "town": town,
+                "county": county,
+                "postcode": postcode,
+                "country": "GB",
+                "created_at": self.now,
+            }
+            for patient_id, line1, town, county, postcode in zip(
+                ids,
+                self._pick(self.streets, size),
+                self._pick(self.towns, size),
+                self._pick(self.counties, size),
+                self._pick(self.postcodes, size),
+            )
+        ]
+
+    def appointments_of(self, ids: np.ndarray) -> List[Dict]:
+        """
+        A Poisson number of appointments per patient, a week to three months
+        apart from a random start in the last two years, so none of a
+        patient's overlap
+        """
+        counts = self.rng.poisson(self.appointments, size=len(ids))
+        total = int(counts.sum())
+        if not total:
+            return []
+        patient_ids = np.repeat(ids, counts)
+        gaps = self.rng.integers(7, 90, size=total)
+        # Days since each patient's first appointment, restarting for each patient
+        cumulative = np.cumsum(gaps)
+        has_any = counts > 0
+        before = (cumulative - gaps)[(np.cumsum(counts) - counts)[has_any]]
+        days = (
+            np.repeat(self.rng.integers(-HISTORY_DAYS, 0, size=len(ids)), counts)
+            + cumulative
+            - np.repeat(before, counts[has_any])
+        )
+        keep = days <= FUTURE_DAYS
+        patient_ids, days = patient_ids[keep], days[keep]
+        size = len(days)
+
+        midnight = self.now.replace(hour=0, minute=0)
+        minutes = days * 24 * 60 + 8 * 60 + 15 * self.rng.integers(0, 36, size=size)
+        durations = DURATIONS[self.rng.integers(len(DURATIONS), size=size)]
+        ended = minutes + durations < (self.now - midnight).total_seconds() // 60
+        statuses = np.where(
+            ended,
+            self.rng.choice(
+                list(PAST_STATUSES), size=size, p=list(PAST_STATUSES.values())
+            ),
+            self.rng.choice(
+                list(FUTURE_STATUSES), size=size, p=list(FUTURE_STATUSES.values())
+            ),
+        )
+
+        rows = []
+        for patient_id, minute, duration, status in zip(
+            patient_ids, minutes, durations, statuses
+        ):
+            start_at = midnight + timedelta(minutes=int(minute))
+            end_at = start_at + timedelta(minutes=int(duration))
+            cancelled = status == AppointmentStatus.CANCELLED.value
+            rows.append(
+                {
+                    "patient_id": int(patient_id),
+                    "start_at": start_at,
+                    "end_at": end_at,
+                    "attended_at": (
+                        start_at if status == AppointmentStatus.ATTENDED.value else None
+                    ),
+                    "cancelled_at": start_at - timedelta(days=1) if cancelled else None,
+                    "is_cancelled": bool(cancelled),
+                    "status": str(status),
+                    "created_at": min(start_at - timedelta(days=14), self.now),
+                }
+            )
+        return rows
+
+
+def _insert(connection: Connection, model, rows: List[Dict], chunk_size: int) -> None:
+    for start in range(0, len(rows), chunk_size):
+        connection.execute(insert(model), rows[start:start + chunk_size])
+
+
+def _advance_patient_ids(connection: Connection, last_id: int) -> None:
+    """
+    Moves PostgreSQL's patients.id sequence past the ids inserted explicitly,
+    or patients added through the API would be given ids already taken
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            select(
+                func.setval(
+                    func.pg_get_serial_sequence(models.Patient.__tablename__, "id"),
+                    last_id,
+                )
+            )
         )
-    )
 
-    # Create a random start time today, between now and 9 hours away
-    start_time: datetime = fake.date_time_between(
-        datetime.utcnow(),
-        datetime.utcnow() + timedelta(hours=fake.random_number(digits=1)),
-    ).replace(tzinfo=timezone.utc)
-    end_time: datetime = (start_time + timedelta(hours=1))
 
-    fake_appointments.append(
-        AppointmentCreate(patient_id=i + 1, start_at=start_time, end_at=end_time)
+def populate(
+    engine: Engine, patients: int, seed: int, appointments: float, chunk_size: int
+) -> Dict[str, int]:
+    """
+    Adds the patients, with their addresses and appointments, returns the
+    rows inserted
+    """
+    with engine.connect() as connection:
+        existing = connection.scalar(select(func.count()).select_from(models.Patient))
+        first_id = (connection.scalar(select(func.max(models.Patient.id))) or 0) + 1
+    # Earlier runs took the first numbers, patients added otherwise may have any
+    candidates = iter_nhs_numbers(skip=existing, block_size=chunk_size)
+    numbers = np.empty(0, dtype=np.int64)
+    generator = Generator(seed, appointments)
+    inserted = {"patients": 0, "addresses": 0, "appointments": 0}
+
+    for start in range(0, patients, chunk_size):
+        ids = np.arange(first_id + start, first_id + min(start + chunk_size, patients))
+        with engine.begin() as connection:
+            while len(numbers) < len(ids):
+                free = _unused(connection, next(candidates))
+                numbers = np.concatenate([numbers, free])
+            patient_rows = generator.patients(ids, numbers[:len(ids)])
+            numbers = numbers[len(ids):]
+            address_rows = generator.addresses(ids)
+            appointment_rows = generator.appointments_of(ids)
+            _insert(connection, models.Patient, patient_rows, chunk_size)
+            _advance_patient_ids(connection, int(ids[-1]))
+            _insert(connection, models.Address, address_rows, chunk_size)
+            _insert(connection, models.Appointment, appointment_rows, chunk_size)
+        inserted["patients"] += len(patient_rows)
+        inserted["addresses"] += len(address_rows)
+        inserted["appointments"] += len(appointment_rows)
+
+    with engine.begin() as connection:
+        stats.rebuild(connection)
+    return inserted
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Fill the PANDA database with synthetic data"
+    )
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", default=settings.SQLALCHEMY_DATABASE_URL)
+    parser.add_argument(
+        "--appointments", type=float, default=8.0, help="Mean appointments per patient"
     )
+    parser.add_argument(
+        "--chunk-size", type=int, default=10000, help="Patients per transaction"
+    )
+    parser.add_argument(
+        "--drop", action="store_true", help="Drop and recreate the tables first"
+    )
+    args = parser.parse_args()
 
+    engine = create_engine(args.url)
+    set_sqlite_pragmas(engine)
+    if args.drop:
+        models.Base.metadata.drop_all(bind=engine)
+    migrations.upgrade(engine)
 
-# Add our fake data to the database
-print("\nCreating fake patients...")
-for patient in fake_patients:
-    print(patient)
-    crud.create_patient(db=db, patient=patient)
+    start = time.perf_counter()
+    inserted = populate(
+        engine, args.patients, args.seed, args.appointments, args.chunk_size
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"Inserted {inserted['patients']} patients, "
+        f"{inserted['addresses']} addresses and "
+        f"{inserted['appointments']} appointments in {elapsed:.1f}s"
+    )
 
-print("\nCreating fake addresses...")
-for i, address in enumerate(fake_addresses, 1):
-    print(i, address)
-    crud.create_patient_address(db=db, address=address, patient_id=i)
 
-print("\nCreating fake appointments...")
-for appointment in fake_appointments:
-    print(appointment)
-    crud.create_appointment(db=db, appointment=appointment)
+if __name__ == "__main__":
+    main()
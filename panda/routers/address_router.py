@@ -1,20 +1,14 @@
-from typing import List
+from typing import List, Union
 
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-
-from panda import crud, schemas
-from panda.database import SessionLocal
-
-
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+from fastapi import APIRouter, Depends, Header, Response
+from fastapi.responses import ORJSONResponse
 
+from panda import async_crud, crud, schemas
+from panda.core.config import settings
+from panda.database import DbSession, get_read_db
+from panda.util import etag
+from panda.util.common_query_params import CommonQuery
+from panda.util.pagination import set_next_cursor
 
 router = APIRouter(
     prefix="/addresses",
@@ -24,10 +18,41 @@ router = APIRouter(
 
 
 @router.get("/", response_model=List[schemas.Address])
-async def get_addresses(db: Session = Depends(get_db)):
-    return crud.get_addresses(db=db)
-
-
-@router.get("/{address_id}", response_model=schemas.Address)
-async def get_address(address_id: int, db: Session = Depends(get_db)):
-    return crud.get_address_by_id(db=db, address_id=address_id)
+async def get_addresses(
+    commons: CommonQuery, response: Response, db: DbSession = Depends(get_read_db)
+):
+    db_addresses = await async_crud.get_addresses(
+        db=db,
+        offset=commons.offset,
+        limit=commons.limit,
+        cursor=commons.cursor,
+        as_dicts=settings.FAST_JSON,
+    )
+    if settings.FAST_JSON:
+        # Plain dicts, so skip response_model and encode them as they are
+        response = ORJSONResponse(db_addresses)
+    set_next_cursor(response, db_addresses, commons.limit, crud.ADDRESS_CURSOR_KEY)
+    return response if settings.FAST_JSON else db_addresses
+
+
+@router.get(
+    "/{address_id}",
+    response_model=schemas.Address,
+    responses={304: {"description": "Not modified (If-None-Match)"}},
+)
+async def get_address(
+    address_id: int,
+    response: Response,
+    if_none_match: Union[str, None] = Header(None),
+    db: DbSession = Depends(get_read_db),
+):
+    if if_none_match:
+        version = await async_crud.get_address_version(db=db, address_id=address_id)
+        if version is not None:
+            current = etag.make_etag(address_id, version)
+            if etag.if_none_match(if_none_match, current):
+                return etag.not_modified(current)
+    db_address = await async_crud.get_address_by_id(db=db, address_id=address_id)
+    if db_address is not None:
+        etag.set_etag(response, db_address.id, db_address.version)
+    return db_address
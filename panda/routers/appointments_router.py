@@ -1,21 +1,16 @@
-from typing import List
+from datetime import date, datetime, timedelta
+from typing import List, Union
 
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-
-from panda import crud, schemas
-from panda.database import SessionLocal
-from panda.util.common_query_params import CommonQuery
-
-
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+from fastapi import APIRouter, Depends, Header, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
+from panda import async_crud, crud, schemas
+from panda.core.config import settings
+from panda.database import DbSession, get_db, get_read_db
+from panda.enums import ExportFormat, StatsPeriod
+from panda.util import etag, export
+from panda.util.common_query_params import AppointmentFilters, CommonQuery
+from panda.util.pagination import set_next_cursor
 
 router = APIRouter(
     prefix="/appointments",
@@ -25,41 +20,205 @@ router = APIRouter(
 
 
 @router.get("/", response_model=List[schemas.Appointment])
-async def get_appointments(commons: CommonQuery, db: Session = Depends(get_db)):
-    return crud.get_appointments(db, offset=commons.offset, limit=commons.limit)
-
-
-@router.get("/{appointment_id}", response_model=schemas.Appointment)
-async def get_appointment_by_id(appointment_id: int, db: Session = Depends(get_db)):
-    return crud.get_appointment_by_id(db, appointment_id=appointment_id)
+async def get_appointments(
+    commons: CommonQuery,
+    filters: AppointmentFilters,
+    response: Response,
+    patient_id: Union[int, None] = None,
+    db: DbSession = Depends(get_read_db),
+):
+    """
+    Appointments ordered by start time, e.g. a clinic's day sheet with
+    start_from and start_to, optionally for one patient or status
+    """
+    db_appointments = await async_crud.get_appointments(
+        db,
+        offset=commons.offset,
+        limit=commons.limit,
+        cursor=commons.cursor,
+        as_dicts=settings.FAST_JSON,
+        patient_id=patient_id,
+        **filters.dict(),
+    )
+    if settings.FAST_JSON:
+        # Plain dicts, so skip response_model and encode them as they are
+        response = ORJSONResponse(db_appointments)
+    set_next_cursor(
+        response, db_appointments, commons.limit, crud.APPOINTMENT_CURSOR_KEY
+    )
+    return response if settings.FAST_JSON else db_appointments
+
+
+# Must be above get_appointment_by_id
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {media_type: {} for media_type in export.MEDIA_TYPES.values()}}
+    },
+)
+async def export_appointments(
+    export_format: ExportFormat = Query(ExportFormat.NDJSON, alias="format"),
+    start_from: Union[datetime, None] = None,
+    start_to: Union[datetime, None] = None,
+    db: DbSession = Depends(get_read_db),
+):
+    """
+    Streams every appointment starting in [start_from, start_to) in a single
+    response, in constant memory
+    """
+    batches = async_crud.stream(
+        db,
+        crud.appointments_export_query(start_from=start_from, start_to=start_to),
+        yield_per=export.EXPORT_BATCH_SIZE,
+    )
+    return StreamingResponse(
+        export.encode(batches, export_format, list(schemas.Appointment.__fields__)),
+        media_type=export.MEDIA_TYPES[export_format],
+    )
+
+
+# Must be above get_appointment_by_id
+@router.get("/conflicts", response_model=List[schemas.AppointmentConflict])
+async def get_appointment_conflicts(
+    start_from: datetime, start_to: datetime, db: DbSession = Depends(get_read_db)
+):
+    """
+    Every pair of overlapping (double booked) appointments of a patient,
+    both starting in [start_from, start_to)
+    """
+    return await async_crud.get_appointment_conflicts(
+        db, start_from=start_from, start_to=start_to
+    )
+
+
+# Must be above get_appointment_by_id
+@router.get("/stats", response_model=List[schemas.AppointmentStats])
+async def get_appointment_stats(
+    date_from: Union[date, None] = Query(
+        None, description="Defaults to 4 weeks before date_to"
+    ),
+    date_to: Union[date, None] = Query(
+        None, description="Inclusive, defaults to today"
+    ),
+    period: StatsPeriod = StatsPeriod.DAY,
+    db: DbSession = Depends(get_read_db),
+):
+    """
+    Attendance, cancellation and DNA (did not attend) counts and rates per
+    day or week, by appointment start date
+    """
+    date_to = date_to or date.today()
+    date_from = date_from or date_to - timedelta(days=27)
+    return await async_crud.get_appointment_stats(
+        db, date_from=date_from, date_to=date_to, period=period
+    )
+
+
+@router.get(
+    "/{appointment_id}",
+    response_model=schemas.Appointment,
+    responses={304: {"description": "Not modified (If-None-Match)"}},
+)
+async def get_appointment_by_id(
+    appointment_id: int,
+    response: Response,
+    if_none_match: Union[str, None] = Header(None),
+    db: DbSession = Depends(get_read_db),
+):
+    if if_none_match:
+        version = await async_crud.get_appointment_version(
+            db=db, appointment_id=appointment_id
+        )
+        if version is not None:
+            current = etag.make_etag(appointment_id, version)
+            if etag.if_none_match(if_none_match, current):
+                return etag.not_modified(current)
+    db_appointment = await async_crud.get_appointment_by_id(
+        db=db, appointment_id=appointment_id
+    )
+    etag.set_etag(response, db_appointment.id, db_appointment.version)
+    return db_appointment
 
 
 @router.post("/", response_model=schemas.Appointment)
-async def create_appointment(appointment: schemas.AppointmentCreate, db: Session = Depends(get_db)):
-    return crud.create_appointment(db=db, appointment=appointment)
+async def create_appointment(
+    appointment: schemas.AppointmentCreate, db: DbSession = Depends(get_db)
+):
+    return await async_crud.create_appointment(db=db, appointment=appointment)
 
 
 # [ ] TODO - Add cancelled_at timestamp if is_cancelled is updated
 @router.put(
     "/{appointment_id}",
-    responses={403: {"description": "Operation forbidden"}},
+    response_model=schemas.Appointment,
+    responses={
+        403: {"description": "Operation forbidden"},
+        412: {"description": "Appointment has changed (If-Match)"},
+    },
 )
-async def update_appointment(appointment_id: int, appointment: schemas.AppointmentCreate, db: Session = Depends(get_db)):
-    return crud.update_appointment(db=db, appointment_id=appointment_id, appointment=appointment)
+async def update_appointment(
+    appointment_id: int,
+    appointment: schemas.AppointmentCreate,
+    response: Response,
+    if_match: Union[str, None] = Header(None),
+    db: DbSession = Depends(get_db),
+):
+    db_appointment = await async_crud.update_appointment(
+        db=db,
+        appointment_id=appointment_id,
+        appointment=appointment,
+        versions=etag.if_match_versions(if_match, appointment_id),
+    )
+    etag.set_etag(response, db_appointment.id, db_appointment.version)
+    return db_appointment
+
+
+def _outcomes(outcomes) -> List[dict]:
+    return [
+        {"id": appointment_id, "status": status, "error": error}
+        for appointment_id, status, error in outcomes
+    ]
+
+
+# Must be above cancel_appointment
+@router.post("/bulk/cancel", response_model=List[schemas.AppointmentOutcome])
+async def bulk_cancel_appointments(
+    selection: schemas.AppointmentSelection, db: DbSession = Depends(get_db)
+):
+    """
+    Cancels every selected appointment that can be, in one transaction, e.g.
+    when a clinic is cancelled. Returns the outcome for each appointment.
+    """
+    return _outcomes(await async_crud.bulk_cancel_appointments(db, **selection.dict()))
+
+
+@router.post("/bulk/attended", response_model=List[schemas.AppointmentOutcome])
+async def bulk_mark_appointments_attended(
+    selection: schemas.AppointmentSelection, db: DbSession = Depends(get_db)
+):
+    return _outcomes(
+        await async_crud.bulk_mark_appointments_attended(db, **selection.dict())
+    )
 
 
-# [ ] TODO - Add cancelled_at timestamp
 @router.post(
     "/{appointment_id}/cancel",
+    response_model=schemas.Appointment,
     responses={403: {"description": "Operation forbidden"}},
 )
-async def cancel_appointment(appointment_id: int, db: Session = Depends(get_db)):
-    return crud.cancel_appointment(db=db, appointment_id=appointment_id)
+async def cancel_appointment(appointment_id: int, db: DbSession = Depends(get_db)):
+    return await async_crud.cancel_appointment(db=db, appointment_id=appointment_id)
 
 
 @router.post(
     "/{appointment_id}/attended",
+    response_model=schemas.Appointment,
     responses={403: {"description": "Operation forbidden"}},
 )
-async def mark_appointment_attended(appointment_id: int, db: Session = Depends(get_db)):
-    return crud.mark_appointment_attended(db=db, appointment_id=appointment_id)
+async def mark_appointment_attended(
+    appointment_id: int, db: DbSession = Depends(get_db)
+):
+    return await async_crud.mark_appointment_attended(
+        db=db, appointment_id=appointment_id
+    )
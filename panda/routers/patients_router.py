@@ -1,22 +1,31 @@
-from typing import List
+from datetime import datetime
+from typing import List, Union
 
-from fastapi import APIRouter, Body, Depends
-from sqlalchemy.orm import Session
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from typing_extensions import Annotated
 
-from panda import crud, schemas
-from panda.database import SessionLocal
-from panda.util.common_query_params import CommonQuery
-
-
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
+from panda import async_crud, crud, schemas
+from panda.core.config import settings
+from panda.database import DbSession, get_db, get_read_db
+from panda.enums import ExportFormat
+from panda.util import bulk_import, etag, export
+from panda.util.common_query_params import (
+    AppointmentFilters,
+    CommonQuery,
+    PatientIncludeQuery,
+)
+from panda.util.pagination import set_next_cursor
 
 router = APIRouter(
     prefix="/patients",
@@ -25,60 +34,247 @@ router = APIRouter(
 )
 
 
-@router.get("/", response_model=List[schemas.Patient])
-async def get_patients(commons: CommonQuery, db: Session = Depends(get_db)):
-    db_patients = crud.get_patients(
-        db, query=commons.query, offset=commons.offset, limit=commons.limit
+# exclude_unset leaves out the relations that weren't included, rather than
+# sending them as null
+@router.get(
+    "/",
+    response_model=List[schemas.PatientWithRelations],
+    response_model_exclude_unset=True,
+)
+async def get_patients(
+    commons: CommonQuery,
+    include: PatientIncludeQuery,
+    response: Response,
+    db: DbSession = Depends(get_read_db),
+):
+    # Always dicts, ORM patients would have their address list validated as an Address
+    db_patients = await async_crud.get_patients(
+        db,
+        query=commons.query,
+        offset=commons.offset,
+        limit=commons.limit,
+        cursor=commons.cursor,
+        as_dicts=True,
+        include=include,
     )
-    return db_patients
+    if settings.FAST_JSON:
+        # Plain dicts, so skip response_model and encode them as they are
+        response = ORJSONResponse(db_patients)
+    set_next_cursor(response, db_patients, commons.limit, crud.PATIENT_CURSOR_KEY)
+    return response if settings.FAST_JSON else db_patients
 
 
 @router.post("/", response_model=schemas.Patient)
 async def create_patient(
-    patient: Annotated[schemas.PatientCreate, Body(
-        examples=schemas.PatientCreate.Config.schema_extra["examples"])], db: Session = Depends(get_db)
+    patient: Annotated[
+        schemas.PatientCreate,
+        Body(examples=schemas.PatientCreate.Config.schema_extra["examples"]),
+    ],
+    db: DbSession = Depends(get_db),
 ):
-    return crud.create_patient(db=db, patient=patient)
+    return await async_crud.create_patient(db=db, patient=patient)
+
+
+@router.post(
+    "/bulk",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "description": "One NDJSON result per row, in row order",
+            "content": {bulk_import.NDJSON_MEDIA_TYPE: {}},
+        },
+        415: {"description": "Body is not NDJSON or CSV"},
+    },
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                bulk_import.NDJSON_MEDIA_TYPE: {"schema": {"type": "string"}},
+                "text/csv": {"schema": {"type": "string"}},
+            },
+        }
+    },
+)
+async def create_patients_bulk(request: Request, db: DbSession = Depends(get_db)):
+    """
+    Imports patients from a streamed NDJSON body (one patient object per line)
+    or CSV body (with a nhs_number,name,dob,sex header row)
+    """
+    content_type = request.headers.get("content-type", bulk_import.NDJSON_MEDIA_TYPE)
+    try:
+        parse_records = bulk_import.record_parser(content_type)
+    except ValueError:
+        raise HTTPException(
+            415, detail=f"{crud.ErrorsEng.UNSUPPORTED_IMPORT_TYPE.value}{content_type}"
+        )
+
+    async def create_chunk(patients):
+        return await async_crud.create_patients(db=db, patients=patients)
+
+    results = bulk_import.spool()
+    await bulk_import.import_patients(
+        parse_records(request.stream()),
+        create_chunk,
+        results,
+        settings.BULK_IMPORT_CHUNK_SIZE,
+    )
+    return StreamingResponse(
+        bulk_import.iter_file(results),
+        media_type=bulk_import.NDJSON_MEDIA_TYPE,
+        background=BackgroundTask(results.close),
+    )
 
 
 # Must be above get_patient
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    responses={
+        200: {"content": {media_type: {} for media_type in export.MEDIA_TYPES.values()}}
+    },
+)
+async def export_patients(
+    export_format: ExportFormat = Query(ExportFormat.NDJSON, alias="format"),
+    created_from: Union[datetime, None] = None,
+    created_to: Union[datetime, None] = None,
+    db: DbSession = Depends(get_read_db),
+):
+    """
+    Streams every patient created in [created_from, created_to) in a single
+    response, in constant memory
+    """
+    batches = async_crud.stream(
+        db,
+        crud.patients_export_query(created_from=created_from, created_to=created_to),
+        yield_per=export.EXPORT_BATCH_SIZE,
+    )
+    return StreamingResponse(
+        export.encode(batches, export_format, list(schemas.Patient.__fields__)),
+        media_type=export.MEDIA_TYPES[export_format],
+    )
+
+
 @router.get("/getbynhsnumber", response_model=schemas.Patient)
 async def get_patient_by_nhs_number(
-    nhs_no: str, db: Session = Depends(get_db)
+    nhs_no: str, db: DbSession = Depends(get_read_db)
 ):
-    return crud.get_patient_by_nhs_number(db=db, nhs_number=nhs_no)
+    return await async_crud.get_cached_patient_by_nhs_number(db=db, nhs_number=nhs_no)
 
 
-@router.get("/{patient_id}", response_model=schemas.Patient)
-async def get_patient(patient_id: int, db: Session = Depends(get_db)):
-    return crud.get_patient_by_id(db=db, patient_id=patient_id)
+@router.get(
+    "/{patient_id}",
+    response_model=schemas.PatientWithRelations,
+    response_model_exclude_unset=True,
+    responses={304: {"description": "Not modified (If-None-Match)"}},
+)
+async def get_patient(
+    patient_id: int,
+    include: PatientIncludeQuery,
+    response: Response,
+    if_none_match: Union[str, None] = Header(None),
+    db: DbSession = Depends(get_read_db),
+):
+    if include:
+        # Not cached, and no ETag: the patient's version doesn't cover its relations
+        return await async_crud.get_patient_with_related(
+            db=db, patient_id=patient_id, include=include
+        )
+    if if_none_match:
+        version = await async_crud.get_patient_version(db=db, patient_id=patient_id)
+        if version is not None:
+            current = etag.make_etag(patient_id, version)
+            if etag.if_none_match(if_none_match, current):
+                return etag.not_modified(current)
+    patient = await async_crud.get_cached_patient(db=db, patient_id=patient_id)
+    etag.set_etag(response, patient["id"], patient["version"])
+    return patient
 
 
 @router.delete("/{patient_id}")
-async def delete_patient(patient_id: int, db: Session = Depends(get_db)):
-    return crud.delete_patient(db=db, patient_id=patient_id)
+async def delete_patient(patient_id: int, db: DbSession = Depends(get_db)):
+    return await async_crud.delete_patient(db=db, patient_id=patient_id)
 
 
-@router.put("/{patient_id}")
+@router.put(
+    "/{patient_id}",
+    response_model=schemas.Patient,
+    responses={412: {"description": "Patient has changed (If-Match)"}},
+)
 async def update_patient(
     patient_id: int,
     patient: schemas.PatientCreate,
-    db: Session = Depends(get_db),
+    response: Response,
+    if_match: Union[str, None] = Header(None),
+    db: DbSession = Depends(get_db),
 ):
-    return crud.update_patient(db=db, patient_id=patient_id, patient=patient)
+    db_patient = await async_crud.update_patient(
+        db=db,
+        patient_id=patient_id,
+        patient=patient,
+        versions=etag.if_match_versions(if_match, patient_id),
+    )
+    etag.set_etag(response, db_patient.id, db_patient.version)
+    return db_patient
 
 
 @router.post("/{patient_id}/address", response_model=schemas.Address)
 async def create_patient_address(
     address: schemas.AddressCreate,
     patient_id: int,
-    db: Session = Depends(get_db),
+    db: DbSession = Depends(get_db),
 ):
-    return crud.create_patient_address(
+    return await async_crud.create_patient_address(
         db=db, address=address, patient_id=patient_id
     )
 
 
-@router.get("/{patient_id}/address", response_model=schemas.Address)
-async def get_patient_address(patient_id: int, db: Session = Depends(get_db)):
-    return crud.get_address_by_patient_id(db=db, patient_id=patient_id)
+@router.get(
+    "/{patient_id}/address",
+    response_model=schemas.Address,
+    responses={304: {"description": "Not modified (If-None-Match)"}},
+)
+async def get_patient_address(
+    patient_id: int,
+    response: Response,
+    if_none_match: Union[str, None] = Header(None),
+    db: DbSession = Depends(get_read_db),
+):
+    if if_none_match:
+        latest = await async_crud.get_address_version_by_patient_id(
+            db=db, patient_id=patient_id
+        )
+        if latest is not None:
+            current = etag.make_etag(*latest)
+            if etag.if_none_match(if_none_match, current):
+                return etag.not_modified(current)
+    db_address = await async_crud.get_address_by_patient_id(
+        db=db, patient_id=patient_id
+    )
+    etag.set_etag(response, db_address.id, db_address.version)
+    return db_address
+
+
+@router.get("/{patient_id}/appointments", response_model=List[schemas.Appointment])
+async def get_patient_appointments(
+    patient_id: int,
+    commons: CommonQuery,
+    filters: AppointmentFilters,
+    response: Response,
+    db: DbSession = Depends(get_read_db),
+):
+    db_appointments = await async_crud.get_patient_appointments(
+        db,
+        patient_id=patient_id,
+        offset=commons.offset,
+        limit=commons.limit,
+        cursor=commons.cursor,
+        as_dicts=settings.FAST_JSON,
+        **filters.dict(),
+    )
+    if settings.FAST_JSON:
+        # Plain dicts, so skip response_model and encode them as they are
+        response = ORJSONResponse(db_appointments)
+    set_next_cursor(
+        response, db_appointments, commons.limit, crud.APPOINTMENT_CURSOR_KEY
+    )
+    return response if settings.FAST_JSON else db_appointments
@@ -3,12 +3,13 @@ from __future__ import annotations
 
 import re
 from datetime import date, datetime, timezone
-from typing import Union
+from typing import List, Union
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, root_validator, validator
 
-from panda.enums import AddressOwnerType, Sex
+from panda.enums import AddressOwnerType, AppointmentStatus, Sex
 from panda.util import nhs_validator
+from panda.util.postcode import normalise_postcode
 
 
 # [ ] TODO - Add sensible values - Phone, Email, etc
@@ -109,7 +110,6 @@ class Patient(PatientBase):
 
 # [ ] TODO - Add example and description values for documentation
 class AddressBase(BaseModel):
-    # [ ] TODO - Create composite index in DB
     owner_type: AddressOwnerType  # Composite index in DB with owner_id
     line1: str
     line2: str
@@ -120,15 +120,7 @@ class AddressBase(BaseModel):
 
     @validator("postcode")
     def coerce_postcode(cls, v: str) -> str:
-        v = re.sub(r"[^a-zA-Z0-9]", "", v).upper()
-        valid_postcode = re.compile(
-            # This is the government's postcode validation regex
-            r"^([Gg][Ii][Rr] 0[Aa]{2})|((([A-Za-z][0-9]{1,2})|(([A-Za-z][A-Ha-hJ-Yj-y][0-9]{1,2})|(([A-Za-z][0-9][A-Za-z])|([A-Za-z][A-Ha-hJ-Yj-y][0-9][A-Za-z]?))))\s?[0-9][A-Za-z]{2})$"
-        )
-        match = valid_postcode.match(v)
-        if not match:
-            raise ValueError(f"Could not parse post code: {v}")
-        return v
+        return normalise_postcode(v)
 
     @validator("owner_type")
     def validate_owner_type(cls, v: AddressOwnerType) -> str:
@@ -198,6 +190,95 @@ class Appointment(AppointmentBase):
     cancelled_at: Union[datetime, None] = None
     ended_at: Union[datetime, None] = None
     is_cancelled: bool = False
+    status: AppointmentStatus = Field(
+        AppointmentStatus.SCHEDULED,
+        description=(
+            f"An Enum value of {AppointmentStatus.list()}, "
+            "missed is set shortly after end_at"
+        ),
+    )
 
     class Config:
         orm_mode = True
+
+
+class AppointmentStats(BaseModel):
+    period_start: date = Field(description="The day, or the Monday of the week")
+    total: int
+    scheduled: int
+    attended: int
+    cancelled: int
+    missed: int = Field(description="Not attended by the end of the appointment (DNA)")
+    attendance_rate: Union[float, None] = Field(
+        description="attended / (attended + missed), null without either"
+    )
+    dna_rate: Union[float, None] = Field(description="missed / (attended + missed)")
+    cancellation_rate: Union[float, None] = Field(description="cancelled / total")
+
+
+class AppointmentSelection(BaseModel):
+    ids: Union[List[int], None] = Field(
+        None, max_items=1000, description="Appointment IDs"
+    )
+    # Or a filter, as for GET /appointments
+    start_from: Union[datetime, None] = None
+    start_to: Union[datetime, None] = None
+    patient_id: Union[int, None] = None
+
+    @root_validator
+    def validate_ids_or_filter(cls, values):
+        filters = [
+            values.get(name) for name in ("start_from", "start_to", "patient_id")
+        ]
+        if values.get("ids") is not None:
+            if any(value is not None for value in filters):
+                raise ValueError("Select appointments by ids or by a filter, not both")
+            return values
+        if values.get("patient_id") is None and None in filters[:2]:
+            raise ValueError(
+                "Select appointments by ids, a patient_id, or start_from and start_to"
+            )
+        return values
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "start_from": "2023-06-25T09:00:00.000Z",
+                "start_to": "2023-06-25T13:00:00.000Z",
+            }
+        }
+
+
+class AppointmentOutcome(BaseModel):
+    id: int
+    status: Union[AppointmentStatus, None] = Field(
+        description="The new status, null if refused"
+    )
+    error: Union[str, None] = Field(
+        description="Why the appointment was left unchanged"
+    )
+
+
+class AppointmentConflict(BaseModel):
+    patient_id: int
+    appointment_id: int = Field(description="The appointment that starts first")
+    other_appointment_id: int = Field(description="The appointment starting during it")
+    overlap_start: datetime
+    overlap_end: datetime
+
+
+class PatientWithRelations(Patient):
+    """
+    A patient with the related resources asked for with include, fields that
+    were not asked for are left out of the response rather than sent as null
+    """
+    address: Union[Address, None] = Field(
+        None, description="The latest address of the patient, with include=address"
+    )
+    appointments: List[Appointment] = Field(
+        None,
+        description=(
+            "Upcoming, not cancelled, appointments soonest first, "
+            "with include=appointments"
+        ),
+    )
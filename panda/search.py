@@ -0,0 +1,179 @@
+"""Indexed patient search over name, NHS number and postcode.
+
+On SQLite, an FTS5 virtual table ``patients_search`` holds one row per patient
+(rowid = patient id). Triggers on ``patients`` and ``addresses`` keep it in
+sync, so every write path (crud, bulk loads, manual SQL) stays indexed without
+extra round trips from Python.
+
+On PostgreSQL, trigram GIN indexes back ``ILIKE`` lookups on the base tables.
+Other databases fall back to the same ``ILIKE`` query without an index.
+"""
+
+import re
+from typing import List
+
+from sqlalchemy import Integer, and_, event, func, or_, select, text, true
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.elements import ColumnElement
+
+from panda import models
+from panda.database import Base
+
+SEARCH_TABLE = "patients_search"
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_NHS_NUMBER_RE = re.compile(r"^\d[\d\s-]*$")
+
+
+def _postcode_terms_sql(column: str) -> str:
+    """
+    Indexes the compact postcode plus its outward and inward codes, so both
+    'TR72SS' and 'TR7 2SS' match whichever way the postcode was stored
+    """
+    compact = f"replace(upper({column}), ' ', '')"
+    return (
+        f"{compact} || ' ' || substr({compact}, 1, length({compact}) - 3)"
+        f" || ' ' || substr({compact}, -3)"
+    )
+
+
+_LATEST_POSTCODE_SQL = f"""
+    COALESCE((
+        SELECT {_postcode_terms_sql('a.postcode')} FROM addresses a
+        WHERE a.owner_type = 'patient' AND a.owner_id = p.id
+        ORDER BY a.id DESC LIMIT 1
+    ), '')
+"""
+
+_SQLITE_DDL = [
+    f"""
+    CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(
+        name, nhs_number, postcode,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """,
+    f"""
+    INSERT INTO {SEARCH_TABLE}(rowid, name, nhs_number, postcode)
+    SELECT p.id, p.name, p.nhs_number, {_LATEST_POSTCODE_SQL} FROM patients p
+    """,
+]
+
+_SQLITE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_patient_insert
+    AFTER INSERT ON patients BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, name, nhs_number, postcode)
+        VALUES (new.id, new.name, new.nhs_number, '');
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_patient_update
+    AFTER UPDATE OF name, nhs_number ON patients BEGIN
+        UPDATE {SEARCH_TABLE} SET name = new.name, nhs_number = new.nhs_number
+        WHERE rowid = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_patient_delete
+    AFTER DELETE ON patients BEGIN
+        DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_address_insert
+    AFTER INSERT ON addresses WHEN new.owner_type = 'patient' BEGIN
+        UPDATE {SEARCH_TABLE} SET postcode = {_postcode_terms_sql('new.postcode')}
+        WHERE rowid = new.owner_id;
+    END
+    """,
+]
+
+_POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_patients_name_trgm"
+    " ON patients USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_nhs_number_trgm"
+    " ON patients USING gin (nhs_number gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_addresses_postcode_trgm"
+    " ON addresses USING gin (replace(upper(postcode), ' ', '') gin_trgm_ops)",
+]
+
+
+def create_search_index(connection: Connection) -> None:
+    """Creates (and backfills) the search index if it is missing. Idempotent."""
+    if connection.dialect.name == "sqlite":
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {"name": SEARCH_TABLE},
+        ).first()
+        if not exists:
+            for statement in _SQLITE_DDL:
+                connection.execute(text(statement))
+        for statement in _SQLITE_TRIGGERS:
+            connection.execute(text(statement))
+    elif connection.dialect.name == "postgresql":
+        for statement in _POSTGRES_DDL:
+            connection.execute(text(statement))
+
+
+def drop_search_index(connection: Connection) -> None:
+    if connection.dialect.name == "sqlite":
+        connection.execute(text(f"DROP TABLE IF EXISTS {SEARCH_TABLE}"))
+
+
+@event.listens_for(Base.metadata, "after_create")
+def _after_create(target, connection: Connection, **kw) -> None:
+    create_search_index(connection)
+
+
+@event.listens_for(models.Patient.__table__, "after_drop")
+def _after_drop(target, connection: Connection, **kw) -> None:
+    # The triggers go with the table, the index rows would otherwise go stale
+    drop_search_index(connection)
+
+
+def tokenize(query: str) -> List[str]:
+    # Spaced or dashed NHS numbers, e.g. '452 440 8592', are a single term
+    if _NHS_NUMBER_RE.match(query.strip()):
+        return [re.sub(r"\D", "", query)]
+    return _TOKEN_RE.findall(query)
+
+
+def _fts_match(tokens: List[str]) -> str:
+    # Every token is a quoted prefix term, implicitly AND'ed by FTS5
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+def _ilike_term(token: str) -> ColumnElement:
+    postcodes = select(models.Address.owner_id).where(
+        and_(
+            models.Address.owner_type == "patient",
+            func.replace(func.upper(models.Address.postcode), " ", "").like(
+                f"%{token.upper()}%"
+            ),
+        )
+    )
+    return or_(
+        models.Patient.name.ilike(f"%{token}%"),
+        models.Patient.nhs_number.like(f"{token}%"),
+        models.Patient.id.in_(postcodes),
+    )
+
+
+def patient_search_filter(dialect_name: str, query: str) -> ColumnElement:
+    """
+    Returns a filter on models.Patient matching every token of the query
+    against name, NHS number or postcode
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return true()
+    if dialect_name == "sqlite":
+        match = (
+            text(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match")
+            .bindparams(match=_fts_match(tokens))
+            .columns(rowid=Integer)
+        )
+        return models.Patient.id.in_(match)
+    return and_(*(_ilike_term(token) for token in tokens))
@@ -0,0 +1,164 @@
+"""Daily appointment statistics rollup.
+
+``appointment_daily_stats`` holds one row per day with the number of
+appointments starting that day in each status. The crud writes and the
+missed sweeper add their change to the row in the same transaction as the
+appointment UPDATE, with an INSERT ... ON CONFLICT upsert, so the dashboard
+reads at most a row per day instead of aggregating the appointments table.
+Databases without the upsert get an UPDATE of each day, then an INSERT of
+the days it missed.
+
+Rebuild it from the appointments, e.g. after loading data with SQL:
+
+    python -m panda.stats rebuild
+"""
+import argparse
+from collections import defaultdict
+from datetime import date, datetime
+from typing import DefaultDict, Dict, Iterable, List, Tuple
+
+from sqlalchemy import (
+    Engine,
+    Table,
+    case,
+    create_engine,
+    delete,
+    func,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from panda import models
+from panda.core.config import settings
+from panda.enums import AppointmentStatus
+
+STATUS_COLUMNS = tuple(status.value for status in AppointmentStatus)
+COUNT_COLUMNS = ("total",) + STATUS_COLUMNS
+
+# {day: {column: change}}
+Deltas = DefaultDict[date, DefaultDict[str, int]]
+
+
+# The inserts with on_conflict_do_update
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def _update_then_insert(db: Session, table: Table, rows: List[Dict]) -> None:
+    for row in rows:
+        statement = (
+            update(table)
+            .where(table.c.day == row["day"])
+            .values({column: table.c[column] + row[column] for column in COUNT_COLUMNS})
+        )
+        if db.execute(statement).rowcount:
+            continue
+        try:
+            with db.begin_nested():
+                db.execute(insert(table), row)
+        except IntegrityError:
+            # Another transaction added the day since the UPDATE
+            db.execute(statement)
+
+
+def new_deltas() -> Deltas:
+    return defaultdict(lambda: defaultdict(int))
+
+
+def bump(db: Session, deltas: Deltas) -> None:
+    """Adds the deltas to the rollup in one statement, creating missing days"""
+    rows = [
+        {"day": day, **{column: changes.get(column, 0) for column in COUNT_COLUMNS}}
+        for day, changes in deltas.items()
+        if any(changes.values())
+    ]
+    if not rows:
+        return
+    table = models.AppointmentDailyStats.__table__
+    upsert = UPSERT_INSERTS.get(db.get_bind().dialect.name)
+    if upsert is None:
+        _update_then_insert(db, table, rows)
+        return
+    statement = upsert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.day],
+        set_={
+            column: table.c[column] + statement.excluded[column]
+            for column in COUNT_COLUMNS
+        },
+    )
+    db.execute(statement, rows)
+
+
+def created(db: Session, start_at: datetime) -> None:
+    deltas = new_deltas()
+    deltas[start_at.date()].update(total=1, scheduled=1)
+    bump(db, deltas)
+
+
+def transitions(db: Session, changes: Iterable[Tuple[datetime, str, str]]) -> None:
+    """Moves appointments between status counts, from (start_at, old, new) tuples"""
+    deltas = new_deltas()
+    for start_at, old, new in changes:
+        if old != new:
+            deltas[start_at.date()][old] -= 1
+            deltas[start_at.date()][new] += 1
+    bump(db, deltas)
+
+
+def rescheduled(
+    db: Session, old_start_at: datetime, old_status: str, start_at: datetime
+) -> None:
+    """An edit can move the appointment to another day, and makes it scheduled"""
+    deltas = new_deltas()
+    deltas[old_start_at.date()]["total"] -= 1
+    deltas[old_start_at.date()][old_status] -= 1
+    deltas[start_at.date()]["total"] += 1
+    deltas[start_at.date()][AppointmentStatus.SCHEDULED.value] += 1
+    bump(db, deltas)
+
+
+def rebuild(connection: Connection) -> None:
+    """Replaces the rollup with counts aggregated from the appointments table"""
+    table = models.AppointmentDailyStats.__table__
+    appointments = models.Appointment.__table__
+    day = func.date(appointments.c.start_at)
+    connection.execute(delete(table))
+    connection.execute(
+        insert(table).from_select(
+            ["day", *COUNT_COLUMNS],
+            select(
+                day,
+                func.count(),
+                *[
+                    func.sum(case((appointments.c.status == status, 1), else_=0))
+                    for status in STATUS_COLUMNS
+                ],
+            )
+            .where(appointments.c.start_at.is_not(None))
+            .group_by(day),
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PANDA appointment statistics")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--url", default=settings.SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args()
+    engine: Engine = create_engine(args.url)
+
+    with engine.begin() as connection:
+        rebuild(connection)
+        days = connection.scalar(
+            select(func.count()).select_from(models.AppointmentDailyStats)
+        )
+    print(f"Rebuilt appointment stats for {days} days")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Marks appointments that ended without being attended or cancelled as missed.
+
+The sweep runs on a background thread every MISSED_SWEEP_INTERVAL seconds,
+starting when the app does. Each chunk of MISSED_SWEEP_CHUNK_SIZE rows is a
+separate UPDATE and transaction, found through the (status, end_at) index, so
+requests writing to the table never wait long behind it. With several workers
+each runs its own sweeper; the UPDATE checks again that each row is still
+scheduled and ended, so a row cancelled or marked meanwhile is left alone and
+a row is marked once.
+"""
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from panda import crud, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def sweep_missed(session_factory: Callable[[], Session], chunk_size: int) -> int:
+    """Marks every overdue appointment as missed, returns how many were marked"""
+    now = datetime.now()  # As used by the attended guard
+    total = 0
+    with session_factory() as db:
+        while True:
+            marked = crud.mark_missed_appointments(db, now=now, limit=chunk_size)
+            total += marked
+            if marked < chunk_size:
+                break
+    if total:
+        metrics.registry.inc("panda_appointments_marked_missed_total", value=total)
+    return total
+
+
+class MissedAppointmentSweeper:
+    """Runs sweep_missed now and then every interval, until stopped"""
+
+    def __init__(
+        self, session_factory: Callable[[], Session], interval: float, chunk_size: int
+    ):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                sweep_missed(self.session_factory, self.chunk_size)
+            except Exception:  # pylint: disable=broad-except
+                # e.g. the database is locked, the next sweep picks the rows up
+                logger.exception("Missed appointment sweep failed")
+            if self._stopped.wait(self.interval):
+                return
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="missed-sweeper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
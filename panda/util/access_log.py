@@ -0,0 +1,110 @@
+"""Structured (JSON lines) access logging.
+
+Records are put on a queue by a QueueHandler and written by a QueueListener
+thread, so a request never waits on the log file. Successful responses can be
+sampled with ACCESS_LOG_SAMPLE_RATE, 4xx and 5xx responses are always logged.
+"""
+import json
+import logging
+import queue
+import random
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from panda import instrumentation
+
+# Fields of the access record, the rest of the LogRecord attributes are ignored
+ACCESS_FIELDS = ("method", "route", "status", "latency_ms", "db_ms", "db_statements")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (field, getattr(record, field))
+            for field in ACCESS_FIELDS
+            if hasattr(record, field)
+        )
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+def queue_logging(logger: logging.Logger, handler: logging.Handler) -> QueueListener:
+    """
+    Sends a logger's records through a queue to handler, which is only called
+    from the listener's thread. The listener still has to be started.
+    """
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    return QueueListener(log_queue, handler, respect_handler_level=True)
+
+
+def _level(status: int) -> int:
+    if status >= 500:
+        return logging.ERROR
+    if status >= 400:
+        return logging.WARNING
+    return logging.INFO
+
+
+class AccessLogMiddleware:
+    """ASGI middleware, logs one record per HTTP request once the response is sent"""
+
+    def __init__(self, app, logger: logging.Logger, sample_rate: float = 1.0):
+        self.app = app
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        stats = instrumentation.start_request()
+        status = 500  # If the app raises before starting the response
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.log(scope, status, time.perf_counter() - start, stats)
+
+    def log(
+        self, scope, status: int, latency: float, stats: instrumentation.RequestStats
+    ) -> None:
+        level = _level(status)
+        if level == logging.INFO and random.random() >= self.sample_rate:
+            return
+        if not self.logger.isEnabledFor(level):
+            return
+        # The router adds the matched route to the scope, the template keeps
+        # ids out of the log, e.g. /patients/{patient_id}
+        route = getattr(scope.get("route"), "path", None)
+        self.logger.log(
+            level,
+            "%s %s %s",
+            scope["method"],
+            route or "(no route)",
+            status,
+            extra={
+                "method": scope["method"],
+                "route": route,
+                "status": status,
+                "latency_ms": round(latency * 1000, 3),
+                "db_ms": round(stats.db_time * 1000, 3),
+                "db_statements": stats.statements,
+            },
+        )
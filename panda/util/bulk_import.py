@@ -0,0 +1,247 @@
+"""Streaming NDJSON/CSV parsing for bulk patient imports.
+
+The request body is read chunk by chunk and only one chunk of patients is
+held at a time. Per-row results are written to a spooled temporary file, which
+is streamed back once the body has been consumed, so memory stays flat
+whatever the size of the upload.
+"""
+
+import csv
+import json
+import tempfile
+from collections import deque
+from typing import (
+    IO,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
+
+from pydantic import ValidationError
+
+from panda.schemas import PatientCreate
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NDJSON_MEDIA_TYPES = (
+    NDJSON_MEDIA_TYPE,
+    "application/ndjson",
+    "application/jsonl",
+    "application/json-lines",
+)
+CSV_MEDIA_TYPES = ("text/csv",)
+
+# Spill results to disk once they pass 1MB
+SPOOL_MAX_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+Record = Tuple[int, Union[Dict[str, Any], str]]  # (row, record or parse error)
+ChunkResult = Tuple[Union[int, None], Union[str, None]]  # (id, error)
+
+
+async def _split_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer:
+        yield buffer.rstrip(b"\r")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Re-splits an arbitrary byte stream into lines, skipping blank ones"""
+    async for line in _split_lines(chunks):
+        if line.strip():
+            yield line
+
+
+async def iter_csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Re-splits an arbitrary byte stream into CSV records, skipping blank ones.
+    A quoted field may hold newlines, quotes in a field are doubled, so a
+    record ends at the first line break after an even number of quotes.
+    """
+    record: List[bytes] = []
+    quotes = 0
+    async for line in _split_lines(chunks):
+        if not record and not line.strip():
+            continue
+        record.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield b"\n".join(record)
+            record, quotes = [], 0
+    if record:
+        yield b"\n".join(record)
+
+
+class _Records:
+    """
+    What csv.reader reads from. Unlike a generator it can be read again once
+    emptied, so one reader parses every record of the stream as it arrives.
+    """
+
+    def __init__(self) -> None:
+        self.queue: Deque[str] = deque()
+
+    def __iter__(self) -> "_Records":
+        return self
+
+    def __next__(self) -> str:
+        if not self.queue:
+            raise StopIteration
+        return self.queue.popleft()
+
+
+def _decode(line: bytes) -> Union[str, None]:
+    """None for a line that isn't UTF-8, it is reported as that row's error"""
+    try:
+        return line.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def _undecodable(line: bytes) -> str:
+    return f"Could not decode as UTF-8: {line.decode('utf-8', errors='replace')}"
+
+
+async def _ndjson_records(lines: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    row = 0
+    async for raw_line in lines:
+        row += 1
+        line = _decode(raw_line)
+        if line is None:
+            yield row, _undecodable(raw_line)
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield row, f"Could not parse JSON: {line}"
+            continue
+        if not isinstance(record, dict):
+            yield row, f"Expected a JSON object: {line}"
+            continue
+        yield row, record
+
+
+async def _csv_records(records: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    source = _Records()
+    reader = csv.reader(source)
+    header: List[str] = []
+    row = 0
+    async for raw_record in records:
+        record = _decode(raw_record)
+        if not header:
+            if record is None:
+                # Without the header no row can be read
+                yield row, _undecodable(raw_record)
+                return
+            source.queue.append(record)
+            header = [name.strip() for name in next(reader)]
+            continue
+        row += 1
+        if record is None:
+            yield row, _undecodable(raw_record)
+            continue
+        source.queue.append(record)
+        values = next(reader)
+        if len(values) != len(header):
+            yield row, f"Expected {len(header)} columns, got {len(values)}: {record}"
+            continue
+        yield row, dict(zip(header, values))
+
+
+def record_parser(
+    content_type: str,
+) -> Callable[[AsyncIterator[bytes]], AsyncIterator[Record]]:
+    """Raises ValueError for content types other than NDJSON or CSV"""
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in NDJSON_MEDIA_TYPES:
+        return lambda chunks: _ndjson_records(iter_lines(chunks))
+    if media_type in CSV_MEDIA_TYPES:
+        return lambda chunks: _csv_records(iter_csv_records(chunks))
+    raise ValueError(content_type)
+
+
+def _write_result(out: IO[bytes], result: Dict[str, Any]) -> None:
+    out.write(json.dumps(result, default=str).encode() + b"\n")
+
+
+Pending = List[Tuple[int, Union[PatientCreate, str, List[Any]]]]
+
+
+def _validate(
+    record: Union[Dict[str, Any], str]
+) -> Union[PatientCreate, str, List[Any]]:
+    """The PatientCreate for a record, or the error to report for its row"""
+    if isinstance(record, str):
+        return record
+    try:
+        return PatientCreate(**record)
+    except ValidationError as exc:
+        return exc.errors()
+
+
+async def _flush(
+    pending: Pending,
+    create_chunk: Callable[[List[PatientCreate]], Awaitable[List[ChunkResult]]],
+    out: IO[bytes],
+) -> None:
+    """Creates the valid patients of a chunk, then writes every row's result"""
+    patients = [p for _, p in pending if isinstance(p, PatientCreate)]
+    created = iter(await create_chunk(patients) if patients else [])
+    for row, item in pending:
+        if not isinstance(item, PatientCreate):
+            _write_result(out, {"row": row, "status": "error", "detail": item})
+            continue
+        patient_id, error = next(created)
+        if error:
+            _write_result(out, {"row": row, "status": "error", "detail": error})
+        else:
+            _write_result(
+                out,
+                {
+                    "row": row,
+                    "status": "created",
+                    "id": patient_id,
+                    "nhs_number": item.nhs_number,
+                },
+            )
+
+
+async def import_patients(
+    records: AsyncIterator[Record],
+    create_chunk: Callable[[List[PatientCreate]], Awaitable[List[ChunkResult]]],
+    out: IO[bytes],
+    chunk_size: int,
+) -> None:
+    """
+    Validates records with the PatientCreate rules and hands them to
+    create_chunk in chunks, writing one NDJSON result per row, in row order
+    """
+    pending: Pending = []
+    async for row, record in records:
+        pending.append((row, _validate(record)))
+        if len(pending) >= chunk_size:
+            await _flush(pending, create_chunk, out)
+            pending = []
+    if pending:
+        await _flush(pending, create_chunk, out)
+
+
+def spool() -> IO[bytes]:
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+b")
+
+
+def iter_file(file: IO[bytes]) -> Iterator[bytes]:
+    file.seek(0)
+    while chunk := file.read(READ_SIZE):
+        yield chunk
@@ -1,14 +1,75 @@
-from typing import Union
+from datetime import datetime
+from typing import FrozenSet, Union
 
-from fastapi import Depends
+from fastapi import Depends, HTTPException, Query
 from typing_extensions import Annotated
 
+from panda.crud import ErrorsEng
+from panda.enums import AppointmentStatus, PatientInclude
+
 
 class CommonQueryParams:
-    def __init__(self, query: Union[str, None] = None, offset: int = 0, limit: int = 100):
+    def __init__(
+        self,
+        query: Union[str, None] = None,
+        offset: int = 0,
+        limit: int = 100,
+        cursor: Union[str, None] = None,
+    ):
         self.query = query
-        self.offset = offset
+        self.offset = offset  # Ignored when a cursor is given
         self.limit = limit
+        self.cursor = cursor
 
 
 CommonQuery = Annotated[CommonQueryParams, Depends()]
+
+
+class AppointmentFilterParams:
+    def __init__(
+        self,
+        start_from: Union[datetime, None] = Query(
+            None, description="Appointments starting at or after this time"
+        ),
+        start_to: Union[datetime, None] = Query(
+            None, description="Appointments starting before this time"
+        ),
+        status: Union[AppointmentStatus, None] = None,
+    ):
+        self.start_from = start_from
+        self.start_to = start_to
+        self.status = status
+
+    def dict(self) -> dict:
+        return {
+            "start_from": self.start_from,
+            "start_to": self.start_to,
+            "status": self.status,
+        }
+
+
+AppointmentFilters = Annotated[AppointmentFilterParams, Depends()]
+
+
+def patient_include_params(
+    include: Union[str, None] = Query(
+        None,
+        description=(
+            "Related resources to embed, a comma separated list of "
+            f"{PatientInclude.list()}"
+        ),
+    ),
+) -> FrozenSet[PatientInclude]:
+    if not include:
+        return frozenset()
+    try:
+        return frozenset(
+            PatientInclude(name.strip()) for name in include.split(",") if name.strip()
+        )
+    except ValueError:
+        raise HTTPException(400, detail=f"{ErrorsEng.INVALID_INCLUDE.value}{include}")
+
+
+PatientIncludeQuery = Annotated[
+    FrozenSet[PatientInclude], Depends(patient_include_params)
+]
@@ -0,0 +1,51 @@
+"""Strong ETags built from a row's id and version column.
+
+Every update bumps the row's version, so '"<id>-<version>"' changes whenever
+the representation does. The id is included so that a resource which can
+point at a different row, e.g. the latest address of a patient, also changes
+tag when it does.
+"""
+from typing import List, Union
+
+from fastapi import Response
+
+
+def make_etag(row_id: int, version: int) -> str:
+    return f'"{row_id}-{version}"'
+
+
+def _tags(header: str) -> List[str]:
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def if_none_match(header: Union[str, None], etag: str) -> bool:
+    """True if the client's copy is current, i.e. a 304 can be returned"""
+    if not header:
+        return False
+    # If-None-Match uses the weak comparison, W/ prefixes are ignored
+    tags = [tag[2:] if tag.startswith("W/") else tag for tag in _tags(header)]
+    return "*" in tags or etag in tags
+
+
+def if_match_versions(header: Union[str, None], row_id: int) -> Union[List[int], None]:
+    """
+    The row versions that satisfy an If-Match header, for a conditional update.
+    None means there is no precondition, an empty list that none can match.
+    """
+    if not header or _tags(header) == ["*"]:
+        return None
+    versions = []
+    for tag in _tags(header):
+        # If-Match uses the strong comparison, weak tags never match
+        tag_id, _, version = tag.strip('"').partition("-")
+        if tag.startswith('"') and tag_id == str(row_id) and version.isdigit():
+            versions.append(int(version))
+    return versions
+
+
+def set_etag(response: Response, row_id: int, version: int) -> None:
+    response.headers["ETag"] = make_etag(row_id, version)
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
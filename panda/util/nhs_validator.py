@@ -13,7 +13,22 @@ Finally, this number is subtracted from 11 to give the checksum in the range 1
 A checksum of 11 is represented by 0 in the final NHS number. If the checksum is 10 then the number is not valid.
 """
 
-from typing import List
+from enum import IntEnum
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+NHS_NUMBER_LENGTH = 10
+# Weights for the first nine digits, 10 down to 2
+CHECKSUM_WEIGHTS = np.arange(10, 1, -1, dtype=np.int64)
+
+
+class NhsNumberReason(IntEnum):
+    VALID = 0
+    BAD_LENGTH = 1
+    NON_NUMERIC = 2
+    CHECKSUM_10 = 3
+    MISMATCH = 4
 
 
 def is_valid_nhs_number(nhs_number: str) -> bool:
@@ -32,5 +47,57 @@ def is_valid_nhs_number(nhs_number: str) -> bool:
     for i, n in zip(digits, range(10, 1, -1)):
         total += i * n
 
-    checksum = 11 - (total % 11)
+    # A checksum of 11 is represented by 0, a checksum of 10 is never valid
+    checksum = (11 - (total % 11)) % 11
     return checksum == digits[-1]
+
+
+def check_digits(bodies: np.ndarray) -> np.ndarray:
+    """
+    Check digits of an array of nine digit NHS number bodies (as integers),
+    10 where the body can't be given a valid check digit.
+    """
+    digits = (
+        bodies.astype(np.int64)[:, None]
+        // 10 ** np.arange(8, -1, -1, dtype=np.int64)
+        % 10
+    )
+    return (11 - (digits @ CHECKSUM_WEIGHTS) % 11) % 11
+
+
+def validate_nhs_numbers(
+    nhs_numbers: Iterable[str],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Validates a batch of NHS numbers at once, without raising.
+
+    The numbers are laid out as a matrix of digits so the checksum of every
+    number is a single weighted dot product. Returns a boolean mask of valid
+    numbers and an array of NhsNumberReason codes, in input order.
+    """
+    # One column more than needed, so over-long numbers keep a wrong length
+    numbers = np.asarray(list(nhs_numbers), dtype=f"U{NHS_NUMBER_LENGTH + 1}")
+    reasons = np.full(len(numbers), NhsNumberReason.VALID, dtype=np.int8)
+    if not len(numbers):
+        return reasons == NhsNumberReason.VALID, reasons
+
+    bad_length = np.char.str_len(numbers) != NHS_NUMBER_LENGTH
+    # Unicode code points, one row per number, '0' is 48
+    digits = (
+        numbers.view(np.uint32).reshape(len(numbers), NHS_NUMBER_LENGTH + 1)[
+            :, :NHS_NUMBER_LENGTH
+        ].astype(np.int64)
+        - ord("0")
+    )
+    non_numeric = ~bad_length & ((digits < 0) | (digits > 9)).any(axis=1)
+
+    checksums = (11 - (digits[:, :-1] @ CHECKSUM_WEIGHTS) % 11) % 11
+    checkable = ~bad_length & ~non_numeric
+    checksum_10 = checkable & (checksums == 10)
+    mismatch = checkable & ~checksum_10 & (checksums != digits[:, -1])
+
+    reasons[mismatch] = NhsNumberReason.MISMATCH
+    reasons[checksum_10] = NhsNumberReason.CHECKSUM_10
+    reasons[non_numeric] = NhsNumberReason.NON_NUMERIC
+    reasons[bad_length] = NhsNumberReason.BAD_LENGTH
+    return reasons == NhsNumberReason.VALID, reasons
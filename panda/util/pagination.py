@@ -0,0 +1,73 @@
+"""Opaque cursor tokens for keyset pagination.
+
+A cursor holds the sort key of the last row on a page, e.g. ``(id,)`` for
+patients or ``(start_at, id)`` for appointments. The next page is then fetched
+with ``WHERE (key) > (cursor)`` which uses the index instead of scanning and
+discarding ``offset`` rows.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, List, Mapping, Optional, Sequence
+
+from fastapi import Response
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    """A key value is an int, a str or a datetime, anything else is rejected"""
+    if isinstance(value, dict) and list(value) == ["dt"]:
+        return datetime.fromisoformat(value["dt"])
+    if isinstance(value, (int, str)) and not isinstance(value, bool):
+        return value
+    raise ValueError(f"Malformed cursor value: {value!r}")
+
+
+def encode_cursor(*values: Any) -> str:
+    payload = json.dumps([_encode_value(v) for v in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, length: int) -> List[Any]:
+    """Raises ValueError if the token is malformed or has the wrong key length"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != length:
+            raise ValueError(f"Malformed cursor: {cursor}")
+        return [_decode_value(v) for v in values]
+    except (binascii.Error, KeyError, TypeError, UnicodeDecodeError) as exc:
+        raise ValueError(f"Malformed cursor: {cursor}") from exc
+
+
+def next_cursor(
+    rows: Sequence[Any], limit: int, key_columns: Sequence[Any]
+) -> Optional[str]:
+    """Builds the cursor from the key columns of the last ORM object or row mapping"""
+    # A short page means there is nothing left to fetch
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    if isinstance(last, Mapping):
+        return encode_cursor(*(last[column.key] for column in key_columns))
+    return encode_cursor(*(getattr(last, column.key) for column in key_columns))
+
+
+def set_next_cursor(
+    response: Response,
+    rows: Sequence[Any],
+    limit: int,
+    key_columns: Sequence[Any],
+) -> None:
+    cursor = next_cursor(rows, limit, key_columns)
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
@@ -0,0 +1,72 @@
+"""UK postcode validation and normalisation.
+
+A postcode is an outward code (area and district, e.g. 'TR7') and a three
+character inward code (sector and unit, e.g. '2SS'). The inward code is
+always a digit and two letters, so the split is taken from the end of the
+compact postcode, whatever spacing it was given with.
+
+Postcodes are stored in the canonical spaced form, 'TR7 2SS'. Canonical
+postcodes are cached, addresses of a household or a street repeat them.
+"""
+import re
+from functools import lru_cache
+from typing import Iterable, List, NamedTuple, Optional
+
+INWARD_LENGTH = 3
+POSTCODE_CACHE_SIZE = 65536
+
+# The government's postcode regex, for upper case postcodes without spaces,
+# with the alternation grouped so that both ends apply to every branch
+_POSTCODE_RE = re.compile(
+    r"GIR0AA"
+    r"|(?:[A-Z][0-9]{1,2}|[A-Z][A-HJ-Y][0-9]{1,2}"
+    r"|[A-Z][0-9][A-Z]|[A-Z][A-HJ-Y][0-9][A-Z]?)"
+    r"[0-9][A-Z]{2}"
+)
+_NON_ALPHANUMERIC_RE = re.compile(r"[^A-Za-z0-9]")
+
+
+class Postcode(NamedTuple):
+    outward: str
+    inward: str
+
+    def __str__(self) -> str:
+        return f"{self.outward} {self.inward}"
+
+
+@lru_cache(maxsize=POSTCODE_CACHE_SIZE)
+def canonical_postcode(value: str) -> Optional[str]:
+    """
+    The canonical form of a postcode, e.g. ' tr7-2ss' is 'TR7 2SS', None if
+    it isn't valid
+    """
+    compact = _NON_ALPHANUMERIC_RE.sub("", value).upper()
+    if _POSTCODE_RE.fullmatch(compact) is None:
+        return None
+    return f"{compact[:-INWARD_LENGTH]} {compact[-INWARD_LENGTH:]}"
+
+
+def parse_postcode(value: str) -> Optional[Postcode]:
+    """Splits a postcode into its outward and inward codes, None if it isn't valid"""
+    canonical = canonical_postcode(value)
+    if canonical is None:
+        return None
+    outward, inward = canonical.split(" ")
+    return Postcode(outward, inward)
+
+
+def normalise_postcode(value: str) -> str:
+    """The canonical form of a postcode, raises ValueError if it isn't valid"""
+    canonical = canonical_postcode(value)
+    if canonical is None:
+        raise ValueError(f"Could not parse post code: {value}")
+    return canonical
+
+
+def normalise_postcodes(values: Iterable[str]) -> List[Optional[str]]:
+    """
+    Normalises a batch of postcodes at once, without raising, e.g. for an
+    import. Returns the canonical postcodes in input order, None for the
+    invalid ones.
+    """
+    return [canonical_postcode(value) for value in values]
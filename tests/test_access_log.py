@@ -0,0 +1,61 @@
+import json
+import logging
+from typing import Tuple
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from panda.util.access_log import AccessLogMiddleware, JsonFormatter
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_client(sample_rate: float) -> Tuple[TestClient, ListHandler]:
+    logger = logging.getLogger(f"panda.access.test.{sample_rate}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int):
+        if item_id == 0:
+            raise HTTPException(404)
+        return {"id": item_id}
+
+    app.add_middleware(AccessLogMiddleware, logger=logger, sample_rate=sample_rate)
+    return TestClient(app), handler
+
+
+def test_access_record_uses_route_template():
+    """
+    Test that access records carry the route template, status and timings as JSON fields
+    """
+    client, handler = make_client(sample_rate=1.0)
+    client.get("/items/42")
+    entry = json.loads(JsonFormatter().format(handler.records[0]))
+    assert entry["route"] == "/items/{item_id}"
+    assert entry["method"] == "GET"
+    assert entry["status"] == 200
+    assert entry["latency_ms"] >= 0
+    assert entry["db_statements"] == 0
+
+
+def test_errors_are_logged_when_sampled_out():
+    """
+    Test that sampling drops successful requests but never errors
+    """
+    client, handler = make_client(sample_rate=0.0)
+    client.get("/items/42")
+    client.get("/items/0")
+    assert [record.status for record in handler.records] == [404]
+    assert handler.records[0].levelno == logging.WARNING
@@ -0,0 +1,79 @@
+import asyncio
+from datetime import date
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from panda import async_crud, models
+from panda.enums import Sex
+from panda.schemas import PatientCreate
+
+
+@pytest.fixture(name="db_path")
+def fixture_db_path(tmp_path) -> str:
+    """ Returns the path of a fresh database with the tables created """
+    path = f"{tmp_path}/panda_async_test.db"
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    return path
+
+
+@pytest.fixture(name="valid_patient")
+def valid_patient() -> PatientCreate:
+    """ Returns a valid patient create object"""
+    return PatientCreate(
+        nhs_number="350 416 5898",
+        name="David Winch",
+        dob=date(1988, 12, 25),
+        sex=Sex.MALE,
+    )
+
+
+def test_async_session_round_trip(db_path: str, valid_patient: PatientCreate):
+    """
+    Test creating and reading a patient through an AsyncSession
+    """
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        session_local = async_sessionmaker(engine, expire_on_commit=False)
+        async with session_local() as db:
+            created = await async_crud.create_patient(db=db, patient=valid_patient)
+        # Overlap lookups from separate sessions, as concurrent requests would
+        async with session_local() as db_one, session_local() as db_two:
+            found = await asyncio.gather(
+                async_crud.get_patient_by_id(db=db_one, patient_id=created.id),
+                async_crud.get_patients(db=db_two, query="winch"),
+            )
+            with pytest.raises(HTTPException) as execinfo:
+                await async_crud.get_patient_by_id(db=db_one, patient_id=999999999)
+        await engine.dispose()
+        return created, found, execinfo.value
+
+    created, (by_id, by_query), error = asyncio.run(scenario())
+    assert by_id.nhs_number == created.nhs_number == "3504165898"
+    assert [p.id for p in by_query] == [created.id]
+    assert error.status_code == 403
+
+
+def test_sync_session_runs_in_threadpool(db_path: str, valid_patient: PatientCreate):
+    """
+    Test that the awaitable crud functions also accept a sync Session
+    """
+    engine = create_engine(
+        f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
+    )
+    db = sessionmaker(bind=engine)()
+
+    async def scenario():
+        created = await async_crud.create_patient(db=db, patient=valid_patient)
+        return await async_crud.get_patient_by_nhs_number(
+            db=db, nhs_number=created.nhs_number
+        )
+
+    assert asyncio.run(scenario()).name == "David Winch"
+    db.close()
+    engine.dispose()
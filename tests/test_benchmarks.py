@@ -0,0 +1,48 @@
+from benchmarks import run
+from panda.util.nhs_validator import validate_nhs_numbers
+
+
+def _report(**scenario) -> dict:
+    result = {"requests_per_sec": 100.0, "p95_ms": 10.0, "queries_per_request": 2.0}
+    result.update(scenario)
+    return {"scenarios": {"patient_by_id": result}}
+
+
+def test_percentile_nearest_rank():
+    """
+    Test that percentiles are the nearest ranked value, not interpolated
+    """
+    values = [float(value) for value in range(1, 101)]
+    assert run.percentile(values, 0.50) == 50.0
+    assert run.percentile(values, 0.99) == 99.0
+    assert run.percentile([7.0], 0.95) == 7.0
+    assert run.percentile([], 0.95) == 0.0
+
+
+def test_compare_flags_regressions_beyond_tolerance():
+    """
+    Test that noise within the tolerance passes, and slower, heavier scenarios don't
+    """
+    baseline = _report()
+    assert not run.compare(
+        _report(requests_per_sec=85.0, p95_ms=11.5), baseline, tolerance=0.2
+    )
+    assert not run.compare(
+        {"scenarios": {"mixed": baseline["scenarios"]["patient_by_id"]}}, baseline
+    )
+
+    regressions = run.compare(
+        _report(requests_per_sec=70.0, p95_ms=13.0, queries_per_request=3.0), baseline
+    )
+    assert len(regressions) == 3
+    assert regressions[0] == "patient_by_id: 70.0 requests/sec, baseline 100.0"
+
+
+def test_seeded_nhs_numbers_are_valid_and_distinct():
+    """
+    Test that the NHS numbers the benchmark seeds have valid check digits and
+    no repeats
+    """
+    numbers = run.nhs_numbers(1000)
+    valid, _ = validate_nhs_numbers(numbers)
+    assert valid.all() and len(set(numbers)) == 1000
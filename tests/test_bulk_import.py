@@ -0,0 +1,123 @@
+import asyncio
+import io
+import json
+from typing import AsyncIterator, List
+
+import pytest
+
+from panda.util import bulk_import
+
+
+async def chunked(body: bytes, size: int) -> AsyncIterator[bytes]:
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+def run_import(body: bytes, content_type: str, chunk_size: int = 2) -> List[dict]:
+    """ Runs an import with a fake chunk insert, returning the per-row results """
+    chunks: List[list] = []
+
+    async def create_chunk(patients):
+        chunks.append(patients)
+        return [(i, None) for i, _ in enumerate(patients, 1)]
+
+    out = io.BytesIO()
+    records = bulk_import.record_parser(content_type)(chunked(body, 5))
+    asyncio.run(bulk_import.import_patients(records, create_chunk, out, chunk_size))
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_ndjson_import_results_are_in_row_order():
+    """
+    Test that valid and invalid NDJSON rows are reported in row order
+    """
+    body = b"\n".join(
+        [
+            b'{"nhs_number": "4609571471", "name": "a", '
+            b'"dob": "1988-12-25", "sex": "Male"}',
+            b'{"nhs_number": "4609571472", "name": "b", '
+            b'"dob": "1988-12-25", "sex": "Male"}',
+            b'not json',
+            b'',
+            b'{"nhs_number": "4524408592", "name": "c", '
+            b'"dob": "1988-12-25", "sex": "Female"}',
+        ]
+    )
+    results = run_import(body, "application/x-ndjson")
+    assert [r["row"] for r in results] == [1, 2, 3, 4]
+    assert [r["status"] for r in results] == ["created", "error", "error", "created"]
+    assert results[3]["nhs_number"] == "4524408592"
+
+
+def test_csv_import():
+    """
+    Test that CSV rows are matched to the header and short rows are rejected
+    """
+    body = (
+        b'nhs_number,name,dob,sex\r\n'
+        b'452 440 8592,"Winch, David",1988-12-25,Male\r\n'
+        b'4959181745,Short Row\r\n'
+    )
+    results = run_import(body, "text/csv; charset=utf-8")
+    assert results[0] == {
+        "row": 1,
+        "status": "created",
+        "id": 1,
+        "nhs_number": "4524408592",
+    }
+    assert results[1]["status"] == "error"
+
+
+def test_csv_quoted_fields_can_hold_newlines():
+    """
+    Test that a quoted field spanning lines is read as one row
+    """
+    body = (
+        b'nhs_number,name,dob,sex\r\n'
+        b'4524408592,"Winch,\r\n\r\n""David""",1988-12-25,Male\r\n'
+        b'\r\n'
+        b'4959181745,Short Row\r\n'
+    )
+    chunks: List[list] = []
+
+    async def create_chunk(patients):
+        chunks.append(patients)
+        return [(i, None) for i, _ in enumerate(patients, 1)]
+
+    records = bulk_import.record_parser("text/csv")(chunked(body, 5))
+    asyncio.run(bulk_import.import_patients(records, create_chunk, io.BytesIO(), 2))
+    assert [patient.name for patient in chunks[0]] == ['Winch,\n\n"David"']
+    results = run_import(body, "text/csv")
+    assert [r["row"] for r in results] == [1, 2]
+    assert [r["status"] for r in results] == ["created", "error"]
+
+
+def test_undecodable_rows_are_reported():
+    """
+    Test that rows which aren't UTF-8 are reported as errors, not failing the import
+    """
+    valid = (
+        b'{"nhs_number": "4524408592", "name": "c", '
+        b'"dob": "1988-12-25", "sex": "Female"}'
+    )
+    body = b"\n".join([b'{"name": "\xff"}', valid])
+    results = run_import(body, "application/x-ndjson")
+    assert [r["status"] for r in results] == ["error", "created"]
+    assert results[0]["detail"].startswith("Could not decode as UTF-8")
+
+    body = (
+        b"nhs_number,name,dob,sex\n"
+        b"4959181745,Caf\xe9,1988-12-25,Male\n"
+        b"4524408592,c,1988-12-25,Male\n"
+    )
+    results = run_import(body, "text/csv")
+    assert [r["status"] for r in results] == ["error", "created"]
+
+
+def test_unsupported_content_type():
+    """
+    Test that only NDJSON and CSV are accepted
+    """
+    with pytest.raises(ValueError):
+        bulk_import.record_parser("application/xml")
@@ -0,0 +1,84 @@
+import time
+
+from panda.cache import LocalBackend, PatientCache
+
+PATIENT = {
+    "nhs_number": "4609571471",
+    "name": "David Winch",
+    "dob": "1988-12-25",
+    "sex": "Male",
+    "id": 1,
+    "created_at": "2023-06-23T10:00:00",
+}
+
+
+def test_cache_by_id_and_nhs_number():
+    """
+    Test that a cached patient is found by either key and counted as a hit
+    """
+    cache = PatientCache(LocalBackend(max_size=10, ttl=60))
+    assert cache.get_by_id(1) is None
+    cache.set(PATIENT)
+    assert cache.get_by_id(1) == PATIENT
+    assert cache.get_by_nhs_number("4609571471") == PATIENT
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_invalidation():
+    """
+    Test that invalidating a patient removes both keys
+    """
+    cache = PatientCache(LocalBackend(max_size=10, ttl=60))
+    cache.set(PATIENT)
+    cache.invalidate(1, "4609571471")
+    assert cache.get_by_id(1) is None
+    assert cache.get_by_nhs_number("4609571471") is None
+
+
+def test_lru_eviction():
+    """
+    Test that the least recently used entry is evicted when the cache is full
+    """
+    backend = LocalBackend(max_size=2, ttl=60)
+    backend.set("a", {"id": 1})
+    backend.set("b", {"id": 2})
+    backend.get("a")
+    backend.set("c", {"id": 3})
+    assert backend.get("b") is None
+    assert backend.get("a") == {"id": 1}
+    assert backend.evictions == 1
+
+
+def test_ttl_expiry():
+    """
+    Test that entries expire after the TTL
+    """
+    backend = LocalBackend(max_size=2, ttl=0.01)
+    backend.set("a", {"id": 1})
+    time.sleep(0.02)
+    assert backend.get("a") is None
+    assert len(backend) == 0
+
+
+def test_disabled_cache():
+    """
+    Test that a cache without a backend always misses
+    """
+    cache = PatientCache(None)
+    cache.set(PATIENT)
+    assert cache.get_by_id(1) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_nhs_number_follows_id_entry():
+    """
+    Test that an old NHS number misses once its patient is re-cached with a new one
+    """
+    cache = PatientCache(LocalBackend(max_size=10, ttl=60))
+    cache.set(PATIENT)
+    cache.invalidate(1)
+    assert cache.get_by_nhs_number("4609571471") is None
+    cache.set({**PATIENT, "nhs_number": "4524408592"})
+    assert cache.get_by_nhs_number("4609571471") is None
+    assert cache.get_by_nhs_number("4524408592")["id"] == 1
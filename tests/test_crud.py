@@ -1,16 +1,26 @@
-from datetime import date
+from datetime import date, datetime, timedelta
 from typing import List
+from unittest.mock import patch
 
 import pytest
 from faker import Faker
 from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session, declarative_base, sessionmaker
 
-from panda import crud, models
-from panda.enums import AddressOwnerType, Sex
+from panda import crud, instrumentation, models, schemas, stats, sweeper
+from panda.cache import patient_cache
+from panda.enums import (
+    AddressOwnerType,
+    AppointmentStatus,
+    PatientInclude,
+    Sex,
+    StatsPeriod,
+)
 from panda.models import Address, Appointment, Patient
-from panda.schemas import AddressCreate, PatientCreate
+from panda.schemas import AddressCreate, AppointmentCreate, PatientCreate
+from panda.util import pagination
 
 Faker.seed(0)
 fake: Faker = Faker("en-GB")
@@ -21,7 +31,9 @@ engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}  # check_same_thread required for SQLite
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
 
 Base = declarative_base()()
 
@@ -41,10 +53,13 @@ if engine.dialect.has_table(engine.connect(), "addresses"):
     Address.__table__.drop(engine)
 if engine.dialect.has_table(engine.connect(), "appointments"):
     Appointment.__table__.drop(engine)
+if engine.dialect.has_table(engine.connect(), "appointment_daily_stats"):
+    models.AppointmentDailyStats.__table__.drop(engine)
 
 # Create the tables from out models
 db: Session = get_db()
 models.Base.metadata.create_all(bind=engine)
+patient_cache.clear()
 
 @pytest.fixture(name="valid_nhs_numbers")
 def fixture_valid_nhs_numbers() -> List[str]:
@@ -114,6 +129,12 @@ def valid_address() -> AddressCreate:
     )
 
 
+@pytest.fixture(name="count_queries")
+def fixture_count_queries():
+    """ Returns a context manager whose stats count the statements run inside it """
+    return instrumentation.track_statements
+
+
 def test_create_patient(valid_patient: PatientCreate):
     """
     Test creating a patient with valid values and NHS number which isn't in the DB
@@ -167,3 +188,864 @@ def test_add_patient_address_for_nonexistent_patient(valid_address: AddressCreat
     with pytest.raises(HTTPException) as execinfo:
         crud.create_patient_address(db=get_db(), address=valid_address, patient_id=999999999)
     assert execinfo.value.status_code == 403
+
+
+def test_get_patients_cursor_pagination(valid_nhs_numbers: List[str]):
+    """
+    Test that walking the cursor returns the same patients as offset paging
+    """
+    for nhs_number in valid_nhs_numbers:
+        crud.create_patient(db=get_db(), patient=PatientCreate(
+            nhs_number=nhs_number,
+            name=fake.name(),
+            dob=fake.date_of_birth(),
+            sex=fake.enum(Sex),
+        ))
+    all_ids = [p.id for p in crud.get_patients(db=get_db(), query=None, limit=1000)]
+
+    cursor_ids: List[int] = []
+    cursor = None
+    while True:
+        page = crud.get_patients(db=get_db(), query=None, limit=3, cursor=cursor)
+        cursor_ids.extend(p.id for p in page)
+        cursor = pagination.next_cursor(page, 3, crud.PATIENT_CURSOR_KEY)
+        if not cursor:
+            break
+    assert cursor_ids == all_ids
+
+
+def test_get_appointments_invalid_cursor():
+    """
+    Test that a malformed cursor is rejected
+    """
+    with pytest.raises(HTTPException) as execinfo:
+        crud.get_appointments(db=get_db(), cursor="not-a-cursor")
+    assert execinfo.value.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "values", [[[1]], [{"id": 1}], [True], [None], [1.5], [{"dt": 1}], [{"dt": "x"}]]
+)
+def test_get_patients_cursor_with_non_scalar_key(values: list):
+    """
+    Test that a well formed cursor holding something other than a key value is
+    rejected, rather than reaching the database
+    """
+    cursor = pagination.encode_cursor(*values)
+    with pytest.raises(HTTPException) as execinfo:
+        crud.get_patients(db=get_db(), query=None, cursor=cursor)
+    assert execinfo.value.status_code == 400
+
+
+def test_cursor_round_trip():
+    """
+    Test that datetimes and ids survive encoding a cursor
+    """
+    start_at = datetime(2023, 6, 25, 10, 0)
+    cursor = pagination.encode_cursor(start_at, 42)
+    assert pagination.decode_cursor(cursor, 2) == [start_at, 42]
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(cursor, 1)
+
+
+def test_search_patients(valid_patient: PatientCreate, valid_address: AddressCreate):
+    """
+    Test that patients can be found by name, NHS number and postcode
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    for query in [
+        "david win",
+        "350 416 5898",
+        "3504165",
+        "TR7 2SS",
+        "tr72ss",
+        "Winch TR7",
+    ]:
+        results = crud.get_patients(db=get_db(), query=query)
+        assert patient.id in [p.id for p in results], query
+    assert crud.get_patients(db=get_db(), query="Winch TR9") == []
+
+
+def test_search_index_follows_updates_and_deletes():
+    """
+    Test that the search index is kept in sync when a patient changes or is removed
+    """
+    patient = crud.create_patient(db=get_db(), patient=PatientCreate(
+        nhs_number="9434765919",
+        name="Searchable Person",
+        dob=fake.date_of_birth(),
+        sex=fake.enum(Sex),
+    ))
+    assert [p.id for p in crud.get_patients(db=get_db(), query="searchable")] == [
+        patient.id
+    ]
+
+    crud.update_patient(db=get_db(), patient_id=int(patient.id), patient=PatientCreate(
+        nhs_number="9434765919",
+        name="Renamed Person",
+        dob=fake.date_of_birth(),
+        sex=fake.enum(Sex),
+    ))
+    assert crud.get_patients(db=get_db(), query="searchable") == []
+    assert [p.id for p in crud.get_patients(db=get_db(), query="renamed")] == [
+        patient.id
+    ]
+
+    crud.delete_patient(db=get_db(), patient_id=int(patient.id))
+    assert crud.get_patients(db=get_db(), query="renamed") == []
+
+
+def test_create_patients_in_bulk(valid_patient: PatientCreate):
+    """
+    Test that a chunk insert reports existing and repeated NHS numbers per row
+    """
+    new_patient = PatientCreate(
+        nhs_number="9000000009",
+        name=fake.name(),
+        dob=fake.date_of_birth(),
+        sex=fake.enum(Sex),
+    )
+    results = crud.create_patients(
+        db=get_db(), patients=[valid_patient, new_patient, new_patient]
+    )
+    assert results[0][0] is None and results[0][1].startswith(
+        crud.ErrorsEng.PATIENT_ALREADY_EXISTS.value
+    )
+    assert results[1][1] is None
+    assert (
+        crud.get_patient_by_nhs_number(db=get_db(), nhs_number="9000000009").id
+        == results[1][0]
+    )
+    assert results[2][0] is None and results[2][1].startswith(
+        crud.ErrorsEng.PATIENT_ALREADY_EXISTS.value
+    )
+
+
+def test_create_patients_rechecks_after_a_race(valid_patient: PatientCreate):
+    """
+    Test that a patient added between the duplicate check and the INSERT is
+    reported as existing, and the rest of the chunk is still inserted
+    """
+    new_patient = PatientCreate(
+        nhs_number="4857773457",
+        name=fake.name(),
+        dob=fake.date_of_birth(),
+        sex=fake.enum(Sex),
+    )
+    # The first check misses valid_patient, as if it was added just after
+    with patch.object(
+        crud, "_existing_nhs_numbers", side_effect=[set(), {valid_patient.nhs_number}]
+    ):
+        results = crud.create_patients(
+            db=get_db(), patients=[valid_patient, new_patient]
+        )
+    assert results[0][0] is None
+    assert results[0][1].startswith(crud.ErrorsEng.PATIENT_ALREADY_EXISTS.value)
+    assert results[1][1] is None
+    db_patient = crud.get_patient_by_nhs_number(db=get_db(), nhs_number="4857773457")
+    assert db_patient.id == results[1][0]
+
+
+def test_patients_export_query_filters_on_created_at():
+    """
+    Test that the export query selects the API fields within the created_at range
+    """
+    db = get_db()
+    rows = db.execute(crud.patients_export_query()).mappings().all()
+    assert list(rows[0].keys()) == [
+        "nhs_number",
+        "name",
+        "dob",
+        "sex",
+        "id",
+        "created_at",
+    ]
+    assert [row["id"] for row in rows] == sorted(row["id"] for row in rows)
+
+    middle = rows[len(rows) // 2]["created_at"]
+    before = db.execute(crud.patients_export_query(created_to=middle)).all()
+    after = db.execute(crud.patients_export_query(created_from=middle)).all()
+    assert len(before) + len(after) == len(rows)
+    assert len(after) >= 1
+
+
+def test_cached_patient_is_invalidated_on_update(valid_patient: PatientCreate):
+    """
+    Test that cached reads are served from the cache until the patient is updated
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    patient_cache.invalidate(int(patient.id), valid_patient.nhs_number)
+
+    hits = patient_cache.hits
+    assert (
+        crud.get_cached_patient(db=get_db(), patient_id=int(patient.id))["name"]
+        == "David Winch"
+    )
+    assert (
+        crud.get_cached_patient_by_nhs_number(
+            db=get_db(), nhs_number=valid_patient.nhs_number
+        )["id"]
+        == patient.id
+    )
+    assert patient_cache.hits == hits + 1
+
+    renamed = valid_patient.copy(update={"name": "David Renamed"})
+    crud.update_patient(db=get_db(), patient_id=int(patient.id), patient=renamed)
+    assert (
+        crud.get_cached_patient(db=get_db(), patient_id=int(patient.id))["name"]
+        == "David Renamed"
+    )
+    crud.update_patient(db=get_db(), patient_id=int(patient.id), patient=valid_patient)
+
+
+def test_update_patient_to_existing_nhs_no(valid_patient: PatientCreate):
+    """
+    Test that taking another patient's NHS number is rejected by the unique constraint
+    """
+    other = crud.create_patient(db=get_db(), patient=PatientCreate(
+        nhs_number="9449306060",
+        name=fake.name(),
+        dob=fake.date_of_birth(),
+        sex=fake.enum(Sex),
+    ))
+    with pytest.raises(HTTPException) as execinfo:
+        crud.update_patient(
+            db=get_db(), patient_id=int(other.id), patient=valid_patient
+        )
+    assert execinfo.value.detail.startswith(crud.ErrorsEng.NHS_NUMBER_CONFLICT.value)
+
+    with pytest.raises(HTTPException) as execinfo:
+        crud.update_patient(db=get_db(), patient_id=999999, patient=valid_patient)
+    assert execinfo.value.detail.startswith(crud.ErrorsEng.NO_PATIENT_FOR_ID.value)
+
+
+def test_appointment_state_transitions(valid_patient: PatientCreate):
+    """
+    Test that conditional updates cancel/attend once, and report why they were refused
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    start_at = datetime(2999, 1, 1, 10).astimezone()
+    appointment = AppointmentCreate(
+        patient_id=patient.id, start_at=start_at, end_at=start_at.replace(hour=11)
+    )
+
+    attended = crud.create_appointment(db=get_db(), appointment=appointment)
+    db_attended = crud.mark_appointment_attended(
+        db=get_db(), appointment_id=attended.id
+    )
+    assert (db_attended.attended_at is not None, db_attended.status) == (
+        True,
+        "attended",
+    )
+    with pytest.raises(HTTPException) as execinfo:
+        crud.cancel_appointment(db=get_db(), appointment_id=attended.id)
+    assert execinfo.value.detail.startswith(crud.ErrorsEng.APPT_ALREADY_ATTENDED.value)
+
+    later = AppointmentCreate(
+        patient_id=patient.id,
+        start_at=start_at.replace(hour=12),
+        end_at=start_at.replace(hour=13),
+    )
+    cancelled = crud.create_appointment(db=get_db(), appointment=later)
+    db_cancelled = crud.cancel_appointment(db=get_db(), appointment_id=cancelled.id)
+    assert (db_cancelled.is_cancelled, db_cancelled.status) == (True, "cancelled")
+    with pytest.raises(HTTPException) as execinfo:
+        crud.cancel_appointment(db=get_db(), appointment_id=cancelled.id)
+    assert execinfo.value.detail.startswith(crud.ErrorsEng.APPT_ALREADY_CANCELLED.value)
+    with pytest.raises(HTTPException) as execinfo:
+        crud.mark_appointment_attended(db=get_db(), appointment_id=cancelled.id)
+    assert execinfo.value.detail.startswith(
+        crud.ErrorsEng.CANNOT_MARK_CANCELLED_APPT_ATTENDED.value
+    )
+
+    with pytest.raises(HTTPException) as execinfo:
+        crud.cancel_appointment(db=get_db(), appointment_id=999999)
+    assert execinfo.value.detail.startswith(crud.ErrorsEng.NO_APPT_FOR_ID.value)
+
+
+def test_update_patient_if_match(valid_patient: PatientCreate):
+    """
+    Test that updates bump the version, and a stale If-Match version is refused with a
+    412
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    version = int(patient.version)
+    updated = crud.update_patient(
+        db=get_db(),
+        patient_id=int(patient.id),
+        patient=valid_patient,
+        versions=[version],
+    )
+    assert updated.version == version + 1
+    assert (
+        crud.get_patient_version(db=get_db(), patient_id=int(patient.id)) == version + 1
+    )
+
+    with pytest.raises(HTTPException) as execinfo:
+        crud.update_patient(
+            db=get_db(),
+            patient_id=int(patient.id),
+            patient=valid_patient,
+            versions=[version],
+        )
+    assert execinfo.value.status_code == 412
+
+
+def test_list_as_dicts_matches_schema():
+    """
+    Test that the dict rows for fast JSON have the same fields and values as the schema
+    """
+    rows = crud.get_patients(db=get_db(), query=None, limit=5, as_dicts=True)
+    patients = crud.get_patients(db=get_db(), query=None, limit=5)
+    assert jsonable_encoder(rows) == [
+        jsonable_encoder(schemas.Patient.from_orm(patient)) for patient in patients
+    ]
+    assert list(rows[0]) == list(schemas.Patient.__fields__)
+
+
+def test_crud_query_counts(
+    count_queries, valid_patient: PatientCreate, valid_address: AddressCreate
+):
+    """
+    Test the exact number of statements each crud function runs, and that none repeats a
+    statement
+    """
+    def run(fn, **kwargs):
+        with count_queries() as stats:
+            result = fn(db=get_db(), **kwargs)
+        assert stats.repeated(2) == {}, fn.__name__
+        return result, stats.statements
+
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    patient_id = int(patient.id)
+    patient_cache.clear()
+    new_patient = PatientCreate(
+        nhs_number="9000000017",
+        name=fake.name(),
+        dob=fake.date_of_birth(),
+        sex=fake.enum(Sex),
+    )
+    start_at = datetime(2999, 1, 2, 10).astimezone()
+    appointment = AppointmentCreate(
+        patient_id=patient_id, start_at=start_at, end_at=start_at.replace(hour=11)
+    )
+
+    counts = {}
+    counts["get_patient_by_id"] = run(crud.get_patient_by_id, patient_id=patient_id)[1]
+    counts["get_patient_by_nhs_number"] = run(
+        crud.get_patient_by_nhs_number, nhs_number=valid_patient.nhs_number
+    )[1]
+    counts["get_cached_patient (miss)"] = run(
+        crud.get_cached_patient, patient_id=patient_id
+    )[1]
+    counts["get_cached_patient (hit)"] = run(
+        crud.get_cached_patient, patient_id=patient_id
+    )[1]
+    counts["get_patients"] = run(crud.get_patients, query=None)[1]
+    counts["get_patients (search)"] = run(crud.get_patients, query="winch")[1]
+    created, counts["create_patient"] = run(crud.create_patient, patient=new_patient)
+    counts["update_patient"] = run(
+        crud.update_patient, patient_id=int(created.id), patient=new_patient
+    )[1]
+    counts["create_patient_address"] = run(
+        crud.create_patient_address, address=valid_address, patient_id=patient_id
+    )[1]
+    counts["get_address_by_patient_id"] = run(
+        crud.get_address_by_patient_id, patient_id=patient_id
+    )[1]
+    counts["get_addresses"] = run(crud.get_addresses)[1]
+    db_appointment, counts["create_appointment"] = run(
+        crud.create_appointment, appointment=appointment
+    )
+    counts["get_appointments"] = run(crud.get_appointments)[1]
+    counts["get_appointment_by_id"] = run(
+        crud.get_appointment_by_id, appointment_id=db_appointment.id
+    )[1]
+    counts["update_appointment"] = run(
+        crud.update_appointment,
+        appointment_id=db_appointment.id,
+        appointment=appointment,
+    )[1]
+    counts["mark_appointment_attended"] = run(
+        crud.mark_appointment_attended, appointment_id=db_appointment.id
+    )[1]
+    counts["delete_patient"] = run(crud.delete_patient, patient_id=int(created.id))[1]
+    assert counts == {
+        "get_patient_by_id": 1,
+        "get_patient_by_nhs_number": 1,
+        "get_cached_patient (miss)": 1,
+        "get_cached_patient (hit)": 0,
+        "get_patients": 1,
+        "get_patients (search)": 1,
+        "create_patient": 1,
+        "update_patient": 1,
+        "create_patient_address": 1,  # The patient check is a cache hit
+        "get_address_by_patient_id": 1,
+        "get_addresses": 1,
+        # Writes also upsert the day's stats, unless they don't change
+        "create_appointment": 2,
+        "get_appointments": 1,
+        "get_appointment_by_id": 1,
+        "update_appointment": 2,  # Reads the day and status it moves from
+        "mark_appointment_attended": 2,
+        # Loads the patient, then its addresses and appointments to unlink them
+        "delete_patient": 4,
+    }
+
+
+def test_get_patients_include_query_count(count_queries, valid_address: AddressCreate):
+    """
+    Test that embedding addresses and appointments costs one query per relationship,
+    however many patients
+    """
+    include = frozenset(PatientInclude)
+    start_at = datetime(2999, 1, 1, 10).astimezone()
+    counts = []
+    for limit in (1, 10):
+        with count_queries() as stats:
+            patients = crud.get_patients(
+                db=get_db(), query=None, limit=limit, include=include
+            )
+        counts.append(stats.statements)
+        assert len(patients) == limit
+    assert counts == [3, 3]
+
+    patient = patients[-1]
+    crud.create_patient_address(
+        db=get_db(), address=valid_address, patient_id=patient["id"]
+    )
+    latest = crud.create_patient_address(
+        db=get_db(), address=valid_address, patient_id=patient["id"]
+    )
+    upcoming = crud.create_appointment(
+        db=get_db(),
+        appointment=AppointmentCreate(
+            patient_id=patient["id"],
+            start_at=start_at,
+            end_at=start_at.replace(hour=11),
+        ),
+    )
+    related = crud.get_patient_with_related(
+        db=get_db(), patient_id=patient["id"], include=include
+    )
+    assert related["address"]["id"] == latest.id
+    assert upcoming.id in [appointment["id"] for appointment in related["appointments"]]
+    schemas.PatientWithRelations(**related)
+
+    only_address = crud.get_patient_with_related(
+        db=get_db(),
+        patient_id=patient["id"],
+        include=frozenset({PatientInclude.ADDRESS}),
+    )
+    assert "appointments" not in only_address
+
+
+def test_get_appointments_filters(valid_patient: PatientCreate):
+    """
+    Test the start time range, patient and status filters, and a patient's own
+    appointments
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    day = datetime(2998, 3, 2, 9).astimezone()
+    created = [
+        crud.create_appointment(
+            db=get_db(),
+            appointment=AppointmentCreate(
+                patient_id=patient.id,
+                start_at=day.replace(hour=hour),
+                end_at=day.replace(hour=hour, minute=30),
+            ),
+        )
+        for hour in (9, 12, 17)
+    ]
+    crud.cancel_appointment(db=get_db(), appointment_id=created[1].id)
+
+    day_sheet = crud.get_appointments(
+        db=get_db(), start_from=day, start_to=day.replace(hour=17)
+    )
+    assert [appointment.id for appointment in day_sheet] == [
+        created[0].id,
+        created[1].id,
+    ]
+
+    scheduled = crud.get_appointments(
+        db=get_db(),
+        start_from=day,
+        start_to=day.replace(hour=23),
+        patient_id=patient.id,
+        status=AppointmentStatus.SCHEDULED,
+    )
+    assert [appointment.id for appointment in scheduled] == [
+        created[0].id,
+        created[2].id,
+    ]
+    cancelled = crud.get_patient_appointments(
+        db=get_db(),
+        patient_id=patient.id,
+        start_from=day,
+        start_to=day.replace(hour=23),
+        status=AppointmentStatus.CANCELLED,
+    )
+    assert [appointment.id for appointment in cancelled] == [created[1].id]
+    assert crud.get_appointments(db=get_db(), start_from=day, patient_id=999999) == []
+    with pytest.raises(HTTPException) as execinfo:
+        crud.get_patient_appointments(db=get_db(), patient_id=999999)
+    assert execinfo.value.detail.startswith(crud.ErrorsEng.NO_PATIENT_FOR_ID.value)
+
+
+def test_sweeper_marks_missed_appointments(valid_patient: PatientCreate):
+    """
+    Test that the sweeper marks ended, open appointments as missed in chunks, and leaves
+    the rest alone
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    ended_at = datetime(2001, 1, 1, 10).astimezone()
+    past = [
+        AppointmentCreate(
+            patient_id=patient.id,
+            start_at=ended_at.replace(hour=hour),
+            end_at=ended_at.replace(hour=hour, minute=30),
+        )
+        for hour in (9, 10, 11, 12)
+    ]
+    missed = [
+        crud.create_appointment(db=get_db(), appointment=appointment)
+        for appointment in past[:3]
+    ]
+    cancelled = crud.create_appointment(db=get_db(), appointment=past[3])
+    crud.cancel_appointment(db=get_db(), appointment_id=cancelled.id)
+
+    assert [appointment.status for appointment in missed] == ["scheduled"] * 3
+    # Counted as missed before the sweep too
+    overdue = crud.get_appointments(
+        db=get_db(), patient_id=patient.id, status=AppointmentStatus.MISSED
+    )
+    assert [appointment.id for appointment in overdue] == [
+        appointment.id for appointment in missed
+    ]
+
+    assert sweeper.sweep_missed(SessionLocal, chunk_size=2) == 3
+    assert sweeper.sweep_missed(SessionLocal, chunk_size=2) == 0
+    for appointment in missed:
+        swept = crud.get_appointment_by_id(db=get_db(), appointment_id=appointment.id)
+        assert (swept.status, swept.version) == ("missed", appointment.version + 1)
+    assert (
+        crud.get_appointment_by_id(db=get_db(), appointment_id=cancelled.id).status
+        == "cancelled"
+    )
+
+
+def test_appointment_stats_rollup(valid_patient: PatientCreate):
+    """
+    Test that the incrementally maintained rollup matches a rebuild, and the per day and
+    per week rates
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    monday = datetime(2997, 6, 5, 9).astimezone()  # A Monday
+
+    def book(day: datetime) -> models.Appointment:
+        return crud.create_appointment(
+            db=get_db(),
+            appointment=AppointmentCreate(
+                patient_id=patient.id, start_at=day, end_at=day.replace(minute=30)
+            ),
+        )
+
+    attended, cancelled, moved = (
+        book(monday),
+        book(monday.replace(hour=10)),
+        book(monday.replace(hour=11)),
+    )
+    crud.mark_appointment_attended(db=get_db(), appointment_id=attended.id)
+    crud.cancel_appointment(db=get_db(), appointment_id=cancelled.id)
+    tuesday = monday.replace(day=6)
+    crud.update_appointment(
+        db=get_db(),
+        appointment_id=moved.id,
+        appointment=AppointmentCreate(
+            patient_id=patient.id, start_at=tuesday, end_at=tuesday.replace(minute=30)
+        ),
+    )
+
+    days = crud.get_appointment_stats(
+        db=get_db(), date_from=monday.date(), date_to=tuesday.date()
+    )
+    assert [
+        (
+            day["period_start"],
+            day["total"],
+            day["attended"],
+            day["cancelled"],
+            day["scheduled"],
+        )
+        for day in days
+    ] == [
+        (monday.date(), 2, 1, 1, 0),
+        (tuesday.date(), 1, 0, 0, 1),
+    ]
+    assert (
+        days[0]["attendance_rate"],
+        days[0]["cancellation_rate"],
+        days[1]["dna_rate"],
+    ) == (1.0, 0.5, None)
+    weeks = crud.get_appointment_stats(
+        db=get_db(),
+        date_from=monday.date(),
+        date_to=tuesday.date(),
+        period=StatsPeriod.WEEK,
+    )
+    assert [(week["period_start"], week["total"]) for week in weeks] == [
+        (monday.date(), 3)
+    ]
+
+    def rollup():
+        with engine.connect() as connection:
+            return connection.execute(
+                models.AppointmentDailyStats.__table__.select().order_by("day")
+            ).all()
+
+    incremental = rollup()
+    with engine.begin() as connection:
+        stats.rebuild(connection)
+    assert rollup() == incremental
+
+    with pytest.raises(HTTPException) as execinfo:
+        crud.get_appointment_stats(
+            db=get_db(), date_from=date(2997, 1, 1), date_to=date(2998, 6, 1)
+        )
+    assert execinfo.value.status_code == 400
+
+
+def test_double_booking_is_refused(valid_patient: PatientCreate):
+    """
+    Test that creating or moving an appointment onto another of the patient's bookings
+    is refused,
+    while back to back and cancelled bookings are allowed
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    day = datetime(2996, 5, 1, 9).astimezone()
+
+    def booking(hour: int, minute: int = 0, hours: int = 1) -> AppointmentCreate:
+        start_at = day.replace(hour=hour, minute=minute)
+        return AppointmentCreate(
+            patient_id=patient.id,
+            start_at=start_at,
+            end_at=start_at.replace(hour=hour + hours),
+        )
+
+    first = crud.create_appointment(db=get_db(), appointment=booking(9))
+    with pytest.raises(HTTPException) as execinfo:
+        crud.create_appointment(db=get_db(), appointment=booking(9, 30))
+    assert execinfo.value.detail == f"{crud.ErrorsEng.APPT_OVERLAP.value}{first.id}"
+
+    second = crud.create_appointment(
+        db=get_db(), appointment=booking(10)
+    )  # Back to back
+    with pytest.raises(HTTPException) as execinfo:
+        crud.update_appointment(
+            db=get_db(), appointment_id=second.id, appointment=booking(8, 30)
+        )
+    assert execinfo.value.detail == f"{crud.ErrorsEng.APPT_OVERLAP.value}{first.id}"
+    # Moving within its own slot doesn't conflict with itself
+    crud.update_appointment(
+        db=get_db(), appointment_id=second.id, appointment=booking(10, 15)
+    )
+
+    crud.cancel_appointment(db=get_db(), appointment_id=first.id)
+    crud.create_appointment(db=get_db(), appointment=booking(9))
+
+    # An overlap that is gone by the time it is looked up, every time, as if bookings
+    # kept racing
+    with patch.object(crud, "_raise_for_overlap"), pytest.raises(
+        HTTPException
+    ) as execinfo:
+        crud.create_appointment(db=get_db(), appointment=booking(9, 30))
+    assert execinfo.value.status_code == 409
+    assert (
+        execinfo.value.detail
+        == f"{crud.ErrorsEng.APPT_BOOKING_CONFLICT.value}{patient.id}"
+    )
+
+
+def test_appointment_conflicts_report(valid_patient: PatientCreate):
+    """
+    Test that the sweep line finds the same overlapping pairs as comparing every pair
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    other = crud.get_patients(db=get_db(), query=None, limit=2)[-1]
+    day = datetime(2995, 2, 1)
+    # Written directly, as from before double bookings were refused
+    db = get_db()
+    for patient_id, start_hour, start_minute, minutes in [
+        (patient.id, 9, 0, 120),
+        (patient.id, 9, 30, 30),
+        (patient.id, 10, 0, 30),
+        (patient.id, 11, 0, 30),
+        (patient.id, 11, 30, 30),
+        (other.id, 9, 0, 60),
+        (other.id, 9, 15, 15),
+        (other.id, 12, 0, 30),
+    ]:
+        start_at = day.replace(hour=start_hour, minute=start_minute)
+        db.add(
+            models.Appointment(
+                patient_id=patient_id,
+                start_at=start_at,
+                end_at=start_at + timedelta(minutes=minutes),
+                is_cancelled=False,
+            )
+        )
+    db.commit()
+
+    conflicts = crud.get_appointment_conflicts(
+        db=get_db(), start_from=day, start_to=day + timedelta(days=1)
+    )
+    rows = crud.get_appointments(
+        db=get_db(), start_from=day, start_to=day + timedelta(days=1)
+    )
+    expected = {
+        (a.id, b.id)
+        for a in rows
+        for b in rows
+        if a.patient_id == b.patient_id
+        and (a.start_at, a.id) < (b.start_at, b.id)
+        and b.start_at < a.end_at
+    }
+    assert {
+        (conflict["appointment_id"], conflict["other_appointment_id"])
+        for conflict in conflicts
+    } == expected
+    assert len(expected) == 3
+
+
+def test_bulk_cancel_and_attended(valid_patient: PatientCreate):
+    """
+    Test that bulk updates apply the single appointment guards per id, and keep the
+    stats rollup in step
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    day = datetime(2994, 3, 1).astimezone()
+    ids = [
+        crud.create_appointment(
+            db=get_db(),
+            appointment=AppointmentCreate(
+                patient_id=patient.id,
+                start_at=day.replace(hour=hour),
+                end_at=day.replace(hour=hour, minute=30),
+            ),
+        ).id
+        for hour in (9, 10, 11, 12)
+    ]
+    crud.mark_appointment_attended(db=get_db(), appointment_id=ids[0])
+
+    outcomes = crud.bulk_cancel_appointments(
+        db=get_db(), ids=[ids[0], ids[1], ids[1], 0]
+    )
+    assert outcomes == [
+        (ids[0], None, f"{crud.ErrorsEng.APPT_ALREADY_ATTENDED.value}{ids[0]}"),
+        (ids[1], AppointmentStatus.CANCELLED.value, None),
+        (0, None, f"{crud.ErrorsEng.NO_APPT_FOR_ID.value}0"),
+    ]
+
+    outcomes = crud.bulk_mark_appointments_attended(
+        db=get_db(), start_from=day, start_to=day + timedelta(days=1), patient_id=None
+    )
+    assert [(appointment_id, status) for appointment_id, status, _ in outcomes] == [
+        (ids[0], None),
+        (ids[1], None),
+        (ids[2], AppointmentStatus.ATTENDED.value),
+        (ids[3], AppointmentStatus.ATTENDED.value),
+    ]
+
+    stats = crud.get_appointment_stats(
+        db=get_db(), date_from=day.date(), date_to=day.date(), period=StatsPeriod.DAY
+    )
+    assert (
+        stats[0]["total"],
+        stats[0]["attended"],
+        stats[0]["cancelled"],
+        stats[0]["scheduled"],
+    ) == (4, 3, 1, 0)
+
+
+def test_bulk_cancel_moves_each_status_out_of_its_count(valid_patient: PatientCreate):
+    """
+    Test that cancelling missed and scheduled appointments in one UPDATE takes each from
+    the stats count of its previous status
+    """
+    patient = crud.get_patient_by_nhs_number(
+        db=get_db(), nhs_number=valid_patient.nhs_number
+    )
+    past, future = (
+        datetime(2002, 3, 1, 9).astimezone(),
+        datetime(2993, 3, 1, 9).astimezone(),
+    )
+    ids = [
+        crud.create_appointment(db=get_db(), appointment=AppointmentCreate(
+            patient_id=patient.id, start_at=day, end_at=day.replace(minute=30),
+        )).id
+        for day in (past, future)
+    ]
+    sweeper.sweep_missed(SessionLocal, chunk_size=100)
+    assert (
+        crud.get_appointment_by_id(db=get_db(), appointment_id=ids[0]).status
+        == "missed"
+    )
+
+    outcomes = crud.bulk_cancel_appointments(db=get_db(), ids=ids)
+    assert [status for _, status, _ in outcomes] == [
+        AppointmentStatus.CANCELLED.value
+    ] * 2
+    for day in (past, future):
+        counts = crud.get_appointment_stats(
+            db=get_db(), date_from=day.date(), date_to=day.date()
+        )
+        assert (
+            counts[0]["cancelled"],
+            counts[0]["missed"],
+            counts[0]["scheduled"],
+        ) == (1, 0, 0)
+
+
+def test_stats_fall_back_to_update_then_insert():
+    """
+    Test that databases without INSERT ... ON CONFLICT add to the rollup with an UPDATE,
+    inserting the days that aren't there yet
+    """
+    start_at = datetime(2991, 5, 1, 9)
+    db = get_db()
+    with patch.dict(stats.UPSERT_INSERTS, clear=True):
+        stats.created(db, start_at)
+        stats.created(db, start_at)
+        stats.transitions(db, [(start_at, "scheduled", "cancelled")])
+    db.commit()
+    counts = crud.get_appointment_stats(
+        db=get_db(), date_from=start_at.date(), date_to=start_at.date()
+    )
+    assert (counts[0]["total"], counts[0]["scheduled"], counts[0]["cancelled"]) == (
+        2,
+        1,
+        1,
+    )
@@ -0,0 +1,171 @@
+import time
+from datetime import date
+
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import Engine, create_engine, insert, update
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from panda import crud, database, models
+from panda.cache import patient_cache
+
+
+@pytest.fixture(name="file_engine")
+def fixture_file_engine(tmp_path) -> Engine:
+    """ Returns a tuned engine for a file SQLite database """
+    url = f"sqlite:///{tmp_path}/panda_database_test.db"
+    engine = create_engine(url, **database.engine_options(url))
+    database.set_sqlite_pragmas(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_sqlite_pragmas_set_on_connect(file_engine: Engine):
+    """
+    Test that new SQLite connections use WAL and the configured pragmas
+    """
+    report = database.describe_engine(file_engine)
+    assert report["journal_mode"] == "wal"
+    assert report["synchronous"] == 1  # NORMAL
+    assert report["cache_size"] == database.settings.SQLITE_CACHE_SIZE
+
+
+def test_pool_options_only_for_file_databases(file_engine: Engine):
+    """
+    Test that pool sizing applies to file databases, but in-memory databases keep a
+    single connection
+    """
+    assert isinstance(file_engine.pool, QueuePool)
+    assert file_engine.pool.size() == database.settings.DB_POOL_SIZE
+    assert "pool_size" not in database.engine_options("sqlite://")
+    assert "pool_size" not in database.engine_options("sqlite:///:memory:")
+
+
+@pytest.fixture(name="replica_pool")
+def fixture_replica_pool(tmp_path) -> database.ReplicaPool:
+    """Returns a pool of a missing replica and a read-only replica of a file database"""
+    create_engine(f"sqlite:///{tmp_path}/replica.db").connect().close()
+    replicas = []
+    for i, name in enumerate(["missing", "replica"]):
+        url = f"sqlite:///file:{tmp_path}/{name}.db?mode=ro&uri=true"
+        replicas.append(
+            database.Replica(f"replica{i}", sessionmaker(bind=create_engine(url)))
+        )
+    return database.ReplicaPool(replicas, retry_interval=60)
+
+
+def test_reads_skip_failed_replicas(tmp_path, replica_pool: database.ReplicaPool):
+    """
+    Test that reads go round the replicas, skip one that can't connect, and fall back to
+    the primary
+    """
+    primary = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path}/primary.db"))
+
+    def database_of(db) -> str:
+        name = db.get_bind().url.database
+        db.close()
+        return name.rsplit("/", 1)[-1]
+
+    assert [
+        database_of(database.read_session(replica_pool, primary, {})) for _ in range(3)
+    ] == ["replica.db", "replica.db", "replica.db"]
+    assert replica_pool.replicas[0].failed_at is not None
+
+    replica_pool.replicas[1].failed_at = replica_pool.replicas[0].failed_at
+    assert database_of(database.read_session(replica_pool, primary, {})) == "primary.db"
+
+
+def test_reads_follow_own_writes(tmp_path, replica_pool: database.ReplicaPool):
+    """
+    Test that a client reads from the primary within the window after a write, and only
+    after a successful one
+    """
+    primary = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path}/primary.db"))
+    app = FastAPI()
+    app.add_middleware(database.ReadYourWritesMiddleware, window=5)
+
+    @app.post("/write")
+    def write(fail: bool = False):
+        if fail:
+            raise HTTPException(403)
+
+    @app.get("/read")
+    def read(request: Request):
+        db = database.read_session(replica_pool, primary, request.cookies)
+        try:
+            return db.get_bind().url.database.rsplit("/", 1)[-1]
+        finally:
+            db.close()
+
+    client = TestClient(app)
+    assert client.get("/read").json() == "replica.db"
+    assert client.post("/write", params={"fail": True}).status_code == 403
+    assert client.get("/read").json() == "replica.db"
+    assert database.LAST_WRITE_COOKIE in client.post("/write").headers["set-cookie"]
+    assert client.get("/read").json() == "primary.db"
+
+    client.cookies.set(database.LAST_WRITE_COOKIE, str(time.time() - 6))
+    assert client.get("/read").json() == "replica.db"
+
+
+def test_lagging_replica_does_not_fill_patient_cache(tmp_path):
+    """
+    Test that a patient read from a replica behind the primary isn't cached, so
+    the writer, reading from the primary, sees its update
+    """
+    engines = {}
+    for name in ("primary", "replica"):
+        engines[name] = create_engine(f"sqlite:///{tmp_path}/{name}.db")
+        models.Base.metadata.create_all(bind=engines[name])
+        with engines[name].begin() as connection:
+            connection.execute(
+                insert(models.Patient),
+                [
+                    {
+                        "id": 987654,
+                        "nhs_number": "4609571471",
+                        "name": "Old Name",
+                        "dob": date(1988, 12, 25),
+                        "sex": "Male",
+                    }
+                ],
+            )
+    # The update hasn't reached the replica yet
+    with engines["primary"].begin() as connection:
+        connection.execute(
+            update(models.Patient)
+            .where(models.Patient.id == 987654)
+            .values(name="New Name", version=2)
+        )
+    replica_url = f"sqlite:///file:{tmp_path}/replica.db?mode=ro&uri=true"
+    pool = database.ReplicaPool(
+        [database.Replica("replica0", sessionmaker(bind=create_engine(replica_url)))],
+        retry_interval=60,
+    )
+    primary = sessionmaker(bind=engines["primary"])
+    patient_cache.invalidate(987654, "4609571471")
+    try:
+        with database.read_session(pool, primary, {}) as db:
+            assert database.is_replica(db)
+            assert (
+                crud.get_cached_patient(db=db, patient_id=987654)["name"] == "Old Name"
+            )
+        assert patient_cache.get_by_id(987654) is None
+
+        writer = {database.LAST_WRITE_COOKIE: str(time.time())}
+        with database.read_session(pool, primary, writer) as db:
+            assert not database.is_replica(db)
+            assert (
+                crud.get_cached_patient_by_nhs_number(db=db, nhs_number="4609571471")[
+                    "name"
+                ]
+                == "New Name"
+            )
+        with database.read_session(pool, primary, {}) as db:
+            assert (
+                crud.get_cached_patient(db=db, patient_id=987654)["name"] == "New Name"
+            )
+    finally:
+        patient_cache.invalidate(987654, "4609571471")
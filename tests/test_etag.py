@@ -0,0 +1,25 @@
+from panda.util.etag import if_match_versions, if_none_match, make_etag
+
+
+def test_if_none_match():
+    """
+    Test that If-None-Match matches the current tag in a list, weakly, or with *
+    """
+    etag = make_etag(1, 2)
+    assert etag == '"1-2"'
+    assert if_none_match('"1-1", "1-2"', etag)
+    assert if_none_match('W/"1-2"', etag)
+    assert if_none_match("*", etag)
+    assert not if_none_match('"1-1"', etag)
+    assert not if_none_match(None, etag)
+
+
+def test_if_match_versions():
+    """
+    Test that If-Match gives the versions of this row only, and no precondition for *
+    """
+    assert if_match_versions(None, 1) is None
+    assert if_match_versions("*", 1) is None
+    assert if_match_versions('"1-2", "1-3"', 1) == [2, 3]
+    assert if_match_versions('"2-2"', 1) == []
+    assert if_match_versions('W/"1-2"', 1) == []
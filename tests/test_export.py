@@ -0,0 +1,66 @@
+import asyncio
+from datetime import date, datetime
+from typing import AsyncIterator, List
+
+from panda.core.config import settings
+from panda.enums import ExportFormat
+from panda.util import export
+
+ROWS = [
+    {
+        "id": 1,
+        "name": "Zoë Winch",
+        "dob": date(1988, 12, 25),
+        "created_at": datetime(2023, 6, 23, 10, 0, 0, 1),
+    },
+    {"id": 2, "name": "Winch, David", "dob": date(1990, 1, 1), "created_at": None},
+]
+
+
+async def batches() -> AsyncIterator[List[dict]]:
+    yield ROWS[:1]
+    yield ROWS[1:]
+
+
+def collect(export_format: ExportFormat) -> bytes:
+    async def read():
+        return b"".join(
+            [
+                chunk
+                async for chunk in export.encode(
+                    batches(), export_format, list(ROWS[0])
+                )
+            ]
+        )
+    return asyncio.run(read())
+
+
+def test_ndjson_export():
+    """
+    Test that NDJSON rows use ISO 8601 dates and keep unicode characters
+    """
+    assert collect(ExportFormat.NDJSON).decode().splitlines() == [
+        '{"id":1,"name":"Zoë Winch","dob":"1988-12-25",'
+        '"created_at":"2023-06-23T10:00:00.000001"}',
+        '{"id":2,"name":"Winch, David","dob":"1990-01-01","created_at":null}',
+    ]
+
+
+def test_fast_json_export_is_byte_compatible(monkeypatch):
+    """
+    Test that the orjson encoder writes exactly the same NDJSON as the json module
+    """
+    expected = collect(ExportFormat.NDJSON)
+    monkeypatch.setattr(settings, "FAST_JSON", True)
+    assert collect(ExportFormat.NDJSON) == expected
+
+
+def test_csv_export():
+    """
+    Test that CSV exports have a header row and quote values where needed
+    """
+    assert collect(ExportFormat.CSV).decode().splitlines() == [
+        "id,name,dob,created_at",
+        "1,Zoë Winch,1988-12-25,2023-06-23T10:00:00.000001",
+        '2,"Winch, David",1990-01-01,',
+    ]
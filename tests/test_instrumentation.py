@@ -0,0 +1,48 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from panda.instrumentation import QueryBudgetExceeded, QueryBudgetMiddleware
+
+
+def make_client(queries: int, **options) -> TestClient:
+    engine = create_engine("sqlite://")
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    def get_items(item_id: int):
+        with engine.connect() as connection:
+            for i in range(queries):
+                connection.execute(text("SELECT :i"), {"i": i})
+        return {"id": item_id}
+
+    app.add_middleware(QueryBudgetMiddleware, mode="raise", **options)
+    return TestClient(app)
+
+
+def test_query_budget_per_route():
+    """
+    Test that a route over its own budget fails in raise mode, and others use the
+    default
+    """
+    client = make_client(
+        3, budget=20, budgets={"GET /items/{item_id}": 2}, n_plus_one_threshold=10
+    )
+    with pytest.raises(QueryBudgetExceeded, match="3 statements, over the budget of 2"):
+        client.get("/items/1")
+    assert (
+        make_client(3, budget=20, budgets={}, n_plus_one_threshold=10)
+        .get("/items/1")
+        .status_code
+        == 200
+    )
+
+
+def test_repeated_statements_are_flagged():
+    """
+    Test that the same statement run threshold times is reported as a possible N+1
+    """
+    client = make_client(5, budget=20, budgets={}, n_plus_one_threshold=5)
+    with pytest.raises(QueryBudgetExceeded, match="5 x SELECT"):
+        client.get("/items/1")
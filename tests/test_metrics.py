@@ -0,0 +1,91 @@
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from panda import crud, metrics
+from panda.core.config import settings
+
+
+@pytest.fixture(name="registry")
+def fixture_registry() -> metrics.Registry:
+    """ Returns the metrics registry, emptied before and after the test """
+    metrics.registry.clear()
+    yield metrics.registry
+    metrics.registry.clear()
+
+
+def test_histogram_buckets_are_cumulative(registry: metrics.Registry):
+    """
+    Test that observations are rendered as cumulative buckets with a sum and count
+    """
+    metrics.observe_request("GET", "/patients/{patient_id}", 200, 0.003)
+    metrics.observe_request("GET", "/patients/{patient_id}", 200, 0.2)
+    text = metrics.render()
+    labels = 'method="GET",route="/patients/{patient_id}"'
+    assert f'panda_http_requests_total{{{labels},status="200"}} 2' in text
+    assert (
+        f'panda_http_request_duration_seconds_bucket{{{labels},le="0.005"}} 1' in text
+    )
+    assert f'panda_http_request_duration_seconds_bucket{{{labels},le="0.25"}} 2' in text
+    assert f'panda_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+    assert f'panda_http_request_duration_seconds_count{{{labels}}} 2' in text
+
+
+def test_statements_grouped_by_operation(registry: metrics.Registry):
+    """
+    Test that statements are counted by their leading keyword, with a bounded set of
+    labels
+    """
+    metrics.observe_statement("\nSELECT patients.id FROM patients", 0.001)
+    metrics.observe_statement("PRAGMA journal_mode", 0.001)
+    text = metrics.render()
+    assert 'panda_db_statements_total{operation="SELECT"} 1' in text
+    assert 'panda_db_statements_total{operation="OTHER"} 1' in text
+
+
+def test_workers_are_aggregated(registry: metrics.Registry, tmp_path, monkeypatch):
+    """
+    Test that a scrape adds the snapshots written by other workers to its own metrics
+    """
+    monkeypatch.setattr(settings, "METRICS_DIR", str(tmp_path))
+    metrics.count_http_exception(403, "NO_PATIENT_FOR_ID")
+    other_worker = metrics.Registry()
+    other_worker.inc("panda_http_exceptions_total", ("403", "NO_PATIENT_FOR_ID"), 2)
+    (tmp_path / "1.json").write_text(json.dumps(other_worker.snapshot()))
+    assert (
+        'panda_http_exceptions_total{status="403",code="NO_PATIENT_FOR_ID"} 3'
+        in metrics.render()
+    )
+
+
+def test_middleware_uses_route_template(registry: metrics.Registry):
+    """
+    Test that requests are recorded by route template rather than raw path
+    """
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int):
+        return {"id": item_id}
+
+    app.add_middleware(metrics.MetricsMiddleware)
+    client = TestClient(app)
+    client.get("/items/1")
+    client.get("/items/2")
+    client.get("/missing")
+    assert registry.counters["panda_http_requests_total"] == {
+        ("GET", "/items/{item_id}", "200"): 2,
+        ("GET", "(no route)", "404"): 1,
+    }
+
+
+def test_error_code():
+    """
+    Test that HTTPException details are mapped back to their ErrorsEng code
+    """
+    assert (
+        crud.error_code(f"{crud.ErrorsEng.NO_APPT_FOR_ID.value}12") == "NO_APPT_FOR_ID"
+    )
+    assert crud.error_code("Not Found") == "OTHER"
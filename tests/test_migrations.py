@@ -0,0 +1,104 @@
+import pytest
+from sqlalchemy import Engine, create_engine, inspect, text
+
+from panda import migrations, models
+
+
+@pytest.fixture(name="legacy_engine")
+def fixture_legacy_engine(tmp_path) -> Engine:
+    """ Returns an engine for a database created before the migrations existed """
+    engine = create_engine(f"sqlite:///{tmp_path}/panda_migrations_test.db")
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for name in [
+            "ix_addresses_owner",
+            "ix_appointments_start_at",
+            "ix_appointments_end_at",
+            "ix_appointments_patient_interval",
+            "ix_appointments_status_end",
+        ]:
+            connection.execute(text(f"DROP INDEX {name}"))
+    yield engine
+    engine.dispose()
+
+
+def index_names(engine: Engine, table: str):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def test_upgrade_adds_missing_indexes(legacy_engine: Engine):
+    """
+    Test that upgrading an existing database adds the indexes and columns, and records
+    each version
+    """
+    assert migrations.current_version(legacy_engine) == 0
+    assert "ix_addresses_owner" not in index_names(legacy_engine, "addresses")
+
+    with legacy_engine.begin() as connection:
+        for table in ["patients", "addresses", "appointments"]:
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN version"))
+        connection.execute(text("ALTER TABLE appointments DROP COLUMN status"))
+        connection.execute(
+            text(
+                "CREATE INDEX ix_appointments_patient_start "
+                "ON appointments (patient_id, start_at)"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO appointments "
+                "(patient_id, start_at, end_at, is_cancelled, attended_at) VALUES "
+                "(1, '2023-06-25 10:00:00', '2023-06-25 11:00:00', 1, NULL), "
+                "(1, '2023-06-25 10:00:00', '2023-06-25 11:00:00', 0, "
+                "'2023-06-25 10:30:00')"
+            )
+        )
+
+    applied = migrations.upgrade(legacy_engine)
+
+    assert [m.version for m in applied] == [m.version for m in migrations.MIGRATIONS]
+    assert (
+        migrations.current_version(legacy_engine) == migrations.MIGRATIONS[-1].version
+    )
+    assert "ix_addresses_owner" in index_names(legacy_engine, "addresses")
+    assert {
+        "ix_appointments_start_at",
+        "ix_appointments_end_at",
+        "ix_appointments_patient_interval",
+        "ix_appointments_status_end",
+    } <= index_names(legacy_engine, "appointments")
+    assert "ix_appointments_patient_start" not in index_names(
+        legacy_engine, "appointments"
+    )
+    assert "version" in {
+        column["name"] for column in inspect(legacy_engine).get_columns("patients")
+    }
+    with legacy_engine.connect() as connection:
+        statuses = (
+            connection.execute(text("SELECT status FROM appointments ORDER BY id"))
+            .scalars()
+            .all()
+        )
+    assert statuses == ["cancelled", "attended"]
+    assert migrations.upgrade(legacy_engine) == []
+
+
+def test_explain_reports_index_usage(legacy_engine: Engine):
+    """
+    Test that the address owner lookup goes from a table scan to the composite index
+    """
+    before = migrations.explain_report(legacy_engine)["address_by_patient_id"]
+    migrations.upgrade(legacy_engine)
+    after = migrations.explain_report(legacy_engine)["address_by_patient_id"]
+    assert not any("ix_addresses_owner" in line for line in before)
+    assert any("ix_addresses_owner" in line for line in after)
+
+
+def test_explain_patient_schedule_uses_composite_index(legacy_engine: Engine):
+    """
+    Test that a patient's appointments from a start time are read from the (patient_id,
+    start_at, end_at) index
+    """
+    migrations.upgrade(legacy_engine)
+    plan = migrations.explain_report(legacy_engine)["patient_schedule"]
+    assert any("ix_appointments_patient_interval" in line for line in plan)
@@ -1,6 +1,10 @@
 import pytest
 
-from panda.util.nhs_validator import is_valid_nhs_number
+from panda.util.nhs_validator import (
+    NhsNumberReason,
+    is_valid_nhs_number,
+    validate_nhs_numbers,
+)
 
 
 @pytest.fixture(name="valid_nhs_numbers")
@@ -99,3 +103,49 @@ def test_validation_alpha():
     value = 'abc4567890'
     with pytest.raises(ValueError):
         is_valid_nhs_number(value)
+
+
+def test_checksum_of_eleven_is_zero():
+    """
+    Test that a checksum of 11 is represented by a final digit of 0
+    """
+    assert is_valid_nhs_number('4000000020')
+
+
+def test_batch_matches_single_validation(valid_nhs_numbers, invalid_nhs_numbers):
+    """
+    Test that batch validation agrees with the single number validator
+    """
+    numbers = valid_nhs_numbers + invalid_nhs_numbers + ['4000000020']
+    mask, reasons = validate_nhs_numbers(numbers)
+    assert mask.tolist() == [is_valid_nhs_number(n) for n in numbers]
+    assert reasons.tolist() == [NhsNumberReason.VALID] * len(valid_nhs_numbers) + [
+        NhsNumberReason.MISMATCH
+    ] * len(invalid_nhs_numbers) + [NhsNumberReason.VALID]
+
+
+def test_batch_reason_codes(invalid_format_nhs_numbers):
+    """
+    Test that batch validation reports why each number failed
+    """
+    numbers = ['0123456', '12345678900', 'abc4567890', '4000000080', '']
+    mask, reasons = validate_nhs_numbers(numbers + invalid_format_nhs_numbers)
+    assert not mask.any()
+    assert reasons.tolist() == [
+        NhsNumberReason.BAD_LENGTH,
+        NhsNumberReason.BAD_LENGTH,
+        NhsNumberReason.NON_NUMERIC,
+        NhsNumberReason.CHECKSUM_10,
+        NhsNumberReason.BAD_LENGTH,
+        NhsNumberReason.BAD_LENGTH,
+        NhsNumberReason.BAD_LENGTH,
+        NhsNumberReason.BAD_LENGTH,
+    ]
+
+
+def test_batch_of_nothing():
+    """
+    Test that an empty batch returns empty results
+    """
+    mask, reasons = validate_nhs_numbers([])
+    assert len(mask) == len(reasons) == 0
@@ -0,0 +1,93 @@
+from datetime import date
+
+from sqlalchemy import create_engine, func, insert, select
+
+from panda import migrations, models, populate_db
+from panda.util.nhs_validator import validate_nhs_numbers
+
+
+def test_nhs_numbers_are_valid_unique_and_continue():
+    """
+    Test that generated NHS numbers have valid check digits, never repeat, and that
+    skipping the numbers already used gives the rest of the same sequence
+    """
+    numbers = populate_db.nhs_numbers(50000, block_size=10000)
+    valid, _ = validate_nhs_numbers(numbers.astype(str))
+    assert valid.all()
+    assert len(set(numbers.tolist())) == 50000
+    assert (
+        populate_db.nhs_numbers(1000, skip=20000, block_size=10000)
+        == numbers[20000:21000]
+    ).all()
+
+
+def test_populate_appends_and_rebuilds_stats(tmp_path):
+    """
+    Test that a second run adds patients after the first, and the stats match the
+    appointments
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'populate.db'}")
+    migrations.upgrade(engine)
+    first = populate_db.populate(
+        engine, patients=300, seed=1, appointments=4, chunk_size=128
+    )
+    second = populate_db.populate(
+        engine, patients=200, seed=2, appointments=4, chunk_size=128
+    )
+    assert (first["patients"], second["patients"], second["addresses"]) == (
+        300,
+        200,
+        200,
+    )
+
+    with engine.connect() as connection:
+        assert (
+            connection.scalar(
+                select(func.count(func.distinct(models.Patient.nhs_number)))
+            )
+            == 500
+        )
+        statuses = dict(
+            connection.execute(
+                select(models.Appointment.status, func.count()).group_by(
+                    models.Appointment.status
+                )
+            ).all()
+        )
+        totals = connection.execute(
+            select(
+                func.sum(models.AppointmentDailyStats.total),
+                func.sum(models.AppointmentDailyStats.missed),
+            )
+        ).one()
+    assert set(statuses) == {"scheduled", "attended", "cancelled", "missed"}
+    assert totals == (
+        first["appointments"] + second["appointments"],
+        statuses["missed"],
+    )
+
+
+def test_populate_skips_nhs_numbers_already_taken(tmp_path):
+    """
+    Test that a run leaves out NHS numbers patients added some other way already have
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'populate.db'}")
+    migrations.upgrade(engine)
+    populate_db.populate(engine, patients=10, seed=1, appointments=1, chunk_size=4)
+    # Added through the API, the numbers the next run starts with after 13 patients
+    taken = populate_db.nhs_numbers(3, skip=13)
+    with engine.begin() as connection:
+        connection.execute(insert(models.Patient), [
+            {
+                "nhs_number": str(number),
+                "name": "Taken",
+                "dob": date(1990, 1, 1),
+                "sex": "Male",
+            }
+            for number in taken
+        ])
+    populate_db.populate(engine, patients=10, seed=2, appointments=1, chunk_size=4)
+
+    with engine.connect() as connection:
+        distinct = select(func.count(func.distinct(models.Patient.nhs_number)))
+        assert connection.scalar(distinct) == 23
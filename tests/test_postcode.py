@@ -0,0 +1,52 @@
+import pytest
+
+from panda.util.postcode import (
+    Postcode,
+    normalise_postcode,
+    normalise_postcodes,
+    parse_postcode,
+)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("TR7 2SS", "TR7 2SS"),
+    (" tr72ss ", "TR7 2SS"),
+    ("TR7-2SS", "TR7 2SS"),
+    ("M1 1AE", "M1 1AE"),
+    ("B33 8TH", "B33 8TH"),
+    ("CR2 6XH", "CR2 6XH"),
+    ("DN55 1PT", "DN55 1PT"),
+    ("W1A 0AX", "W1A 0AX"),
+    ("EC1A 1BB", "EC1A 1BB"),
+    ("gir 0aa", "GIR 0AA"),
+])
+def test_postcodes_are_normalised(value, expected):
+    assert normalise_postcode(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value", ["111111", "TR72SSS", "TR77S2SS", "GIR 0AAXX", "XGIR0AA", "QI1 1AA", ""]
+)
+def test_invalid_postcodes(value):
+    """
+    Test that the whole postcode must match, not just its start or end
+    """
+    assert parse_postcode(value) is None
+    with pytest.raises(ValueError):
+        normalise_postcode(value)
+
+
+def test_outward_and_inward_codes():
+    """
+    Test that the inward code is the last three characters, however long the outward
+    code
+    """
+    assert parse_postcode("EC1A1BB") == Postcode("EC1A", "1BB")
+    assert parse_postcode("M11AE") == Postcode("M1", "1AE")
+    assert str(parse_postcode("m1 1ae")) == "M1 1AE"
+
+
+def test_batch_matches_single_normalisation():
+    values = ["tr7 2ss", "111111", "EC1A1BB", "TR7 2SS"]
+    assert normalise_postcodes(values) == ["TR7 2SS", None, "EC1A 1BB", "TR7 2SS"]
+    assert normalise_postcodes([]) == []